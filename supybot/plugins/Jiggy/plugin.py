@@ -122,7 +122,7 @@ class Judd(callbacks.Plugin):
                 pkgs.append( [row[0], row[1], row[2]] )
 
 
-            pkgs.sort( lambda a,b: debian_support.version_compare( a[1], b[1] ) )
+            pkgs.sort( key=lambda row: debian_support.Version( row[1] ) )
 
             reply = "%s --" % package
             for row in pkgs:
@@ -154,7 +154,7 @@ class Judd(callbacks.Plugin):
             else:
                 reply = "%s" % package
 
-            pkgs.sort( lambda a,b: debian_support.version_compare( a[1], b[1] ) )
+            pkgs.sort( key=lambda row: debian_support.Version( row[1] ) )
             for row in pkgs:
                 if release:
                     if( row[2] == 'main' ):
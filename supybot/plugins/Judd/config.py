@@ -88,11 +88,99 @@ conf.registerGlobalValue(Judd, 'db_port',
 conf.registerGlobalValue(Judd, 'db_database',
                          registry.String("udd",
                          "postgres to use", private=True))
+conf.registerGlobalValue(Judd, 'db_pool_size',
+                         registry.PositiveInteger(4,
+                         "maximum number of connections to the udd postgres "
+                         "database that may be open at once"))
+conf.registerGlobalValue(Judd, 'db_pool_timeout',
+                         registry.PositiveFloat(30.0,
+                         "time in seconds that a command will wait for a "
+                         "free connection to the udd postgres database"))
+conf.registerGlobalValue(Judd, 'db_reconnect_attempts',
+                         registry.NonNegativeInteger(3,
+                         "number of times that a query is retried after the "
+                         "connection to the udd postgres database is lost"))
+conf.registerGlobalValue(Judd, 'db_reconnect_backoff',
+                         registry.PositiveFloat(0.5,
+                         "time in seconds to wait before retrying a query "
+                         "after the connection to the udd postgres database "
+                         "is lost; the wait is doubled for each retry"))
+conf.registerGlobalValue(Judd, 'db_replicas',
+                         registry.String("",
+                         "connection strings for replicas of the udd postgres "
+                         "database between which queries are routed, "
+                         "separated by ';', e.g. 'host=mirror1; host=mirror2 "
+                         "port=5433'; other settings are taken from the db_ "
+                         "values. If empty, only db_hostname is used",
+                         private=True))
+conf.registerGlobalValue(Judd, 'db_routing',
+                         registry.String("round-robin",
+                         "how queries are routed between the replicas: "
+                         "round-robin or latency (to the replica that has "
+                         "been the fastest recently)"))
+conf.registerGlobalValue(Judd, 'db_cache_size',
+                         registry.NonNegativeInteger(16 * 1024 * 1024,
+                         "maximum size in bytes of the cache of results of "
+                         "queries on the udd postgres database; 0 disables "
+                         "the cache"))
+conf.registerGlobalValue(Judd, 'db_cache_ttl',
+                         registry.PositiveFloat(3600.0,
+                         "time in seconds for which query results are cached"))
+conf.registerGlobalValue(Judd, 'db_cache_table_ttls',
+                         registry.String("",
+                         "time in seconds for which the results of queries "
+                         "on particular tables are cached, "
+                         "e.g. 'bugs*=600, popcon=86400'"))
+conf.registerGlobalValue(Judd, 'db_cache_check_interval',
+                         registry.PositiveFloat(60.0,
+                         "time in seconds between checks for new imports "
+                         "into udd, which drop the cached results that they "
+                         "make stale"))
+conf.registerGlobalValue(Judd, 'db_release_cache_entries',
+                         registry.PositiveInteger(20000,
+                         "maximum number of packages kept in memory between "
+                         "commands for the releases that have been used"))
+conf.registerGlobalValue(Judd, 'db_release_cache_size',
+                         registry.NonNegativeInteger(0,
+                         "maximum size in bytes of the packages kept in "
+                         "memory between commands; 0 for no limit"))
+conf.registerGlobalValue(Judd, 'db_release_slices',
+                         registry.String("",
+                         "releases and architectures whose packages are held "
+                         "in memory so that they are looked up without "
+                         "queries, e.g. 'stable/i386, sid/amd64'"))
+conf.registerGlobalValue(Judd, 'db_snapshot',
+                         registry.String("",
+                         "snapshot file of the package tables (written by "
+                         "'udd-cache snapshot') to be queried instead of the "
+                         "database server; empty to use the server"))
+conf.registerGlobalValue(Judd, 'deadline',
+                         registry.Float(15.0,
+                         "time in seconds that the database queries for a "
+                         "command may take before the command is abandoned; "
+                         "0 disables the limit. The limit can be set for "
+                         "individual commands, e.g. deadline.checkinstall"))
+for command, budget in (('checkinstall', 30.0), ('why', 30.0),
+                        ('checkbuilddeps', 20.0), ('checkbackport', 30.0),
+                        ('checkdeps', 20.0)):
+    conf.registerGlobalValue(Judd.deadline, command,
+                             registry.Float(budget,
+                             "time in seconds that the database queries for "
+                             "the %s command may take; 0 disables the limit"
+                             % command))
 conf.registerGlobalValue(Judd, 'db_querylog',
                          registry.String("udd-query.log",
                          "logfile in which sql queries should be logged; "
                          "if a relative path is used, "
                          "it is relative to supybot.directories.logs"))
+conf.registerGlobalValue(Judd, 'db_log_slow_ms',
+                         registry.Float(100.0,
+                         "sql queries that take at least this many ms are "
+                         "always logged"))
+conf.registerGlobalValue(Judd, 'db_log_sample_rate',
+                         registry.Probability(0.01,
+                         "fraction of the faster sql queries that are "
+                         "logged"))
 conf.registerGlobalValue(Judd, 'use_conf_file',
                          registry.Boolean(True,
                          "use the udd-cache.conf file in the plugin directory "
@@ -35,6 +35,7 @@
 
 import supybot.conf as conf
 import supybot.utils as utils
+import supybot.registry as registry
 from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
@@ -50,12 +51,14 @@ import fnmatch
 import debcontents.contents_file
 
 import uddcache.udd
+import uddcache.database
 import uddcache.package_queries
 import uddcache.bug_queries
 import uddcache.config
 from uddcache.packages import PackageNotFoundError
 import uddcache.bts
 from uddcache.bts import BugNotFoundError
+from uddcache.database import DeadlineExceededError
 
 #
 #def parse_standard_options(optlist, args=None):
@@ -90,7 +93,31 @@ class Judd(callbacks.Plugin):
                         'port': self.registryValue('db_port'),
                         'username': self.registryValue('db_username'),
                         'password': self.registryValue('db_password'),
-                        'logfile': sqllog
+                        'replicas': self.registryValue('db_replicas'),
+                        'routing': self.registryValue('db_routing'),
+                        'pool_size': self.registryValue('db_pool_size'),
+                        'cache_size': self.registryValue('db_cache_size'),
+                        'cache_ttl': self.registryValue('db_cache_ttl'),
+                        'cache_table_ttls':
+                                self.registryValue('db_cache_table_ttls'),
+                        'cache_check_interval':
+                                self.registryValue('db_cache_check_interval'),
+                        'release_cache_entries':
+                                self.registryValue('db_release_cache_entries'),
+                        'release_cache_size':
+                                self.registryValue('db_release_cache_size'),
+                        'release_slices':
+                                self.registryValue('db_release_slices'),
+                        'snapshot': self.registryValue('db_snapshot'),
+                        'pool_timeout': self.registryValue('db_pool_timeout'),
+                        'reconnect_attempts':
+                                self.registryValue('db_reconnect_attempts'),
+                        'reconnect_backoff':
+                                self.registryValue('db_reconnect_backoff'),
+                        'logfile': sqllog,
+                        'log_slow_ms': self.registryValue('db_log_slow_ms'),
+                        'log_sample_rate':
+                                self.registryValue('db_log_sample_rate'),
                     }
             uddconf = uddcache.config.Config(confdict=confdict)
         # Initialise a UDD instance with the appropriate configuration
@@ -98,9 +125,29 @@ class Judd(callbacks.Plugin):
         self.dispatcher = uddcache.package_queries.Commands(self.udd)
         self.bugs_dispatcher = uddcache.bug_queries.Commands(self.udd)
 
+    def callCommand(self, command, irc, msg, *args, **kwargs):
+        """ run each command within its time budget for database queries """
+        try:
+            with self.udd.deadline(self.deadline(command)):
+                self.__parent.callCommand(command, irc, msg, *args, **kwargs)
+        except DeadlineExceededError:
+            irc.error("Sorry, that took too long to work out; "
+                      "please try a more specific query later.")
+
+    def deadline(self, command):
+        """the time budget for the queries made by the command"""
+        try:
+            return self.registryValue('deadline.%s' % command[-1])
+        except registry.NonExistentRegistryEntry:
+            return self.registryValue('deadline')
+
     def notfound(self, irc, package, release=None, arch=None,
-                 message="No package named '%s' was found%s."):
-        """ return a message indicating that the package was not found """
+                 message="No package named '%s' was found%s.", error=None):
+        """ return a message indicating that the package was not found
+
+        error: the PackageNotFoundError, whose suggested names are added to
+                the message
+        """
         if release:
             if arch:
                 tag = " in %s/%s" % (release, arch)
@@ -111,7 +158,10 @@ class Judd(callbacks.Plugin):
                 tag = " in %s" % arch
             else:
                 tag = ""
-        irc.reply(message % (package, tag))
+        message = message % (package, tag)
+        if error is not None and error.suggestions:
+            message += " Did you mean: %s?" % ", ".join(error.suggestions)
+        irc.reply(message)
 
     def versions(self, irc, msg, args, package, optlist, something):
         """<pattern> [--arch <i386>] [--release <stable>]
@@ -130,8 +180,8 @@ class Judd(callbacks.Plugin):
 
         try:
             pkgs = self.dispatcher.versions(package, release, arch)
-        except PackageNotFoundError:
-            return self.notfound(irc, package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, release, arch, error=e)
 
         replies = []
         for row in pkgs:
@@ -203,8 +253,8 @@ class Judd(callbacks.Plugin):
 
         try:
             pinfo = self.dispatcher.info(package, release, arch)
-        except PackageNotFoundError:
-            return self.notfound(irc, package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, release, arch, error=e)
 
         description = pinfo['description'].splitlines()
         if description:
@@ -250,8 +300,8 @@ class Judd(callbacks.Plugin):
 
         try:
             pkgs = self.dispatcher.archs(package, release)
-        except PackageNotFoundError:
-            return self.notfound(irc, package, release, None)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, release, None, error=e)
 
         replies = []
         for row in pkgs:
@@ -335,6 +385,108 @@ class Judd(callbacks.Plugin):
 
     danke = wrap(danke, [])
 
+    def dbstats(self, irc, msg, args, optlist, number):
+        """[--origin|--replica] [--sort <key>] [--reset] [<number>] | --cache | --flush
+
+        Show the database queries that have taken the most time, grouped by
+        the form of the query or, with --origin, by the command that made
+        them or, with --replica, by the database replica that ran them.
+        By default the top 5 by total time are shown; --sort orders them by
+        total, calls, errors, mean, p95, p99 or max instead.
+        With --cache, show how well the caches are working and the size of
+        the indexes and releases held in memory. With --flush, drop
+        everything that is cached from the database, e.g. after it has been
+        updated.
+        """
+        stats = uddcache.database.query_stats
+        by = 'fingerprints'
+        key = 'total'
+        for (option, arg) in optlist:
+            if option == 'origin':
+                by = 'origins'
+            elif option == 'replica':
+                by = 'replicas'
+            elif option == 'cache':
+                return self.cachestats(irc)
+            elif option == 'flush':
+                self.udd.flush()
+                return irc.replySuccess()
+            elif option == 'sort':
+                key = arg
+            elif option == 'reset':
+                stats.reset()
+                return irc.replySuccess()
+        if not key in ('total', 'calls', 'errors', 'mean', 'p50', 'p95',
+                       'p99', 'max'):
+            return irc.error("Unknown sort order '%s'." % key)
+
+        top = stats.top(number or 5, key, by)
+        if not top:
+            return irc.reply("No database queries have been recorded yet.")
+        reply = ["%s: %d calls, %d ms total, p50/p95/p99 %d/%d/%d ms%s" %
+                    (self.bold(name), s['calls'], s['total'],
+                        s['p50'], s['p95'], s['p99'],
+                        s['errors'] and ", %d errors" % s['errors'] or "")
+                    for name, s in top]
+        if by == 'replicas':
+            health = self.udd.pool_stats().get('replicas', {})
+            reply = [r + (name in health and not health[name]['healthy']
+                            and " (down)" or "")
+                     for r, (name, s) in zip(reply, top)]
+        irc.reply("; ".join(reply))
+
+    def cachestats(self, irc):
+        """ reply with the counters of the caches and in-memory indexes """
+        s = self.udd.cache_stats()
+        if not s:
+            irc.reply("The cache of query results is disabled.")
+        else:
+            irc.reply("%d hits, %d misses (%d%%); %d entries using %d of "
+                      "%d kB; %d evicted, %d expired, %d invalidated by "
+                      "imports" %
+                        (s['hits'], s['misses'], s['hit_rate'] * 100,
+                         s['entries'], s['bytes'] / 1024, s['size'] / 1024,
+                         s['evictions'], s['expirations'],
+                         s['invalidations']))
+        s = self.udd.release_stats()
+        irc.reply("Packages of %d releases: %d hits, %d misses (%d%%); "
+                  "%d of %d packages using %d kB; %d evicted, %d flushes" %
+                    (s['releases'], s['hits'], s['misses'],
+                     s['hit_rate'] * 100, s['entries'], s['max_entries'],
+                     s['bytes'] / 1024, s['evictions'], s['flushes']))
+        for s in self.udd.provides_stats():
+            irc.reply("Provides index for %s/%s: %d virtual packages, "
+                      "%d providers; %d kB, built in %d ms, %d s ago" %
+                        ("+".join(s['release']), s['arch'], s['virtuals'],
+                         s['providers'], s['bytes'] / 1024, s['build_ms'],
+                         s['age']))
+        for s in self.udd.slice_stats():
+            irc.reply("Slice %s/%s in memory: %d packages (%d versions), "
+                      "%d virtual; %d kB, loaded in %d ms, %d s ago" %
+                        ("+".join(s['release']), s['arch'], s['packages'],
+                         s['rows'], s['virtuals'], s['bytes'] / 1024,
+                         s['load_ms'], s['age']))
+        for s in self.udd.sourcemap_stats():
+            irc.reply("Source map for %s: %d binary packages of %d sources; "
+                      "%d kB, built in %d ms, %d s ago" %
+                        ("+".join(s['release']), s['binaries'], s['sources'],
+                         s['bytes'] / 1024, s['build_ms'], s['age']))
+        for s in self.udd.name_stats():
+            irc.reply("Names of %s: %d binary and %d source packages, "
+                      "%d lookups rejected; %d kB, built in %d ms, %d s ago" %
+                        ("+".join(s['release']), s['binaries'], s['sources'],
+                         s['rejected'], s['bytes'] / 1024, s['build_ms'],
+                         s['age']))
+
+    dbstats = wrap(dbstats, ['owner',
+                             getopts({'origin':'',
+                                      'replica':'',
+                                      'cache':'',
+                                      'flush':'',
+                                      'sort':'something',
+                                      'reset':''}),
+                             optional('positiveInt')])
+
     def src(self, irc, msg, args, package, optlist, something):
         """<packagename> [--release <stable>]
 
@@ -351,10 +503,11 @@ class Judd(callbacks.Plugin):
         rel = self.udd.BindRelease(release, arch)
         try:
             pack = rel.bin2src(package)
-        except PackageNotFoundError:
+        except PackageNotFoundError, e:
             return self.notfound(irc, package, release, arch,
                             message="Sorry, there is no record of a "
-                            "source package for the binary package '%s'%s.")
+                            "source package for the binary package '%s'%s.",
+                            error=e)
 
         irc.reply("Package %s in %s -- source: %s" % (package, release, pack))
 
@@ -377,8 +530,8 @@ class Judd(callbacks.Plugin):
 
         try:
             pack = self.udd.BindSourcePackage(package, release)
-        except PackageNotFoundError:
-            return self.notfound(irc, package, release, None)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, release, None, error=e)
 
         irc.reply("Source %s in %s: Binaries: %s" % \
                       (package, release, ", ".join(pack.Binaries())))
@@ -403,8 +556,8 @@ class Judd(callbacks.Plugin):
         # FIXME: make b-d list arch-specific
         try:
             pack = self.udd.BindSourcePackage(package, release)
-        except PackageNotFoundError:
-            return self.notfound(irc, package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, release, arch, error=e)
 
         bd = pack.BuildDepends()
         bdi = pack.BuildDependsIndep()
@@ -513,12 +666,13 @@ class Judd(callbacks.Plugin):
                                any('something')])
 
     def checkdeps(self, irc, msg, args, package, optlist, something):
-        """<packagename> [--arch <i386>] [--release <stable>] [--type depends|recommends|suggests]
+        """<packagename> [--arch <i386>|any] [--release <stable>] [--type depends|recommends|suggests]
 
         Check that the dependencies listed by a package are satisfiable for the
         specified release and architecture.
         By default, all dependency types with the current stable release and
-        i386 are used.
+        i386 are used. With --arch any (or all), every architecture is checked
+        and those in which the dependencies are unsatisfiable are listed.
         """
         channel = msg.args[0]
         release = self.udd.data.clean_release_name(optlist=optlist,
@@ -538,10 +692,13 @@ class Judd(callbacks.Plugin):
         if not relation:
             relation = self.udd.data.relations
 
+        if dict(optlist).get('arch') in ('any', 'all'):
+            return self._checkdeps_arches(irc, package, release, relation)
+
         try:
             status = self.dispatcher.checkdeps(package, release, arch, relation)
-        except PackageNotFoundError:
-            return self.notfound(irc, package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, release, arch, error=e)
 
         badlist = []
         for rel in relation:
@@ -555,6 +712,31 @@ class Judd(callbacks.Plugin):
             irc.reply("Package %s in %s/%s: all dependencies satisfied." %
                         (package, release, arch))
 
+    def _checkdeps_arches(self, irc, package, release, relation):
+        """ reply with the architectures with unsatisfiable dependencies """
+        try:
+            statuses = self.dispatcher.checkdeps_arches(package, release,
+                                                        None, relation)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, release, None, error=e)
+
+        badlist = []
+        for arch in sorted(statuses.keys()):
+            status = statuses[arch]
+            bad = ["%s: %s" % (rel.title(), str(status[rel].bad))
+                        for rel in relation if status[rel].bad]
+            if bad:
+                badlist.append("%s: %s" % (self.bold(arch), "; ".join(bad)))
+
+        if badlist:
+            irc.reply("Package %s in %s unsatisfiable dependencies on %d of "
+                      "%d architectures: %s." %
+                        (package, release, len(badlist), len(statuses),
+                         " | ".join(badlist)))
+        else:
+            irc.reply("Package %s in %s: all dependencies satisfied on %d "
+                      "architectures." % (package, release, len(statuses)))
+
     checkdeps = wrap(checkdeps, ['something',
                                   getopts({'arch':'something',
                                            'release':'something',
@@ -583,8 +765,8 @@ class Judd(callbacks.Plugin):
         try:
             solverh = self.dispatcher.checkInstall(package, release, arch,
                                               withrecommends)
-        except PackageNotFoundError:
-            return self.notfound(irc, package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, release, arch, error=e)
 
         solverh = solverh.flatten()
         details = []
@@ -631,8 +813,8 @@ class Judd(callbacks.Plugin):
         try:
             chains = self.dispatcher.why(package1, package2, release, arch,
                                               withrecommends)
-        except PackageNotFoundError:
-            return self.notfound(irc, package1, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package1, release, arch, error=e)
 
         details = ""
         if chains:
@@ -738,8 +920,8 @@ class Judd(callbacks.Plugin):
 
         try:
             status = self.dispatcher.checkBackport(package, fr, tr)
-        except PackageNotFoundError:
-            return self.notfound(irc, package, fromrelease, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(irc, package, fromrelease, arch, error=e)
 
         irc.reply((u"Backporting package %s in %s→%s/%s: %s" % \
                     (package, fromrelease, torelease, arch,
@@ -0,0 +1,312 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Batches of independent queries sent to the server in few round trips
+
+Each query run with database.query() pays a full round trip to the server.
+A Batch instead queues queries, handing back a Future for the result of
+each, and sends them together when it is executed, combined into as few
+statements as possible:
+
+    scalar queries (those returning a single value) are all combined into
+    one statement as scalar subqueries:
+        SELECT (q1) AS _b0, (q2) AS _b1, ...
+
+    row queries with the same shape (by default the same SQL text, or the
+    same 'shape' given when the queries are known to return the same
+    columns) are combined with UNION ALL, each row being tagged with the
+    position of its query:
+        SELECT 0 AS _batch, row_number() OVER () AS _row, _b0.*
+            FROM (q1) AS _b0
+        UNION ALL
+        SELECT 1, row_number() OVER (), _b1.* FROM (q2) AS _b1
+        ORDER BY _batch, _row
+    except for queries with an ORDER BY, which are run alone since the
+    server need not keep the order of a subquery in the row numbers
+
+so that a batch costs one round trip for its scalars and one for each
+shape of row query. (psycopg2 has no pipeline mode and only returns the
+result of the last statement of a multi-statement query, so the queries
+are combined into single statements instead.)
+
+Typical usage:
+    with udd.batch() as b:
+        total = b.scalar("SELECT count(*) FROM bugs")
+        rc = b.scalar("SELECT count(*) FROM bugs WHERE severity >= 'serious'")
+    print total.result(), rc.result()
+
+Within a plan (see engine.py), the batch is run as a sub-plan:
+    b = Batch()
+    total = b.scalar("SELECT count(*) FROM bugs")
+    yield b.plan()
+    raise Return(total.result())
+"""
+
+import re
+import sys
+import collections
+import psycopg2.extras
+from engine import Query, Future, run
+from rows import RowCursor, row_class
+
+
+class BatchFuture(Future):
+    """The result of one query in a Batch
+
+    Asking for the result executes the batch if it has not been executed
+    yet and it knows the database connection to use.
+    """
+
+    def __init__(self, batch):
+        Future.__init__(self)
+        self._batch = batch
+
+    def _wait(self, timeout):
+        if not self.done():
+            if self._batch.dbconn is None:
+                raise RuntimeError("The batch has not been executed")
+            self._batch.execute()
+        Future._wait(self, timeout)
+
+
+class _Member(object):
+    """A query queued in a batch"""
+
+    def __init__(self, sql, params, cursor_factory, one, scalar, future):
+        self.sql = sql.strip().rstrip(';')
+        self.params = params
+        self.cursor_factory = cursor_factory
+        self.one = one
+        self.scalar = scalar
+        self.future = future
+
+
+class _Columns(object):
+    """Column names of a combined result, standing in for a cursor"""
+
+    def __init__(self, names):
+        self.description = names
+        self.index = collections.OrderedDict([(n, i) for i, n in
+                                        enumerate(names) if n is not None])
+
+
+class Batch(object):
+    """Queries queued to be sent to the server together (see module docs)
+
+    The counters 'queries' and 'round_trips' record how many queries were
+    run and in how many statements.
+    """
+
+    _placeholder = re.compile(r"%\((\w+)\)s|%s|%%")
+    _ordered = re.compile(r"\bORDER\s+BY\b", re.I)
+
+    def __init__(self, dbconn=None):
+        """Create an empty batch
+
+            dbconn: pool or connection on which execute() runs the batch,
+                    if it is not run as a sub-plan
+        """
+        self.dbconn = dbconn
+        self.queries = 0
+        self.round_trips = 0
+        self._members = []
+
+    def query(self, sql, params=None, cursor_factory=None, one=False,
+              shape=None):
+        """Queue a query, returning a Future for its rows
+
+        sql, params, cursor_factory, one: as per database.query()
+        shape: queries that are given the same shape must return the same
+                columns so that they can be combined; by default only
+                queries with the same SQL text are combined, and queries
+                with an ORDER BY are never combined
+        """
+        future = BatchFuture(self)
+        member = _Member(sql, params, cursor_factory, one, False, future)
+        member.shape = shape or member.sql
+        self._members.append(member)
+        return future
+
+    def scalar(self, sql, params=None):
+        """Queue a query for a single value, returning a Future for it
+
+        The query must return at most one row of one column; the value is
+        None if it returns no rows.
+        """
+        future = BatchFuture(self)
+        self._members.append(_Member(sql, params, None, True, True, future))
+        return future
+
+    def __len__(self):
+        return len(self._members)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def execute(self, dbconn=None):
+        """Run the queued queries now, setting the results of the futures"""
+        return run(self.plan(), dbconn or self.dbconn)
+
+    def plan(self):
+        """Return a plan that runs the queued queries (see engine.py)"""
+        members = self._members
+        self._members = []
+        scalars = [m for m in members if m.scalar]
+        shapes = []
+        groups = {}
+        for m in members:
+            if not m.scalar:
+                shape = m.shape
+                if self._ordered.search(m.sql):
+                    # the order of the rows is only kept when run alone
+                    shape = (shape, id(m))
+                if not shape in groups:
+                    shapes.append(shape)
+                    groups[shape] = []
+                groups[shape].append(m)
+        if scalars:
+            yield self._run_scalars(scalars)
+        for shape in shapes:
+            yield self._run_rows(groups[shape])
+
+    def _run_scalars(self, members):
+        if len(members) == 1:
+            m = members[0]
+            step = Query(m.sql, m.params, one=True)
+        else:
+            params = {}
+            columns = []
+            for i, m in enumerate(members):
+                sql = self._rename(m, i, params)
+                columns.append("(%s) AS _b%d" % (sql, i))
+            step = Query("SELECT " + ", ".join(columns), params, one=True)
+        try:
+            row = yield self._send(step, len(members))
+        except Exception:
+            self._fail(members)
+            return
+        for i, m in enumerate(members):
+            m.future.set_result(row and row[i])
+
+    def _run_rows(self, members):
+        if len(members) == 1:
+            m = members[0]
+            try:
+                rows = yield self._send(Query(m.sql, m.params,
+                                              m.cursor_factory, m.one), 1)
+            except Exception:
+                self._fail(members)
+                return
+            m.future.set_result(rows)
+            return
+        params = {}
+        selects = []
+        for i, m in enumerate(members):
+            sql = self._rename(m, i, params)
+            selects.append("SELECT %d AS _batch, "
+                           "row_number() OVER () AS _row, _b%d.* "
+                           "FROM (%s) AS _b%d" % (i, i, sql, i))
+        step = Query(" UNION ALL ".join(selects) +
+                        " ORDER BY _batch, _row", params,
+                     cursor_factory=psycopg2.extras.DictCursor)
+        try:
+            rows = yield self._send(step, len(members))
+        except Exception:
+            self._fail(members)
+            return
+        results = [[] for m in members]
+        columns = None
+        for row in rows:
+            if columns is None:
+                names = [None] * len(row)
+                for name, i in row._index.items():
+                    names[i] = name
+                columns = _Columns(names[2:])
+            results[row[0]].append(row[2:])
+        for m, values in zip(members, results):
+            values = [self._row(m, columns, v) for v in values]
+            if m.one:
+                values = values and values[0] or None
+            m.future.set_result(values)
+
+    def _send(self, step, queries):
+        self.queries += queries
+        self.round_trips += 1
+        return step
+
+    def _fail(self, members):
+        error = sys.exc_info()
+        for m in members:
+            m.future.set_exception(error)
+
+    def _rename(self, member, i, params):
+        """Return the member's SQL with its parameters renamed for batch
+
+        The renamed parameters are added to params.
+        """
+        if member.params is None:
+            return member.sql.replace('%', '%%')
+        prefix = "_b%d_" % i
+        positions = []
+
+        def rename(m):
+            if m.group(0) == '%%':
+                return '%%'
+            if m.group(1) is not None:
+                name = prefix + m.group(1)
+                params[name] = member.params[m.group(1)]
+            else:
+                name = "%s%d" % (prefix, len(positions))
+                params[name] = member.params[len(positions)]
+                positions.append(name)
+            return "%%(%s)s" % name
+
+        return self._placeholder.sub(rename, member.sql)
+
+    def _row(self, member, columns, values):
+        """Make a row of the kind that the member's cursor would return"""
+        factory = member.cursor_factory
+        if factory is not None and \
+                issubclass(factory, psycopg2.extras.RealDictCursor):
+            return dict([(n, v) for n, v in zip(columns.description, values)
+                         if n is not None])
+        if factory is not None and \
+                issubclass(factory, psycopg2.extras.DictCursor):
+            row = psycopg2.extras.DictRow(columns)
+            row[:] = values
+            return row
+        if factory is not None and issubclass(factory, RowCursor):
+            return row_class(columns.description)(values)
+        return tuple(values)
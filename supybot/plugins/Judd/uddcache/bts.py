@@ -36,7 +36,9 @@
 
 import re
 import psycopg2
-import psycopg2.extras
+import batch
+from engine import Query, Return, run
+from rows import RowCursor
 
 severities = ('wishlist', 'minor', 'normal', 'important',
                     'serious', 'grave', 'critical')
@@ -60,9 +62,18 @@ class Bts(object):
         self.dbconn = dbconn
         self.include_archived = include_archived
 
-    def bugs(self, bugnumbers):
-        """ look up one """
-        c = self.dbconn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    def bugs(self, bugnumbers, tags=False):
+        """ look up bugs by number
+
+        tags: also look up the tags of the bugs (see get_bugs_tags)
+
+        The bugs, archived bugs and their tags are looked up together in as
+        few round trips to the database as possible (see batch.py).
+        """
+        return run(self.bugs_plan(bugnumbers, tags), self.dbconn)
+
+    def bugs_plan(self, bugnumbers, tags=False):
+        """ plan (see engine.py) that looks up bugs by number as bugs() """
         cleanbugs = []
         for b in bugnumbers:
             if type(b) is int:
@@ -70,30 +81,54 @@ class Bts(object):
             if type(b) is str:
                 b = b.replace('#', '')
                 cleanbugs.append(int(b))
-        cleanbugs = tuple(cleanbugs)
-        q = self._query_builder("id IN %(bugs)s")
-        c.execute(r"""SELECT *, FALSE AS archived
-                        FROM bugs
-                        WHERE id IN %(bugs)s""",
-                    {'bugs': cleanbugs})
-        found_bugs = [Bugreport(r) for r in c.fetchall()]
+        params = {'bugs': tuple(cleanbugs)}
+        b = batch.Batch()
+        found = [b.query(r"""SELECT %s, FALSE AS archived
+                             FROM bugs
+                             WHERE id IN %%(bugs)s""" % self.columns,
+                         params, cursor_factory=RowCursor,
+                         shape='bugs')]
+        tagged = []
+        if tags:
+            tagged.append(b.query(r"""SELECT id, tag
+                                      FROM bugs_tags
+                                      WHERE id IN %(bugs)s""",
+                                  params, shape='tags'))
         if self.include_archived:
-            found_bugnums= [b.id for b in found_bugs]
-            missing_bugnums = tuple([n for n in cleanbugs if n not in found_bugnums])
-            if missing_bugnums:
-                c.execute(r"""SELECT *, TRUE AS archived
-                                FROM archived_bugs
-                                WHERE id IN %(bugs)s""",
-                            {'bugs': missing_bugnums})
-                found_bugs.extend([Bugreport(r) for r in c.fetchall()])
-        return found_bugs
+            # only the bugs that are not found unarchived are wanted
+            missing = r"""id IN %(bugs)s
+                          AND id NOT IN (SELECT id FROM bugs
+                                         WHERE id IN %(bugs)s)"""
+            found.append(b.query(r"""SELECT %s, TRUE AS archived
+                                     FROM archived_bugs AS bugs
+                                     WHERE %s""" % (self.columns, missing),
+                                 params,
+                                 cursor_factory=RowCursor,
+                                 shape='bugs'))
+            if tags:
+                tagged.append(b.query(r"""SELECT id, tag
+                                          FROM archived_bugs_tags
+                                          WHERE """ + missing,
+                                      params, shape='tags'))
+        yield b.plan()
+        found_bugs = [Bugreport(r) for f in found for r in f.result()]
+        if tags:
+            bugs = dict([(bug.id, bug) for bug in found_bugs])
+            for f in tagged:
+                [bugs[id].tags.append(t) for (id, t) in f.result()
+                    if id in bugs]
+        raise Return(found_bugs)
+
+    def bug(self, bugnumber, tags=False):
+        return run(self.bug_plan(bugnumber, tags), self.dbconn)
 
-    def bug(self, bugnumber):
-        b = self.bugs([bugnumber])
+    def bug_plan(self, bugnumber, tags=False):
+        """ plan (see engine.py) that looks up one bug as bug() """
+        b = yield self.bugs_plan([bugnumber], tags)
         if not b:
             raise BugNotFoundError(bugnumber)
         else:
-            return b[0]
+            raise Return(b[0])
 
     def get_bugs(self, search):
         """
@@ -104,7 +139,10 @@ class Bts(object):
                                             'done', 'forwarded', or 'fixed')
         "title": regular expression match on title
         """
-        c = self.dbconn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        return run(self.get_bugs_plan(search), self.dbconn)
+
+    def get_bugs_plan(self, search):
+        """ plan (see engine.py) that searches for bugs as get_bugs() """
         wheres = {
                  'package': 'bugs_packages.package = %(package)s',
                  'source': 'bugs_packages.source = %(source)s',
@@ -118,12 +156,15 @@ class Bts(object):
             q += " ORDER BY %s" % search['sort']
         if 'limit' in search:
             q += " LIMIT %d" % search['limit']
-        c.execute(q, search)
-        return [Bugreport(r) for r in c.fetchall()]
+        rows = yield Query(q, search, cursor_factory=RowCursor)
+        raise Return([Bugreport(r) for r in rows])
 
     def get_bugs_tags(self, bugs):
         """Look up the tags for a list of bug objects"""
-        c = self.dbconn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        run(self.get_bugs_tags_plan(bugs), self.dbconn)
+
+    def get_bugs_tags_plan(self, bugs):
+        """ plan (see engine.py) that looks up tags as get_bugs_tags() """
         archived_bugs = {}
         unarchived_bugs = {}
         try:
@@ -133,25 +174,29 @@ class Bts(object):
                else:
                    unarchived_bugs[b.id] = b
         except TypeError:
-            return self.get_bugs_tags([bugs])
+            yield self.get_bugs_tags_plan([bugs])
+            return
+        b = batch.Batch()
+        tagged = []
         if unarchived_bugs:
-            c.execute(r"""SELECT id, tag
+            tagged.append((unarchived_bugs, b.query(r"""SELECT id, tag
                             FROM bugs_tags
                             WHERE id IN %(bugs)s""",
-                        {'bugs': tuple(unarchived_bugs)})
-            [unarchived_bugs[id].tags.append(t) for (id, t) in c.fetchall()]
+                        {'bugs': tuple(unarchived_bugs)}, shape='tags')))
         if archived_bugs:
-            c.execute(r"""SELECT id, tag
+            tagged.append((archived_bugs, b.query(r"""SELECT id, tag
                             FROM archived_bugs_tags
                             WHERE id IN %(bugs)s""",
-                        {'bugs': tuple(archived_bugs)})
-            [archived_bugs[id].tags.append(t) for (id, t) in c.fetchall()]
+                        {'bugs': tuple(archived_bugs)}, shape='tags')))
+        yield b.plan()
+        for bugs, f in tagged:
+            [bugs[id].tags.append(t) for (id, t) in f.result()]
 
-    def _query_builder(self, where):
-        columns = r"""
-                        %(archived)sbugs.id,
-                        %(archived)sbugs.package AS package,
-                        %(archived)sbugs.source AS source,
+    # the columns of the bugs and archived_bugs tables used by Bugreport
+    columns = r"""
+                        bugs.id,
+                        bugs.package AS package,
+                        bugs.source AS source,
                         arrival, status, severity,
                         submitter, submitter_name, submitter_email,
                         owner, owner_name, owner_email,
@@ -160,6 +205,8 @@ class Bts(object):
                         affects_oldstable, affects_stable, affects_testing,
                         affects_unstable, affects_experimental
                 """
+
+    def _query_builder(self, where):
         if self.include_archived:
             q = \
                 r"""
@@ -188,12 +235,23 @@ class Bts(object):
                 """
         return q % ({
                         'where': where,
-                        'columns': columns % {'archived':''},
-                        'columns_archived': columns % {'archived':''}
+                        'columns': self.columns,
+                        'columns_archived': self.columns
                      })
 
 
 class Bugreport(object):
+    # the fields are held in slots rather than in a dict for each bug, as
+    # the bugs of a popular package number in the thousands
+    __slots__ = ('id', 'package', 'source', 'arrival', 'status', 'severity',
+                 'submitter', 'submitter_name', 'submitter_email',
+                 'owner', 'owner_name', 'owner_email',
+                 'done', 'done_name', 'done_email', 'done_date', 'title',
+                 'last_modified', 'forwarded',
+                 'affects_oldstable', 'affects_stable', 'affects_testing',
+                 'affects_unstable', 'affects_experimental',
+                 'archived', 'tags')
+
     def __init__(self, data=None, archived=False):
         self.id = None
         self.package = None
@@ -225,7 +283,8 @@ class Bugreport(object):
             self.load(data)
 
     def load(self, data):
-        [self.__setattr__(field, data[field]) for field in data.keys()]
+        for field, value in data.items():
+            setattr(self, field, value)
 
     @property
     def readable_status(self):
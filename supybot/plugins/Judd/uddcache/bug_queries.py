@@ -35,6 +35,9 @@
 ###
 
 from udd import Udd
+import database
+from engine import Call, Return, synchronous, asynchronous
+from batch import Batch
 import bts
 from packages import PackageNotFoundError
 from bts import BugNotFoundError
@@ -45,7 +48,14 @@ except:
     from debian_bundle import debian_support
 
 
-class Commands(object):
+class Queries(object):
+    """
+    The bug queries, written as plans (see engine.py)
+
+    Use Commands to run them synchronously or AsyncCommands to run them on
+    the event loop of an AsyncUdd. The bugs are looked up with the plans of
+    the Bts (see bts.py), whose queries are Query steps.
+    """
 
     def __init__(self, udd):
         self.udd = udd
@@ -55,15 +65,17 @@ class Commands(object):
         Retrieve information about a particular bug
         """
         tracker = self.udd.Bts()
-        b = tracker.bug(bugnumber)
-        if verbose:
-            tracker.get_bugs_tags([b])
-        return b
+        b = yield tracker.bug_plan(bugnumber, verbose)
+        raise Return(b)
 
     def bug_package(self, package, verbose=True, archived=False, source=None, filter=None):
         """
         Retrieve information about bugs in a package
         """
+        bugs = yield self._bug_package(package, verbose, archived, source, filter)
+        raise Return(bugs)
+
+    def _bug_package(self, package, verbose, archived, source, filter):
         if filter:
             fil = filter.copy()
         else:
@@ -78,35 +90,38 @@ class Commands(object):
             if source not in (True, False):
                 source = False
         if source:
+            yield self.udd.check_imports_plan()
+            r = self.udd.releases.get(self.udd.data.devel_release)
             try:
-                p = self.udd.BindSourcePackage(packagename,
-                                               self.udd.data.devel_release)
+                p = yield Call(r.ResolveSource, packagename)
                 fil['source'] = p.package
             except PackageNotFoundError:
                 fil['source'] = package
         else:
             fil['package'] = package
         tracker = self.udd.Bts(archived)
-        bugs = tracker.get_bugs(fil)
+        bugs = yield tracker.get_bugs_plan(fil)
         if verbose:
-            tracker.get_bugs_tags(bugs)
-        return bugs
+            yield tracker.get_bugs_tags_plan(bugs)
+        raise Return(bugs)
 
     def bug_package_search(self, package, search, verbose=True, archived=False, source=None):
         """
         Retrieve information about bugs in a package
         """
-        return self.bug_package(package, verbose, archived, source, {'title':search})
+        bugs = yield self._bug_package(package, verbose, archived, source, {'title':search})
+        raise Return(bugs)
 
     def rm(self, package, archived=True):
         """
         Retrieve information about a package removal bug
         """
         tracker = self.udd.Bts(archived)
-        return tracker.get_bugs({'package': 'ftp.debian.org',
+        bugs = yield tracker.get_bugs_plan({'package': 'ftp.debian.org',
                                 'title': 'RM: %s ' % package,
                                 'sort': 'id DESC',
                                 'limit': 1})
+        raise Return(bugs)
 
     def wnpp(self, package, bugtype=None):
         """
@@ -122,27 +137,29 @@ class Commands(object):
             filter['title'] = r'''^["']?%s\s*(:|--|)\s*%s ''' % (bugtype, package)
         else:
             filter['title'] = r'''^["']?(%s)\s*(:|--|)\s*%s ''' % ('|'.join(bts.wnpp_types), package)
-        return tracker.get_bugs(filter)
+        bugs = yield tracker.get_bugs_plan(filter)
+        raise Return(bugs)
 
     def rcbugs(self, package, verbose=True):
         """
         Retrieve all open release critical bugs for a package
         """
+        yield self.udd.check_imports_plan()
+        r = self.udd.releases.get(self.udd.data.devel_release)
         try:
-            p = self.udd.BindSourcePackage(package,
-                                           self.udd.data.devel_release)
+            p = yield Call(r.ResolveSource, package)
             source = p.package
         except PackageNotFoundError:
             source = package
         tracker = self.udd.Bts(False) # only consider unarchived bugs
-        bugs = tracker.get_bugs({
+        bugs = yield tracker.get_bugs_plan({
                         'source': source,
                         'severity': ('critical', 'grave', 'serious'),
                         'status': ('forwarded', 'pending', 'pending-fixed')
                     })
         if verbose:
-            tracker.get_bugs_tags(bugs)
-        return bugs
+            yield tracker.get_bugs_tags_plan(bugs)
+        raise Return(bugs)
 
     def stats(self):
         """
@@ -203,9 +220,35 @@ class Commands(object):
                                     WHERE id > merged_with))
                     AND (severity >= 'serious')"""
             }
-        stats = {}
-        c = self.udd.psql.cursor()
-        for query in queries.keys():
-            c.execute(queries[query])
-            stats[query] = c.fetchone()[0]
-        return stats
\ No newline at end of file
+        # all of the counts are made in one round trip
+        b = Batch()
+        counts = dict([(name, b.scalar(sql)) for name, sql in queries.items()])
+        yield b.plan()
+        stats = dict([(name, f.result()) for name, f in counts.items()])
+        raise Return(stats)
+
+
+@database.query_origins
+@synchronous
+class Commands(Queries):
+    """
+    The bug queries, each returning its result
+
+    Typical usage:
+        dispatcher = Commands(Udd())
+        print dispatcher.rcbugs('eglibc')
+    """
+    pass
+
+
+@asynchronous
+class AsyncCommands(Queries):
+    """
+    The bug queries, each returning an engine.Future for its result
+
+    Typical usage:
+        dispatcher = AsyncCommands(AsyncUdd())
+        future = dispatcher.rcbugs('eglibc')
+        future.add_done_callback(lambda f: reply(f.result()))
+    """
+    pass
\ No newline at end of file
@@ -0,0 +1,535 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Cache of query results for UDD, invalidated as the importers run
+
+UDD only changes when one of its importers runs, so the results of the hot
+queries can be reused until then. Each result is cached under the query's
+normalised SQL and parameters along with the tables that the query reads.
+An entry is dropped:
+
+    - when the importer that refreshes one of its tables records a new
+      run in UDD's timestamps table (see ImportWatcher)
+    - when its time to live runs out; the TTL can be set for each table
+      and is the shortest TTL of the tables that the query reads
+    - when the cache is full, least recently used first; the size of the
+      cache is bounded by the (approximate) number of bytes of the results
+
+Queries opt in to the cache with database.query(..., cache=True), which
+uses the QueryCache attached to the pool as its 'cache' attribute.
+
+Typical usage:
+    pool.cache = QueryCache(pool, size=16 * 1024 * 1024,
+                            table_ttls=[('bugs*', 600)])
+    rows = database.query(pool, "SELECT ...", params, cache=True)
+    print pool.cache.stats()['hit_rate']
+
+ObjectCache is a plainer LRU cache of objects, bounded by their number and
+size, that keeps the Package objects of the releases between commands.
+"""
+
+import re
+import sys
+import time
+import fnmatch
+import threading
+import collections
+import psycopg2
+import database
+from engine import Query
+
+
+# Tables that are refreshed by each UDD importer: the importers are named
+# in the 'source' column of the timestamps table. The runs of importers not
+# listed here drop the whole cache.
+IMPORTERS = [
+        (r'^(debian|ubuntu|derivatives)', ['packages', 'sources',
+                        'packages_summary', 'all_packages', 'all_sources',
+                        'uploaders', 'packages_distrelease',
+                        'sources_uniq']),
+        (r'^popcon', ['popcon*']),
+        (r'^bugs', ['bugs*', 'archived_bugs*']),
+        (r'^upload[-_]history', ['upload_history*']),
+        (r'^screenshots', ['screenshots']),
+        (r'^orphaned', ['orphaned_packages']),
+    ]
+
+
+class ImportWatcher(object):
+    """Polls UDD's timestamps table for new runs of the importers
+
+    The table is polled at most once every 'interval' seconds, when
+    changed(), check() or the plan() step is called. check() calls the functions in the
+    listeners list with the tables refreshed by each importer that has run
+    (or None for all tables), so that the QueryCache and the other caches
+    of UDD's data can drop what has become stale.
+    """
+
+    sql = r"""SELECT source, max(greatest(start_time, end_time))
+              FROM timestamps
+              GROUP BY source"""
+
+    def __init__(self, dbconn, interval=60, importers=None):
+        """
+            dbconn: pool on which to poll the timestamps table
+            interval: number of seconds between polls
+            importers: list of (importer regex, list of tables) giving the
+                    tables refreshed by each importer (default IMPORTERS)
+        """
+        self.dbconn = dbconn
+        self.interval = interval
+        self.importers = [(re.compile(p), tables) for p, tables in
+                                (importers or IMPORTERS)]
+        self.listeners = []
+        self.polls = 0
+        self.errors = 0
+        self._runs = None
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def changed(self):
+        """Return the names of the importers that have run since last time
+
+        Nothing is returned the first time that the table is polled, or if
+        polling fails.
+        """
+        if not self._due():
+            return []
+        try:
+            rows = database.query(self.dbconn, self.sql)
+        except psycopg2.Error:
+            rows = None
+        return self._update(rows)
+
+    def check(self):
+        """Tell the listeners about the importers that have run"""
+        self._notify(self.changed())
+
+    def plan(self):
+        """Plan (see engine.py) that makes the same check as check()
+
+        The table is polled with a Query step, so that on the event loop
+        of an AsyncUdd the poll does not hold up the other plans.
+        """
+        if not self._due():
+            return
+        try:
+            rows = yield Query(self.sql)
+        except psycopg2.Error:
+            rows = None
+        self._notify(self._update(rows))
+
+    def _due(self):
+        """Test whether it is time to poll, claiming the poll if so"""
+        with self._lock:
+            now = time.time()
+            if now < self._next:
+                return False
+            self._next = now + self.interval
+            return True
+
+    def _update(self, rows):
+        """Record the runs polled from the table, returning those changed"""
+        if rows is None:
+            self.errors += 1
+            return []
+        runs = dict(rows)
+        with self._lock:
+            self.polls += 1
+            last = self._runs
+            self._runs = runs
+        if last is None:
+            return []
+        return [source for source, ts in runs.items()
+                if last.get(source) != ts]
+
+    def _notify(self, sources):
+        for source in sources:
+            tables = self.tables_for(source)
+            for listener in self.listeners:
+                listener(tables)
+
+    def tables_for(self, source):
+        """Return the tables refreshed by an importer or None if unknown"""
+        for pattern, tables in self.importers:
+            if pattern.search(source):
+                return tables
+        return None
+
+
+class _Entry(object):
+    """A cached result"""
+
+    __slots__ = ('value', 'size', 'tables', 'expires')
+
+    def __init__(self, value, size, tables, expires):
+        self.value = value
+        self.size = size
+        self.tables = tables
+        self.expires = expires
+
+
+class QueryCache(object):
+    """A size-bounded LRU cache of query results (see the module docs)"""
+
+    _tables = re.compile(r"\b(?:FROM|JOIN)\s+([a-z_][\w.]*)", re.I)
+
+    def __init__(self, dbconn=None, size=16 * 1024 * 1024, ttl=3600,
+                 table_ttls=None, check_interval=60, importers=None,
+                 watcher=None):
+        """Create an empty cache
+
+            dbconn: pool on which to poll the timestamps table or None not
+                    to watch for imports, unless a watcher is given
+            size: maximum number of bytes of results to hold
+            ttl: number of seconds for which results are kept
+            table_ttls: list of (table, seconds) overriding the ttl for the
+                    queries that read the tables; the table names may
+                    contain shell wildcards
+            check_interval: number of seconds between polls of the
+                    timestamps table
+            importers: list of (importer regex, list of tables) giving the
+                    tables refreshed by each importer (default IMPORTERS)
+            watcher: ImportWatcher shared with the other caches of UDD's
+                    data, used instead of polling on dbconn
+
+        Functions in the listeners list are called with the tables (or None
+        for all tables) whenever an import makes results stale, so that
+        other caches can be flushed too.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.table_ttls = table_ttls or []
+        if watcher is None and dbconn is not None:
+            watcher = ImportWatcher(dbconn, check_interval, importers)
+        self.watcher = watcher
+        if watcher is not None:
+            watcher.listeners.append(self._imported)
+        self.listeners = []
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {
+                            'hits': 0,
+                            'misses': 0,
+                            'stores': 0,
+                            'evictions': 0,
+                            'expirations': 0,
+                            'invalidations': 0,
+                            'oversize': 0,
+                        }
+
+    def fetch(self, sql, params, cursor_factory, one, compute):
+        """Return the cached result of a query or compute and cache it
+
+        compute: function that runs the query and returns its result
+        """
+        self.check_imports()
+        key = self.key(sql, params, cursor_factory, one)
+        if key is None:
+            return compute()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry.expires <= now:
+                self._bytes -= entry.size
+                self.counters['expirations'] += 1
+                entry = None
+            if entry is not None:
+                self._entries[key] = entry
+                self.counters['hits'] += 1
+                return self._copy(entry.value)
+            self.counters['misses'] += 1
+        value = compute()
+        self.store(key, sql, value)
+        return self._copy(value)
+
+    def store(self, key, sql, value):
+        """Cache the result of a query under the key"""
+        size = _sizeof(value)
+        if size > self.size:
+            with self._lock:
+                self.counters['oversize'] += 1
+            return
+        tables = frozenset([t.lower() for t in self._tables.findall(sql)])
+        entry = _Entry(value, size, tables, time.time() + self.ttl_for(tables))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += size
+            self.counters['stores'] += 1
+            while self._bytes > self.size:
+                k, e = self._entries.popitem(last=False)
+                self._bytes -= e.size
+                self.counters['evictions'] += 1
+
+    def key(self, sql, params, cursor_factory, one):
+        """Return the key for a query or None if it cannot be cached"""
+        key = (" ".join(sql.split()), _freeze(params), cursor_factory, one)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def ttl_for(self, tables):
+        """Return the time to live of the result of a query on the tables"""
+        ttls = [self.ttl]
+        for table in tables:
+            for pattern, ttl in self.table_ttls:
+                if fnmatch.fnmatchcase(table, pattern):
+                    ttls.append(ttl)
+                    break
+        return min(ttls)
+
+    def check_imports(self):
+        """Drop the results made stale by the importers that have run"""
+        if self.watcher is not None:
+            self.watcher.check()
+
+    def _imported(self, tables):
+        self.invalidate(tables)
+        for listener in self.listeners:
+            listener(tables)
+
+    def invalidate(self, tables=None):
+        """Drop the results of the queries that read any of the tables
+
+        tables: list of table names, which may contain shell wildcards, or
+                None to drop all results
+        """
+        def reads(entry):
+            for table in entry.tables:
+                for pattern in tables:
+                    if fnmatch.fnmatchcase(table, pattern):
+                        return True
+            return False
+
+        with self._lock:
+            for key, entry in self._entries.items():
+                if tables is None or reads(entry):
+                    del self._entries[key]
+                    self._bytes -= entry.size
+                    self.counters['invalidations'] += 1
+
+    def clear(self):
+        """Drop all cached results"""
+        self.invalidate(None)
+
+    def stats(self):
+        """Return a snapshot of the cache's usage counters"""
+        with self._lock:
+            s = dict(self.counters)
+            s['entries'] = len(self._entries)
+            s['bytes'] = self._bytes
+        s['size'] = self.size
+        lookups = s['hits'] + s['misses']
+        s['hit_rate'] = lookups and float(s['hits']) / lookups or 0.0
+        if self.watcher is not None:
+            s['import_polls'] = self.watcher.polls
+            s['import_poll_errors'] = self.watcher.errors
+        return s
+
+    def _copy(self, value):
+        # callers may modify the list of rows that they are given
+        if isinstance(value, list):
+            return list(value)
+        return value
+
+
+class ObjectCache(object):
+    """A least recently used cache of objects such as Package objects
+
+    The cache is bounded by the number of objects and optionally by their
+    (approximate) size in bytes. It is shared by several users, such as the
+    Release objects of a Udd, each of which sees the part of it under its
+    own namespace (see namespace()) as if it were a dict.
+    """
+
+    def __init__(self, entries=20000, size=0, sizeof=None):
+        """Create an empty cache
+
+            entries: maximum number of objects to hold
+            size: maximum number of bytes of objects to hold or 0 for no
+                    limit on their size
+            sizeof: function estimating the size of an object (default
+                    estimates the size of a query result)
+        """
+        self.entries = entries
+        self.size = size
+        self.sizeof = sizeof or _sizeof
+        self._entries = collections.OrderedDict()
+        self._counts = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {
+                            'hits': 0,
+                            'misses': 0,
+                            'stores': 0,
+                            'evictions': 0,
+                            'flushes': 0,
+                        }
+
+    def namespace(self, ns):
+        """Return a dict-like view of the objects cached under ns"""
+        return _Namespace(self, ns)
+
+    def get(self, ns, key, default=None):
+        """Return a cached object, marking it as recently used"""
+        with self._lock:
+            entry = self._entries.pop((ns, key), None)
+            if entry is None:
+                self.counters['misses'] += 1
+                return default
+            self._entries[(ns, key)] = entry
+            self.counters['hits'] += 1
+            return entry[0]
+
+    def contains(self, ns, key):
+        """Test if an object is cached without marking it as used"""
+        return (ns, key) in self._entries
+
+    def put(self, ns, key, value):
+        """Cache an object, evicting the least recently used as needed"""
+        size = self.size and self.sizeof(value) or 0
+        with self._lock:
+            self._remove((ns, key))
+            self._entries[(ns, key)] = (value, size)
+            self._counts[ns] = self._counts.get(ns, 0) + 1
+            self._bytes += size
+            self.counters['stores'] += 1
+            while len(self._entries) > self.entries or \
+                    (self.size and self._bytes > self.size):
+                k, e = self._entries.popitem(last=False)
+                self._forget(k[0], e)
+                self.counters['evictions'] += 1
+
+    def remove(self, ns, key):
+        """Drop an object from the cache"""
+        with self._lock:
+            self._remove((ns, key))
+
+    def count(self, ns):
+        """Return the number of objects cached under ns"""
+        return self._counts.get(ns, 0)
+
+    def flush(self, ns=None):
+        """Drop the objects under ns or all objects, e.g. after an import"""
+        with self._lock:
+            if ns is None:
+                self._entries.clear()
+                self._counts = {}
+                self._bytes = 0
+            else:
+                for k in [k for k in self._entries if k[0] == ns]:
+                    self._remove(k)
+            self.counters['flushes'] += 1
+
+    def stats(self):
+        """Return a snapshot of the cache's usage counters"""
+        with self._lock:
+            s = dict(self.counters)
+            s['entries'] = len(self._entries)
+            s['bytes'] = self._bytes
+            s['namespaces'] = len(self._counts)
+        s['max_entries'] = self.entries
+        s['size'] = self.size
+        lookups = s['hits'] + s['misses']
+        s['hit_rate'] = lookups and float(s['hits']) / lookups or 0.0
+        return s
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._forget(key[0], entry)
+
+    def _forget(self, ns, entry):
+        self._bytes -= entry[1]
+        self._counts[ns] -= 1
+        if not self._counts[ns]:
+            del self._counts[ns]
+
+
+class _Namespace(object):
+    """The objects cached under one namespace of an ObjectCache"""
+
+    def __init__(self, cache, ns):
+        self.cache = cache
+        self.ns = ns
+
+    def get(self, key, default=None):
+        return self.cache.get(self.ns, key, default)
+
+    def __getitem__(self, key):
+        value = self.cache.get(self.ns, key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.cache.put(self.ns, key, value)
+
+    def __delitem__(self, key):
+        self.cache.remove(self.ns, key)
+
+    def __contains__(self, key):
+        return self.cache.contains(self.ns, key)
+
+    def __len__(self):
+        return self.cache.count(self.ns)
+
+    def clear(self):
+        self.cache.flush(self.ns)
+
+
+_missing = object()
+
+
+def _freeze(value):
+    """Return a hashable version of query parameters"""
+    if isinstance(value, dict):
+        return tuple(sorted([(k, _freeze(v)) for k, v in value.items()]))
+    if isinstance(value, (list, tuple)):
+        # lists and tuples are passed to the server differently
+        return (type(value), tuple([_freeze(v) for v in value]))
+    return value
+
+
+def _sizeof(value):
+    """Estimate the number of bytes of memory used by a query result"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum([_sizeof(v) for v in value])
+    elif isinstance(value, dict):
+        size += sum([_sizeof(k) + _sizeof(v) for k, v in value.items()])
+    return size
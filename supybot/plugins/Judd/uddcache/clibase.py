@@ -49,7 +49,8 @@ class CliBase(object):
         self.command_map = {}
         self.command_aliases = {}
         if initialise:
-            self.udd = udd.Udd(config=config, distro=options.distro)
+            self.udd = udd.Udd(config=config, distro=options.distro,
+                               snapshot=getattr(options, 'snapshot', None))
             self.dispatcher = dispatcherClass(self.udd)
             self.options = options
 
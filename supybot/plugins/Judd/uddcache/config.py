@@ -45,6 +45,59 @@ Expected format is as follows:
     password: database_password
     database: udd
 
+Optional settings for the pool of database connections:
+    pool_size:    4
+    pool_timeout: 30
+    prepared_statements: yes
+    async_workers: 2
+
+Optional settings for routing queries between several replicas of the
+database (the replicas are listed as libpq connection strings or URIs,
+separated by ';' or on continuation lines; settings not given for a replica
+are taken from the settings above; the routing is round-robin or latency;
+replicas are checked every health_check_interval seconds):
+    replicas: host=mirror1 port=5432; host=mirror2 port=5433
+    routing:  round-robin
+    health_check_interval: 30
+
+Optional settings for the cache of query results (the size in bytes, 0 to
+disable the cache; the time to live in seconds, also set for the queries
+on particular tables in cache_table_ttls; the time in seconds between checks
+for new imports into UDD, which are made even if the cache is disabled so
+that the packages kept for the releases are refreshed):
+    cache_size: 16777216
+    cache_ttl:  3600
+    cache_table_ttls: bugs*=600, popcon=86400
+    cache_check_interval: 60
+
+Optional settings for the packages kept for the releases between lookups
+(the maximum number of packages and their maximum size in bytes, 0 for no
+limit on the size):
+    release_cache_entries: 20000
+    release_cache_size:    0
+
+Optional list of releases and architectures whose packages are held in
+memory so that they are looked up without queries (reloaded in the
+background when UDD imports new packages):
+    release_slices: stable/i386, sid/amd64
+
+Optional snapshot of the package tables to be queried instead of the
+database server (see snapshot.py and 'udd-cache snapshot'):
+    snapshot: udd.sqlite
+
+Optional settings for reconnecting after the connection to the database
+is lost (the number of times to retry a query and the initial wait in
+seconds, doubled for each retry):
+    reconnect_attempts: 3
+    reconnect_backoff:  0.5
+
+Optional settings for logging the SQL statements (all statements slower
+than log_slow_ms are logged along with a fraction log_sample_rate of the
+rest):
+    logfile:         udd-query.log
+    log_slow_ms:     100
+    log_sample_rate: 0.01
+
 If working with a Judd instance, this can be generated from
 the supybot config file as follows:
     (echo "[database]"; sed -nr 's/.*Judd\.db_(.*)$/\1/p' supybot.conf) \
@@ -57,6 +110,7 @@ the supybot config file as follows:
 
 import os
 import os.path
+import re
 import ConfigParser
 
 
@@ -116,12 +170,144 @@ class Config(object):
                 }
         return conf
 
+    def db_replicas(self):
+        """
+        Return the list of connection strings for the replicas, if any
+        """
+        value = self.get('database', 'replicas', '') or ''
+        return [dsn.strip() for dsn in re.split(r'[;\n]', value)
+                if dsn.strip()]
+
+    def db_routing(self):
+        """
+        Return the policy for routing queries between the replicas
+        """
+        return self.get('database', 'routing', None) or 'round-robin'
+
+    def db_health_check_interval(self):
+        """
+        Return the time in seconds between health checks of the replicas
+        """
+        return float(self.get('database', 'health_check_interval', 30))
+
+    def db_cache_size(self):
+        """
+        Return the maximum size in bytes of the cache of query results
+        """
+        return int(self.get('database', 'cache_size', 16 * 1024 * 1024))
+
+    def db_cache_ttl(self):
+        """
+        Return the time in seconds for which query results are cached
+        """
+        return float(self.get('database', 'cache_ttl', 3600))
+
+    def db_cache_table_ttls(self):
+        """
+        Return a list of (table, seconds) giving the cache TTL for tables
+        """
+        value = self.get('database', 'cache_table_ttls', '') or ''
+        ttls = []
+        for item in re.split(r'[,\s]+', value):
+            if item:
+                table, ttl = item.split('=', 1)
+                ttls.append((table, float(ttl)))
+        return ttls
+
+    def db_cache_check_interval(self):
+        """
+        Return the time in seconds between checks for new imports into UDD
+        """
+        return float(self.get('database', 'cache_check_interval', 60))
+
+    def db_release_cache_entries(self):
+        """
+        Return the maximum number of packages kept for the bound releases
+        """
+        return int(self.get('database', 'release_cache_entries', 20000))
+
+    def db_release_cache_size(self):
+        """
+        Return the maximum size in bytes of the packages kept for the bound
+        releases or 0 for no limit
+        """
+        return int(self.get('database', 'release_cache_size', 0))
+
+    def db_release_slices(self):
+        """
+        Return a list of (release, arch) to be held in memory
+        """
+        value = self.get('database', 'release_slices', '') or ''
+        slices = []
+        for item in re.split(r'[,\s]+', value):
+            if item:
+                release, arch = item.split('/', 1)
+                slices.append((release, arch))
+        return slices
+
+    def db_snapshot(self):
+        """
+        Return the filename of the snapshot to be queried, if any
+        """
+        return self.get('database', 'snapshot', None) or None
+
     def db_logging(self):
         """
         Return the filename if any that should be used for database logging
         """
         return self.get('database', 'logfile', None)
 
+    def db_log_slow_ms(self):
+        """
+        Return the time in ms above which all statements are logged
+        """
+        return float(self.get('database', 'log_slow_ms', 100))
+
+    def db_log_sample_rate(self):
+        """
+        Return the fraction of the faster statements that are logged
+        """
+        return float(self.get('database', 'log_sample_rate', 0.01))
+
+    def db_pool_size(self):
+        """
+        Return the maximum number of database connections to hold open
+        """
+        return int(self.get('database', 'pool_size', 4))
+
+    def db_pool_timeout(self):
+        """
+        Return the time in seconds to wait for a free database connection
+        """
+        return float(self.get('database', 'pool_timeout', 30))
+
+    def db_async_workers(self):
+        """
+        Return the number of threads that run blocking work for AsyncUdd
+        """
+        return int(self.get('database', 'async_workers', 2))
+
+    def db_reconnect_attempts(self):
+        """
+        Return the number of times to retry a query after losing the server
+        """
+        return int(self.get('database', 'reconnect_attempts', 3))
+
+    def db_reconnect_backoff(self):
+        """
+        Return the time in seconds to wait before the first retry
+        """
+        return float(self.get('database', 'reconnect_backoff', 0.5))
+
+    def db_prepared_statements(self):
+        """
+        Return whether hot queries may be run as prepared statements
+        """
+        value = self.get('database', 'prepared_statements', True)
+        if isinstance(value, basestring):
+            return value.lower() in ('1', 'yes', 'true', 'on')
+        return bool(value)
+
     def get(self, section, value, default=None):
         try:
             return self.config.get(section, value)
@@ -98,6 +98,14 @@ class AvailableData:
             arch = default
         return arch
 
+    @classmethod
+    def list_arches(cls):
+        """
+        List the architectures for which binary packages are built, i.e.
+        excluding 'all'
+        """
+        return [arch for arch in cls.arches if arch != 'all']
+
     @classmethod
     def list_dependent_releases(cls, release, suffixes=None,
                                 include_self=True):
@@ -32,129 +32,1195 @@
 
 import types
 import os
+import re
+import math
 import time
+import hashlib
+import threading
+import contextlib
+import weakref
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import random
+import json
+import Queue
 
-import logging
 
+def Connect(querylog, prepare=True, **kwargs):
+    """Create a psycopg2 database connection, optionally logging the SQL
 
-def Connect(logfile, **kwargs):
-    """Create a psycopg2 database connection that logs all SQL
-
-    logfile: filename to log into
+    querylog: QueryLog or the name of a log file in which to log the SQL
+            or None not to log
+    prepare: permit queries to be run as server-side prepared statements
     kwargs: as per psycopg2.connect()
 
     The statement log also includes statement execution time.
     """
     psql = None
-    if logfile:
-        psql = psycopg2.connect(
-                        connection_factory=WrappingLoggingConnection,
-                        **kwargs
-                     )
-        db_logger = logging.getLogger('psql')
-        db_logger.setLevel(logging.DEBUG)
-        fh = logging.FileHandler(logfile)
-        formatter = logging.Formatter('[%(asctime)-15s] %(name)s:%(levelname)s %(message)s')
-        fh.setFormatter(formatter)
-        db_logger.addHandler(fh)
-        psql.initialize(db_logger)
+    if querylog:
+        if isinstance(querylog, basestring):
+            querylog = query_log(querylog)
+        psql = psycopg2.connect(connection_factory=LoggingConnection,
+                                **kwargs)
+        psql.querylog = querylog
     else:
-        psql = psycopg2.connect(**kwargs)
+        psql = psycopg2.connect(connection_factory=Connection, **kwargs)
+    if not prepare:
+        psql.prepared = None
     psql.set_isolation_level(0)
     return psql
 
 
-def _wrap(cursor, func):
-    """ Construct a proxy function for methods that logs the call """
-    def wrapper(*args, **kwargs):
-        """ Wrapper function: call the original method and then log """
-        cursor.timestamp = time.time()
+def ConnectAsync(**kwargs):
+    """Create an asynchronous psycopg2 connection (see engine.AsyncEngine)
+
+    kwargs: as per psycopg2.connect()
+
+    The connection is returned before it has been established and must be
+    polled until it is ready. Asynchronous connections are always in
+    autocommit mode; they do not log their SQL or use prepared statements.
+    """
+    kwargs['async'] = True
+    return psycopg2.connect(**kwargs)
+
+
+class PoolTimeoutError(psycopg2.pool.PoolError):
+    """Exception raised when no connection became free in the pool in time"""
+
+    def __init__(self, timeout):
+        psycopg2.pool.PoolError.__init__(self)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "No database connection became available within %g s." % \
+                    self.timeout
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of database connections
+
+    Connections are opened lazily up to the size of the pool. A caller that
+    finds every connection in use waits for one to be checked back in for
+    up to 'timeout' seconds before PoolTimeoutError is raised.
+
+    Typical usage:
+        pool = ConnectionPool(lambda: Connect(None, database='udd'), size=4)
+        with pool.connection() as conn:
+            c = conn.cursor()
+            c.execute(...)
+
+    The counters in stats() record how often and for how long callers had to
+    wait for a connection and how often the pool was saturated.
+
+    If the database server goes away, query() discards the broken
+    connections and retries the query on a new connection up to 'retries'
+    times, waiting 'backoff' seconds before the first retry and doubling
+    the wait each time.
+    """
+
+    def __init__(self, connect, size=4, timeout=30, retries=3, backoff=0.5):
+        """Create a pool of connections
+
+            connect: function that returns a new database connection
+            size: maximum number of connections that may be open at once
+            timeout: number of seconds to wait for a free connection
+            retries: number of times to retry a query after the connection
+                    to the server is lost
+            backoff: number of seconds to wait before the first retry
+        """
+        if size < 1:
+            raise ValueError("Connection pool size must be at least 1")
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._idle = []
+        self._opened = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        self.counters = {
+                            'checkouts': 0,
+                            'waits': 0,
+                            'wait_time': 0.0,
+                            'max_wait': 0.0,
+                            'saturated': 0,
+                            'timeouts': 0,
+                            'opened': 0,
+                            'reconnects': 0,
+                        }
+
+    def getconn(self, timeout=None):
+        """Check a connection out of the pool
+
+        The connection must be returned to the pool with putconn().
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        conn = None
+        with self._cond:
+            if self._closed:
+                raise psycopg2.pool.PoolError("connection pool is closed")
+            waited = False
+            while not self._idle and self._opened >= self.size:
+                if not waited:
+                    self.counters['saturated'] += 1
+                    waited = True
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeoutError(timeout)
+                self._cond.wait(remaining)
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                self._opened += 1
+                self.counters['opened'] += 1
+            self.counters['checkouts'] += 1
+            if waited:
+                wait = time.time() - start
+                self.counters['waits'] += 1
+                self.counters['wait_time'] += wait
+                self.counters['max_wait'] = max(wait,
+                                                self.counters['max_wait'])
+        if conn is None:
+            try:
+                conn = self._connect()
+            except:
+                with self._cond:
+                    self._opened -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Check a connection back in to the pool
+
+        Connections that are closed (or that are to be closed as requested
+        by the 'close' argument) are discarded from the pool.
+        """
+        if not close and not conn.closed and not self._closed:
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+            return
+        if not conn.closed:
+            conn.close()
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection for the duration of a with block"""
+        conn = self.getconn(timeout)
         try:
-            return func(*args, **kwargs)
+            yield conn
         finally:
-            if not isinstance(cursor, psycopg2.extras.LoggingCursor):
-                cursor.connection.log(cursor.query.replace("%", "%%"), cursor)
+            self.putconn(conn)
 
-    newfunc = types.FunctionType(wrapper.func_code, wrapper.func_globals,
-                                func.func_name,
-                                wrapper.func_defaults, wrapper.func_closure)
-    newfunc.__doc__ = wrapper.__doc__
-    return newfunc
+    def reset(self):
+        """Close the idle connections after a connection was found broken
 
+        A lost connection usually means that the server restarted and that
+        the other connections have gone too; new connections are opened as
+        they are needed.
+        """
+        with self._cond:
+            self.counters['reconnects'] += 1
+            idle = self._idle
+            self._idle = []
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def closeall(self):
+        """Close all idle connections and refuse further check-outs
 
-class WrappingLoggingConnection(psycopg2.extras.LoggingConnection):
-    """A connection that logs all queries to a file or logger__ object.
+        Connections still checked out are closed as they are returned.
+        """
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
 
-        As distinct to the original LoggingConnection class, the
-        cursor_factory argument to the cursor() method can still be used.
-        All cursor types can then be used with a connection that will
-        always log.
+    def stats(self):
+        """Return a snapshot of the pool usage counters"""
+        with self._cond:
+            s = dict(self.counters)
+            s['size'] = self.size
+            s['idle'] = len(self._idle)
+            s['in_use'] = self._opened - len(self._idle)
+        return s
 
-    .. __: http://docs.python.org/library/logging.html
+
+class Replica(object):
+    """One of the database servers among which a ReplicaRouter routes"""
+
+    # weight of the newest sample in the moving average of the latency
+    smoothing = 0.2
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = True
+        self.latency = None
+        self.checkouts = 0
+        self.errors = 0
+
+    def observe(self, ms):
+        """Fold a latency sample in ms into the moving average"""
+        if self.latency is None:
+            self.latency = ms
+        else:
+            self.latency += self.smoothing * (ms - self.latency)
+
+    def stats(self):
+        return {
+                'healthy': self.healthy,
+                'latency': self.latency,
+                'checkouts': self.checkouts,
+                'errors': self.errors,
+               }
+
+
+class ReplicaRouter(object):
+    """Routes connection check-outs between pools on several replicas
+
+    The router stands in for a ConnectionPool (see connection() and query())
+    and hands out connections from the pool of one of the replicas, chosen
+    according to the routing policy:
+        round-robin: each replica in turn
+        latency: the replica with the lowest recent latency, being a moving
+            average of the time taken by the statements run on it by query()
+            and by the health checks; replicas not yet measured are tried
+            after those that have been
+
+    A replica whose connections cannot be made or are found broken is marked
+    as down and not used while another replica is healthy; query() then
+    retries on the next replica. Each connection that is handed out has its
+    'replica' attribute set to the name of the replica so that the query
+    statistics can be collected for each replica.
+
+    Replicas that are down are brought back into use when a connection to
+    them next works, either as the last resort when all the replicas are
+    down or when the health checker, run every check_interval seconds,
+    succeeds in running a trivial query on them.
+
+    Typical usage:
+        router = ReplicaRouter([
+                    ('mirror1', ConnectionPool(lambda: Connect(...))),
+                    ('mirror2', ConnectionPool(lambda: Connect(...))),
+                 ], policy='latency')
+        query(router, "SELECT ...")
     """
 
-    def filter(self, msg, curs):
-        """Add the total execution time to the log output """
-        t = (time.time() - curs.timestamp) * 1000
-        return "[%d ms] %s" % (t, " ".join([line.strip()
-                                            for line in msg.split("\n")]))
-        #return msg + os.linesep + "  (execution time: %d ms)" % t
+    policies = ('round-robin', 'latency')
+
+    def __init__(self, pools, policy='round-robin', check_interval=30,
+                 retries=3, backoff=0.5):
+        """Create a router between replicas
+
+            pools: list of (name, pool) for the replicas
+            policy: 'round-robin' or 'latency'
+            check_interval: number of seconds between health checks of the
+                    replicas or 0 not to check them in the background
+            retries: number of times to retry a query after its connection
+                    is lost, possibly on another replica
+            backoff: number of seconds to wait before the first retry
+        """
+        if not pools:
+            raise ValueError("At least one replica is needed")
+        if not policy in self.policies:
+            raise ValueError("Unknown routing policy '%s'" % policy)
+        self.replicas = [Replica(name, pool) for name, pool in pools]
+        self.policy = policy
+        self.check_interval = check_interval
+        self.timeout = max([r.pool.timeout for r in self.replicas])
+        self.retries = retries
+        self.backoff = backoff
+        self.failovers = 0
+        self._next = 0
+        self._checkouts = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._checker = None
+        if check_interval:
+            self._checker = threading.Thread(target=self._check_loop,
+                                             name="ReplicaRouter checker")
+            self._checker.daemon = True
+            self._checker.start()
+
+    def _candidates(self):
+        """Return the replicas in the order in which they should be tried"""
+        with self._lock:
+            healthy = [r for r in self.replicas if r.healthy]
+            down = [r for r in self.replicas if not r.healthy]
+            if self.policy == 'latency':
+                healthy.sort(key=lambda r: (r.latency is None, r.latency))
+            elif healthy:
+                i = self._next % len(healthy)
+                healthy = healthy[i:] + healthy[:i]
+                self._next += 1
+        return healthy + down
 
-    def cursor(self, name=None, cursor_factory=None):
-        """ Create a new cursor for the connection
+    def getconn(self, timeout=None):
+        """Check a connection out of the pool of one of the replicas
 
-        By default this will be a psycopg2.extras.LoggingCursor,
-        however any other cursor type can be created by specifying
-        cursor_factory.
+        The connection must be returned to the router with putconn().
         """
-        self._check()
-        # default to creating a LoggingCursor
-        if cursor_factory is None:
-            cursor_factory = psycopg2.extras.LoggingCursor
-        if name is None:
-            c = psycopg2.extensions.connection.cursor(self,
-                                    cursor_factory=cursor_factory)
+        error = None
+        for replica in self._candidates():
+            try:
+                conn = replica.pool.getconn(timeout)
+            except PoolTimeoutError:
+                raise
+            except psycopg2.Error, e:
+                self._failed(replica)
+                error = e
+                continue
+            if error is not None:
+                with self._lock:
+                    self.failovers += 1
+            conn.replica = replica.name
+            with self._lock:
+                replica.checkouts += 1
+                self._checkouts[id(conn)] = replica
+            return conn
+        raise error
+
+    def observe(self, conn, ms):
+        """Charge a statement that took ms to run on conn to its replica"""
+        with self._lock:
+            replica = self._checkouts.get(id(conn))
+            if replica is not None:
+                replica.observe(ms)
+
+    def putconn(self, conn, close=False):
+        """Check a connection back in to the pool of its replica
+
+        A connection that is closed or that is to be closed is taken to be
+        broken and its replica is marked as down.
+        """
+        with self._lock:
+            replica = self._checkouts.pop(id(conn))
+        broken = close or conn.closed
+        replica.pool.putconn(conn, close)
+        if broken:
+            self._failed(replica)
         else:
-            c = psycopg2.extensions.connection.cursor(self, name,
-                                    cursor_factory=cursor_factory)
-
-        # wrap the execute and callproc methods of the cursor with
-        # the logging wrapper -- this has two effects:
-        #  * the wrapper will record the cursor creation so the total
-        #     execution time can be logged
-        #  * if a cursor other than the LoggingCursor is used, the log
-        #    will still be written by the wrapper
-        c.execute = _wrap(c, c.execute)
-        c.callproc = _wrap(c, c.callproc)
-        return c
+            with self._lock:
+                replica.healthy = True
 
-#
-#    return __changeFunctionName(wrapper, func.func_name, func.__doc__)
-#
-#def __changeFunctionName(func, name, doc=None):
-#    if doc is None:
-#        doc = func.__doc__
-#    newfunc = types.FunctionType(func.func_code, func.func_globals, name,
-#                              func.func_defaults, func.func_closure)
-#    newfunc.__doc__ = doc
-#    return newfunc
-#
-#def __wrap(cursor, func):
-#    def newfunc(*args, **kwargs):
-#        cursor.timestamp = time.time()
-#        try:
-#            return func(*args, **kwargs)
-#        finally:
-#            if not isinstance(cursor, psycopg2.extras.LoggingCursor):
-#                cursor.connection.log(cursor.query, cursor)
-#    return __changeFunctionName(newfunc, func.func_name, func.__doc__)
-#
-#def __changeFunctionName(func, name, doc=None):
-#    if doc is None:
-#        doc = func.__doc__
-#    newfunc = types.FunctionType(func.func_code, func.func_globals, name,
-#                              func.func_defaults, func.func_closure)
-#    newfunc.__doc__ = doc
-#    return newfunc
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection for the duration of a with block"""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def _failed(self, replica):
+        with self._lock:
+            replica.healthy = False
+            replica.errors += 1
+
+    def reset(self):
+        """Close the idle connections of the replicas that are down"""
+        with self._lock:
+            down = [r for r in self.replicas if not r.healthy]
+        for replica in down or self.replicas:
+            replica.pool.reset()
+
+    def check(self):
+        """Run a trivial query on each replica, marking it as up or down
+
+        Replicas whose connections are all in use are assumed to be up.
+        """
+        for replica in self.replicas:
+            try:
+                conn = replica.pool.getconn(0)
+            except PoolTimeoutError:
+                continue
+            except psycopg2.Error:
+                self._failed(replica)
+                continue
+            broken = False
+            start = time.time()
+            try:
+                conn.cursor().execute("SELECT 1")
+            except psycopg2.Error:
+                broken = True
+            replica.pool.putconn(conn, close=broken)
+            if broken:
+                self._failed(replica)
+                replica.pool.reset()
+            else:
+                with self._lock:
+                    replica.healthy = True
+                    replica.observe((time.time() - start) * 1000)
+
+    def _check_loop(self):
+        while not self._stop.wait(self.check_interval):
+            self.check()
+
+    def closeall(self):
+        """Stop the health checks and close the pools of all replicas"""
+        self._stop.set()
+        if self._checker is not None:
+            self._checker.join()
+        for replica in self.replicas:
+            replica.pool.closeall()
+
+    def stats(self):
+        """Return the usage counters of the pools summed over the replicas
+
+        The counters for each replica are included under 'replicas'.
+        """
+        s = {}
+        for replica in self.replicas:
+            for k, v in replica.pool.stats().items():
+                if k == 'max_wait':
+                    s[k] = max(v, s.get(k, 0))
+                else:
+                    s[k] = v + s.get(k, 0)
+        with self._lock:
+            s['failovers'] = self.failovers
+            s['replicas'] = dict([(r.name, r.stats())
+                                        for r in self.replicas])
+        return s
+
+
+class DeadlineExceededError(RuntimeError):
+    """Exception raised when the time budget of a deadline has run out"""
+
+    def __init__(self, budget):
+        RuntimeError.__init__(self)
+        self.budget = budget
+
+    def __str__(self):
+        return "The time budget of %g s for the database queries " \
+                "was exceeded." % self.budget
+
+
+class Deadline(object):
+    """A time budget for all of the queries made by one thread
+
+    While a deadline is in force (see deadline()), a watchdog cancels any
+    query still running on the thread's connections when the budget runs
+    out. The server-side statement_timeout of each connection is also kept
+    close to the time that remains (see limit()) in case the watchdog's
+    cancel request is lost. Long computations that make many small queries
+    are also stopped as each new query checks the deadline first.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires = time.time() + budget
+        self.cancelled = False
+        self._conns = []
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(budget, self.cancel)
+        self._timer.daemon = True
+
+    def remaining(self):
+        """Return the number of seconds left in the budget"""
+        return self.expires - time.time()
+
+    def expired(self):
+        return self.cancelled or self.remaining() <= 0
+
+    def check(self):
+        """Raise DeadlineExceededError if the budget has run out"""
+        if self.expired():
+            raise DeadlineExceededError(self.budget)
+
+    def start(self):
+        self._timer.start()
+
+    def stop(self):
+        self._timer.cancel()
+
+    def attach(self, conn):
+        """Watch a connection so that its queries can be cancelled"""
+        with self._lock:
+            self._conns.append(conn)
+
+    def detach(self, conn):
+        """Stop watching a connection"""
+        with self._lock:
+            self._conns.remove(conn)
+
+    def limit(self, cursor):
+        """Bound the statement_timeout for the next query run on the cursor
+
+        Setting the timeout costs a round trip, so it is only sent when the
+        connection has none, when the one it has would stop the query before
+        the budget runs out, or when it is more than twice the time that
+        remains. The timeout is left in place when the connection goes back
+        to the pool so that the next deadline can usually reuse it; it is
+        reset if the connection is next used without a deadline (see
+        connection()).
+        """
+        self.check()
+        wanted = max(1, int(math.ceil(self.remaining() * 1000)))
+        current = _timeouts.get(cursor.connection, 0)
+        if not wanted <= current <= 2 * wanted:
+            set_statement_timeout(cursor, wanted)
+
+    def cancel(self):
+        """Watchdog: cancel the queries running on the watched connections"""
+        with self._lock:
+            self.cancelled = True
+            conns = list(self._conns)
+        for conn in conns:
+            try:
+                conn.cancel()
+            except psycopg2.Error:
+                pass
+
+
+_deadlines = threading.local()
+
+# the statement_timeout in ms last set on each connection by a deadline
+_timeouts = weakref.WeakKeyDictionary()
+
+
+def set_statement_timeout(cursor, ms):
+    """Set the statement_timeout of the cursor's connection in ms
+
+    A timeout of 0 resets it to the server's default.
+    """
+    if ms:
+        cursor.execute("SET statement_timeout = %d" % ms)
+    else:
+        cursor.execute("RESET statement_timeout")
+    _timeouts[cursor.connection] = ms
+
+
+def reset_statement_timeout(conn):
+    """Reset a statement_timeout left on a connection by a deadline, if any
+
+    Pooled connections keep the timeout of the last deadline under which
+    they were used (see Deadline.limit); it is reset before a connection
+    is used without a deadline.
+    """
+    if _timeouts.get(conn):
+        set_statement_timeout(conn.cursor(), 0)
+
+
+def current_deadline():
+    """Return the Deadline in force for this thread or None"""
+    return getattr(_deadlines, 'current', None)
+
+
+def check_deadline():
+    """Raise DeadlineExceededError if this thread's deadline has passed"""
+    d = current_deadline()
+    if d is not None:
+        d.check()
+
+
+@contextlib.contextmanager
+def deadline(budget):
+    """Impose a time budget on all queries made in a with block
+
+    budget: number of seconds that all of the queries made by the thread
+            within the block may take; None or 0 imposes no limit
+
+    Deadlines may be nested but an inner deadline can only shorten the
+    budget, never extend it. DeadlineExceededError is raised within the
+    block once the budget has run out.
+    """
+    outer = current_deadline()
+    if not budget or (outer is not None and outer.remaining() <= budget):
+        yield outer
+        return
+    d = Deadline(budget)
+    _deadlines.current = d
+    d.start()
+    try:
+        yield d
+    finally:
+        d.stop()
+        _deadlines.current = outer
+
+
+def fingerprint(sql):
+    """Normalise an SQL statement so that queries of the same shape match
+
+    Literals, placeholders and lists of values are replaced by '?' and
+    whitespace is collapsed, e.g.
+        SELECT * FROM packages WHERE package='dpkg' AND release IN ('sid')
+    becomes
+        SELECT * FROM packages WHERE package=? AND release IN (?)
+    """
+    for pattern, repl in _fingerprint_rules:
+        sql = pattern.sub(repl, sql)
+    return sql.strip()
+
+_fingerprint_rules = [(re.compile(p, re.I), r) for p, r in (
+        (r"'(?:[^']|'')*'", "?"),                   # string literals
+        (r"%\(\w+\)s|%s|\$\d+", "?"),               # placeholders
+        (r"\b\d+(?:\.\d+)?\b", "?"),                 # numbers
+        (r"ARRAY\[[?,\s]*\]", "?"),                 # lists as arrays
+        (r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)"),        # lists of values
+        (r"\s+", " "),
+    )]
+
+
+class LatencyHistogram(object):
+    """Counts of query times in a fixed set of buckets
+
+    Percentiles are estimated from the bucket counts so that the memory used
+    does not grow with the number of queries recorded.
+    """
+
+    # upper bounds of the buckets in ms; the last bucket is unbounded
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500,
+              1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms, error=False):
+        """Record one query time in ms and whether the query failed"""
+        i = 0
+        while i < len(self.bounds) and ms > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """Estimate the p-th percentile of the recorded times in ms
+
+        The upper bound of the bucket holding the percentile is returned,
+        limited by the largest time seen.
+        """
+        if not self.calls:
+            return 0.0
+        rank = p / 100.0 * self.calls
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i < len(self.bounds):
+                    return min(float(self.bounds[i]), self.max)
+                break
+        return self.max
+
+    def summary(self):
+        return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'total': self.total,
+                'mean': self.total / self.calls if self.calls else 0.0,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'max': self.max,
+               }
+
+
+class QueryStats(object):
+    """Query latency statistics by fingerprint, by origin and by replica
+
+    Each query run through query() is recorded against the fingerprint of
+    its SQL, against the Commands method that it was made on behalf of
+    (see query_origin()) and, when routing between replicas (see
+    ReplicaRouter), against the replica on which it ran, giving call and
+    error counts, total time and latency percentiles for each. All times
+    are in ms.
+
+    Typical usage:
+        for fp, summary in query_stats.top(5, key='p95'):
+            print fp, summary['calls'], summary['p95']
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard all the statistics collected so far"""
+        with self._lock:
+            self.fingerprints = {}
+            self.origins = {}
+            self.replicas = {}
+
+    def record(self, sql, ms, origin=None, replica=None, error=False):
+        """Record the time taken by a query and whether it failed"""
+        fp = fingerprint(sql)
+        if origin is None:
+            origin = '(unknown)'
+        tables = [(self.fingerprints, fp), (self.origins, origin)]
+        if replica is not None:
+            tables.append((self.replicas, replica))
+        with self._lock:
+            for table, name in tables:
+                h = table.get(name)
+                if h is None:
+                    h = table[name] = LatencyHistogram()
+                h.add(ms, error)
+
+    def dump(self):
+        """Return the summaries for all fingerprints, origins and replicas
+
+        The result is a dict with keys 'fingerprints', 'origins' and
+        'replicas', each mapping the names to summary dicts (see
+        LatencyHistogram.summary).
+        """
+        with self._lock:
+            return {
+                    'fingerprints': dict([(k, h.summary()) for k, h in
+                                            self.fingerprints.items()]),
+                    'origins': dict([(k, h.summary()) for k, h in
+                                            self.origins.items()]),
+                    'replicas': dict([(k, h.summary()) for k, h in
+                                            self.replicas.items()]),
+                   }
+
+    def top(self, n=10, key='total', by='fingerprints'):
+        """Return the n worst offenders as a list of (name, summary)
+
+        key: summary value to sort by: total, calls, errors, mean, p50, p95,
+                p99, max
+        by: 'fingerprints', 'origins' or 'replicas'
+        """
+        summaries = self.dump()[by].items()
+        summaries.sort(key=lambda item: item[1][key], reverse=True)
+        return summaries[:n]
+
+
+query_stats = QueryStats()
+
+_origins = threading.local()
+
+
+def current_origin():
+    """Return the name of the method on whose behalf queries are being made"""
+    return getattr(_origins, 'current', None)
+
+
+@contextlib.contextmanager
+def query_origin(name):
+    """Attribute the queries made in a with block to the named origin
+
+    Origins do not nest: queries are attributed to the outermost origin so
+    that helper methods calling each other are counted against the method
+    that was called originally.
+    """
+    if current_origin() is not None:
+        yield
+        return
+    _origins.current = name
+    try:
+        yield
+    finally:
+        _origins.current = None
+
+
+def query_origins(cls):
+    """Class decorator attributing the queries of each public method to it
+
+    The origin is named module.method, e.g. package_queries.checkInstall.
+    """
+    module = cls.__module__.split('.')[-1]
+
+    def traced(name, func):
+        label = "%s.%s" % (module, name)
+
+        def wrapper(*args, **kwargs):
+            with query_origin(label):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    for name, func in cls.__dict__.items():
+        if not name.startswith('_') and isinstance(func, types.FunctionType):
+            setattr(cls, name, traced(name, func))
+    return cls
+
+
+@contextlib.contextmanager
+def connection(dbconn):
+    """Check out a connection from dbconn for the duration of a with block
+
+    dbconn: either a pool (e.g. ConnectionPool) or a bare psycopg2 connection
+
+    If a deadline is in force, the wait for a pooled connection is limited
+    by it and queries cancelled by it raise DeadlineExceededError.
+
+    Without a deadline, the connection has no statement_timeout left on it
+    by an earlier deadline.
+
+    Connections that fail with OperationalError or InterfaceError are
+    discarded from the pool rather than being reused.
+    """
+    d = current_deadline()
+    pooled = hasattr(dbconn, 'getconn')
+    if pooled:
+        timeout = None
+        if d is not None:
+            d.check()
+            timeout = min(d.remaining(), dbconn.timeout)
+        try:
+            conn = dbconn.getconn(timeout)
+        except PoolTimeoutError:
+            check_deadline()
+            raise
+    else:
+        conn = dbconn
+    if d is not None:
+        d.attach(conn)
+    broken = False
+    try:
+        try:
+            if d is None:
+                reset_statement_timeout(conn)
+            yield conn
+        except psycopg2.extensions.QueryCanceledError:
+            if d is None:
+                raise
+            raise DeadlineExceededError(d.budget)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+    finally:
+        if d is not None:
+            d.detach(conn)
+            if not pooled and not broken:
+                # the caller's own connection is left without the timeout
+                try:
+                    reset_statement_timeout(conn)
+                except psycopg2.Error:
+                    pass
+        if pooled:
+            dbconn.putconn(conn, close=broken)
+
+
+def query(dbconn, sql, params=None, cursor_factory=None, one=False,
+          prepare=False, cache=False):
+    """Run a single query on a connection checked out of dbconn
+
+    dbconn: a ConnectionPool, a ReplicaRouter or a bare psycopg2 connection
+    sql, params: as per cursor.execute()
+    cursor_factory: cursor class to use (e.g. rows.RowCursor)
+    one: return only the first row (or None) rather than a list of all rows
+    prepare: run the query as a server-side prepared statement if the
+            connection supports it (see PreparedStatements)
+    cache: reuse the result of an identical query if dbconn has a cache
+            attached as its 'cache' attribute (see cache.QueryCache)
+
+    The query is limited by the deadline in force for the thread, if any,
+    and its execution time is recorded in query_stats.
+
+    Only read-only queries may be run with query(): if the connection to
+    the server is lost, the query is retried on a new connection according
+    to the retry policy of the pool (see ConnectionPool), on another replica
+    if dbconn is a ReplicaRouter.
+    """
+    results = getattr(dbconn, 'cache', None) if cache else None
+    if results is not None:
+        return results.fetch(sql, params, cursor_factory, one,
+                    lambda: _retry(dbconn, sql, params, cursor_factory, one,
+                                   prepare))
+    return _retry(dbconn, sql, params, cursor_factory, one, prepare)
+
+
+def _retry(dbconn, sql, params, cursor_factory, one, prepare):
+    attempt = 0
+    while True:
+        try:
+            return _query(dbconn, sql, params, cursor_factory, one, prepare)
+        except psycopg2.extensions.QueryCanceledError:
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            attempt += 1
+            if attempt > getattr(dbconn, 'retries', 0):
+                raise
+            dbconn.reset()
+            delay = dbconn.backoff * 2 ** (attempt - 1)
+            d = current_deadline()
+            if d is not None:
+                delay = min(delay, max(0, d.remaining()))
+            time.sleep(delay)
+            check_deadline()
+
+
+def _query(dbconn, sql, params, cursor_factory, one, prepare):
+    with connection(dbconn) as conn:
+        c = conn.cursor(cursor_factory=cursor_factory)
+        d = current_deadline()
+        if d is not None:
+            d.limit(c)
+        registry = getattr(conn, 'prepared', None)
+        start = time.time()
+        error = True
+        try:
+            if prepare and registry is not None:
+                registry.execute(c, sql, params)
+            else:
+                c.execute(sql, params)
+            if one:
+                rows = c.fetchone()
+            else:
+                rows = c.fetchall()
+            error = False
+            return rows
+        finally:
+            ms = (time.time() - start) * 1000
+            query_stats.record(sql, ms, current_origin(),
+                               getattr(conn, 'replica', None), error)
+            if not error and hasattr(dbconn, 'observe'):
+                dbconn.observe(conn, ms)
+
+
+class PreparedStatements(object):
+    """Registry of the server-side prepared statements of one connection
+
+    Queries are written with the usual pyformat placeholders, e.g.
+        SELECT * FROM packages WHERE package=%(package)s
+    and the first time each distinct query text (its "shape") is seen on
+    the connection it is sent to the server with PREPARE, the placeholders
+    having been rewritten as $1, $2, ... Thereafter only EXECUTE and the
+    parameter values are sent, so the server does not re-plan the query.
+
+    Parameters that are used with IN must be written as "= ANY(%(name)s)"
+    and passed as a list, since a prepared statement cannot expand a tuple
+    into a list of values.
+
+    Statement names are derived from the query text so that the same shape
+    has the same name on every connection.
+    """
+
+    _placeholder = re.compile(r"%\((\w+)\)s|%%")
+
+    def __init__(self):
+        self.statements = {}
+        self.executions = 0
+
+    def execute(self, cursor, sql, params=None):
+        """Execute the query on the cursor, preparing it first if needed"""
+        stmt = self.statements.get(sql)
+        if stmt is None:
+            stmt = self.prepare(cursor, sql)
+        name, names = stmt
+        self.executions += 1
+        if not names:
+            return cursor.execute("EXECUTE %s" % name)
+        return cursor.execute("EXECUTE %s (%s)" %
+                                    (name, ", ".join(["%s"] * len(names))),
+                              [params[n] for n in names])
+
+    def prepare(self, cursor, sql):
+        """Send PREPARE for the query and record the statement"""
+        names = []
+
+        def positional(m):
+            if m.group(0) == '%%':
+                return '%'
+            if not m.group(1) in names:
+                names.append(m.group(1))
+            return "$%d" % (names.index(m.group(1)) + 1)
+
+        text = self._placeholder.sub(positional, sql)
+        name = "udd_%s" % hashlib.md5(text).hexdigest()[:16]
+        cursor.execute("PREPARE %s AS %s" % (name, text))
+        stmt = (name, tuple(names))
+        self.statements[sql] = stmt
+        return stmt
+
+    def __len__(self):
+        return len(self.statements)
+
+
+class Connection(psycopg2.extensions.connection):
+    """A connection that can run prepared statements (see query()) """
+
+    def __init__(self, *args, **kwargs):
+        psycopg2.extensions.connection.__init__(self, *args, **kwargs)
+        self.prepared = PreparedStatements()
+
+
+class QueryLog(object):
+    """A sampled log of SQL statements, written by a background thread
+
+    Statements that take at least slow_ms are always logged, as is a random
+    sample (sample_rate, between 0 and 1) of the rest. The querying thread
+    only decides whether to log the statement and queues it; formatting and
+    writing are done in the writer thread. If the queue is full the record
+    is dropped (and counted) rather than delaying the query.
+
+    Each line of the log is a JSON object, e.g.:
+        {"ts": 1364000000.123, "ms": 12.5, "rows": 1, "slow": false,
+         "origin": "package_queries.checkInstall",
+         "fingerprint": "SELECT ... WHERE package=?",
+         "sql": "SELECT ... WHERE package='dpkg'"}
+    where ts is the time at which the statement finished.
+    """
+
+    def __init__(self, logfile, slow_ms=100, sample_rate=0.01,
+                 queue_size=10000):
+        self.logfile = logfile
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.logged = 0
+        self.dropped = 0
+        self._out = open(logfile, 'a')
+        self._queue = Queue.Queue(queue_size)
+        self._writer = threading.Thread(target=self._write,
+                                        name="QueryLog(%s)" % logfile)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def log(self, cursor, ms):
+        """Queue the statement last executed by the cursor for logging"""
+        slow = ms >= self.slow_ms
+        if not slow and random.random() >= self.sample_rate:
+            return
+        try:
+            self._queue.put_nowait((time.time(), ms, slow, cursor.query,
+                                    cursor.rowcount, current_origin()))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    self._out.close()
+                    return
+                self._out.write(self._format(record))
+                self.logged += 1
+                if self._queue.empty():
+                    self._out.flush()
+            finally:
+                self._queue.task_done()
+
+    def _format(self, record):
+        ts, ms, slow, sql, rows, origin = record
+        if sql is None:
+            sql = ''
+        sql = sql.decode('UTF-8', 'replace')
+        return json.dumps({
+                    'ts': round(ts, 3),
+                    'ms': round(ms, 3),
+                    'slow': slow,
+                    'rows': rows,
+                    'origin': origin,
+                    'fingerprint': fingerprint(sql),
+                    'sql': sql,
+                }, sort_keys=True) + "\n"
+
+    def flush(self):
+        """Wait until all queued statements have been written out"""
+        self._queue.join()
+
+    def close(self):
+        """Write out the queued statements and stop the writer"""
+        self._queue.put(None)
+        self._writer.join()
+
+    def stats(self):
+        return {
+                'logged': self.logged,
+                'dropped': self.dropped,
+                'queued': self._queue.qsize(),
+               }
+
+
+_query_logs = {}
+_query_logs_lock = threading.Lock()
+
+
+def query_log(logfile, slow_ms=None, sample_rate=None):
+    """Return the QueryLog for logfile, creating it only once
+
+    Each connection in a pool is made with Connect(), so all of them (and
+    all Udd instances logging to the same file) share the one writer. The
+    sampling settings of the log are updated if they are given.
+    """
+    with _query_logs_lock:
+        querylog = _query_logs.get(logfile)
+        if querylog is None:
+            querylog = _query_logs[logfile] = QueryLog(logfile)
+        if slow_ms is not None:
+            querylog.slow_ms = slow_ms
+        if sample_rate is not None:
+            querylog.sample_rate = sample_rate
+    return querylog
+
+
+_logging_cursors = {}
+
+
+def _logging_cursor(factory):
+    """Return a subclass of the cursor class that logs to the QueryLog
+
+    The subclasses are made only once for each cursor class.
+    """
+    cls = _logging_cursors.get(factory)
+    if cls is not None:
+        return cls
+
+    class LoggingCursor(factory):
+        def execute(self, sql, args=None):
+            start = time.time()
+            try:
+                return factory.execute(self, sql, args)
+            finally:
+                self.connection.querylog.log(self,
+                                        (time.time() - start) * 1000)
+
+        def callproc(self, procname, args=None):
+            start = time.time()
+            try:
+                return factory.callproc(self, procname, args)
+            finally:
+                self.connection.querylog.log(self,
+                                        (time.time() - start) * 1000)
+
+    LoggingCursor.__name__ = "Logging%s" % factory.__name__
+    _logging_cursors[factory] = LoggingCursor
+    return LoggingCursor
+
+
+class LoggingConnection(Connection):
+    """A connection that logs its queries to a QueryLog (see Connect())
+
+    Any cursor_factory can still be given to the cursor() method; the
+    cursors are made from a logging subclass of it.
+    """
+
+    querylog = None
+
+    def cursor(self, name=None, cursor_factory=None, **kwargs):
+        factory = cursor_factory or self.cursor_factory or \
+                    psycopg2.extensions.cursor
+        return Connection.cursor(self, name,
+                                 cursor_factory=_logging_cursor(factory),
+                                 **kwargs)
@@ -0,0 +1,727 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Query plans and an event-driven query engine for UDD
+
+The Commands classes (see package_queries.py and bug_queries.py) are
+written as plans: generator methods that yield each step that they need
+and are sent the result of the step in return. A step is one of:
+
+    Query -- run one SQL query; the rows (or row) are sent back
+    Call -- call a blocking function, such as a Checker that makes many
+            queries of its own; the return value is sent back
+    another plan -- run it as a sub-plan; its value is sent back
+
+Since a generator cannot return a value, a plan finishes with
+"raise Return(value)". Exceptions from a step are raised inside the plan
+at the yield so that they can be handled there as usual.
+
+A plan can be run in two ways:
+
+    run() -- synchronously, step by step, on the calling thread
+    AsyncEngine -- on a single event loop thread that multiplexes many
+            plans over a small pool of asynchronous psycopg2 connections,
+            returning a Future for the value of each plan
+
+The synchronous() and asynchronous() class decorators turn the plans of a
+class into ordinary methods that use one or the other.
+
+Typical usage:
+    class Queries(object):
+        def __init__(self, udd):
+            self.udd = udd
+
+        def popcon(self, package):
+            row = yield Query("SELECT * FROM popcon WHERE package=%(p)s",
+                              {'p': package}, one=True)
+            raise Return(row)
+
+    @synchronous
+    class Commands(Queries):
+        pass
+
+    @asynchronous
+    class AsyncCommands(Queries):
+        pass
+
+    print Commands(Udd()).popcon('dpkg')
+    print AsyncCommands(AsyncUdd()).popcon('dpkg').result()
+"""
+
+import os
+import sys
+import errno
+import fcntl
+import time
+import types
+import select
+import inspect
+import functools
+import threading
+import collections
+import Queue
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import database
+
+
+class Return(Exception):
+    """Raised by a plan to finish with a value"""
+
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Query(object):
+    """A plan step that runs one SQL query (see database.query())"""
+
+    def __init__(self, sql, params=None, cursor_factory=None, one=False,
+                 prepare=False, cache=False):
+        self.sql = sql
+        self.params = params
+        self.cursor_factory = cursor_factory
+        self.one = one
+        self.prepare = prepare
+        self.cache = cache
+
+    def run(self, dbconn):
+        return database.query(dbconn, self.sql, self.params,
+                              cursor_factory=self.cursor_factory,
+                              one=self.one, prepare=self.prepare,
+                              cache=self.cache)
+
+
+class Call(object):
+    """A plan step that calls a blocking function"""
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+def _error(exc):
+    """Return the exc_info triple for an exception that was not raised"""
+    try:
+        raise exc
+    except:
+        return sys.exc_info()
+
+
+def _advance(plan, value, error):
+    """Send a value or raise an error in a plan, returning the next step
+
+    Returns (True, step) if the plan yielded a step or (False, value) if it
+    finished; exceptions raised by the plan propagate.
+    """
+    try:
+        if error:
+            step = plan.throw(*error)
+        else:
+            step = plan.send(value)
+    except Return, r:
+        return False, r.value
+    except StopIteration:
+        return False, None
+    return True, step
+
+
+def run(plan, dbconn):
+    """Run a plan synchronously on the calling thread and return its value
+
+    plan: generator as described above
+    dbconn: pool or connection on which to run the queries
+    """
+    value = error = None
+    while True:
+        running, step = _advance(plan, value, error)
+        if not running:
+            return step
+        value = error = None
+        try:
+            if isinstance(step, Query):
+                value = step.run(dbconn)
+            elif isinstance(step, Call):
+                value = step.run()
+            elif isinstance(step, types.GeneratorType):
+                value = run(step, dbconn)
+            else:
+                raise TypeError("Unknown step in plan: %r" % step)
+        except Exception:
+            error = sys.exc_info()
+
+
+def _plans(cls):
+    """Return the names of the plans (public generator methods) of cls"""
+    names = set()
+    for klass in inspect.getmro(cls):
+        for name, func in klass.__dict__.items():
+            if not name.startswith('_') and \
+                    inspect.isgeneratorfunction(func):
+                names.add(name)
+    return names
+
+
+def synchronous(cls):
+    """Class decorator: run the plans of the class with run()
+
+    Each plan becomes a method returning the value of the plan. The queries
+    are run on self.udd.pool.
+    """
+    for name in _plans(cls):
+        setattr(cls, name, _synchronous(getattr(cls, name).im_func))
+    return cls
+
+
+def _synchronous(plan):
+    @functools.wraps(plan)
+    def wrapper(self, *args, **kwargs):
+        return run(plan(self, *args, **kwargs), self.udd.pool)
+    return wrapper
+
+
+def asynchronous(cls):
+    """Class decorator: run the plans of the class on an AsyncEngine
+
+    Each plan becomes a method returning a Future for the value of the plan.
+    The plans are run on self.udd.engine within the time that remains of
+    the calling thread's deadline, if any (see database.deadline()). The
+    queries are attributed to origins named module.method, as for
+    database.query_origins().
+    """
+    module = cls.__module__.split('.')[-1]
+    for name in _plans(cls):
+        setattr(cls, name, _asynchronous(getattr(cls, name).im_func,
+                                         "%s.%s" % (module, name)))
+    return cls
+
+
+def _asynchronous(plan, origin):
+    @functools.wraps(plan)
+    def wrapper(self, *args, **kwargs):
+        d = database.current_deadline()
+        budget = None
+        if d is not None:
+            budget = d.remaining()
+        return self.udd.engine.submit(plan(self, *args, **kwargs),
+                                      origin, budget)
+    return wrapper
+
+
+class TimeoutError(RuntimeError):
+    """Exception raised when waiting for the result of a Future times out"""
+    pass
+
+
+class Future(object):
+    """The eventual value of a plan that is being run by an AsyncEngine"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._done = False
+        self._value = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def set_result(self, value):
+        self._finish(value, None)
+
+    def set_exception(self, error):
+        """Finish with an error given as an exc_info triple"""
+        self._finish(None, error)
+
+    def _finish(self, value, error):
+        with self._cond:
+            if self._done:
+                raise RuntimeError("The future has already finished")
+            self._done = True
+            self._value = value
+            self._error = error
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._cond.notify_all()
+        for func in callbacks:
+            self._callback(func)
+
+    def _callback(self, func):
+        try:
+            func(self)
+        except Exception:
+            # a broken callback must not stop the event loop
+            pass
+
+    def add_done_callback(self, func):
+        """Call func(future) when the future finishes
+
+        The function is called on the thread that finishes the future
+        (usually the event loop thread) and must not block.
+        """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(func)
+                return
+        self._callback(func)
+
+    def _wait(self, timeout):
+        with self._cond:
+            if timeout is None:
+                while not self._done:
+                    self._cond.wait()
+            else:
+                end = time.time() + timeout
+                while not self._done and time.time() < end:
+                    self._cond.wait(end - time.time())
+            if not self._done:
+                raise TimeoutError("The result was not ready within %g s." %
+                                   timeout)
+
+    def result(self, timeout=None):
+        """Wait for the value of the plan, raising its exception if any"""
+        self._wait(timeout)
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+
+    def exception(self, timeout=None):
+        """Wait for the plan to finish, returning its exception or None"""
+        self._wait(timeout)
+        if self._error:
+            return self._error[1]
+        return None
+
+
+class _Task(object):
+    """A plan being run by the engine"""
+
+    def __init__(self, plan, future, origin, budget):
+        self.plan = plan
+        self.future = future
+        self.origin = origin
+        self.budget = budget
+        self.expires = None
+        if budget:
+            self.expires = time.time() + budget
+
+    def expired(self, now=None):
+        return self.expires is not None and \
+                    (now or time.time()) >= self.expires
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(self.expires - time.time(), 0.001)
+
+    def deadline_error(self):
+        return _error(database.DeadlineExceededError(self.budget))
+
+
+class _Job(object):
+    """A query step of a task, waiting for or running on a connection"""
+
+    def __init__(self, task, query):
+        self.task = task
+        self.query = query
+        self.cursor = None
+        self.start = None
+        self.attempts = 0
+        self.not_before = 0
+        self.cancelled = False
+
+
+class AsyncEngine(object):
+    """Run plans on one event loop thread over asynchronous connections
+
+    Plans submitted from any thread are stepped on the loop thread. Their
+    queries are sent on a pool of up to 'size' asynchronous connections and
+    the loop waits for the results with select(), so that many requests are
+    served concurrently without a thread for each. Call steps, which block,
+    are run on a pool of 'workers' threads.
+
+    As for ConnectionPool, a query whose connection is lost is retried on a
+    new connection up to 'retries' times, waiting 'backoff' seconds before
+    the first retry and doubling the wait each time. Queries running when a
+    plan runs out of time are cancelled.
+
+    The prepare and cache options of Query steps are ignored: queries run
+    by the engine are neither prepared nor cached (see cache.py).
+
+    Typical usage:
+        engine = AsyncEngine(lambda: database.ConnectAsync(database='udd'))
+        future = engine.query("SELECT * FROM popcon WHERE package=%(p)s",
+                              {'p': 'dpkg'}, one=True)
+        future.add_done_callback(lambda f: reply(f.result()))
+    """
+
+    def __init__(self, connect, size=4, workers=2, retries=3, backoff=0.5):
+        """Start the event loop and the worker threads
+
+            connect: function that returns a new asynchronous connection
+                     (e.g. database.ConnectAsync)
+            size: maximum number of connections that may be open at once
+            workers: number of threads on which to run Call steps
+            retries, backoff: retry policy for lost connections
+        """
+        self._connect = connect
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self._pending = collections.deque()
+        self._idle = []
+        self._opened = 0
+        self._waiting = {}
+        self._callbacks = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL,
+                    fcntl.fcntl(self._wakeup_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._closed = False
+        self.counters = {
+                            'plans': 0,
+                            'queries': 0,
+                            'calls': 0,
+                            'opened': 0,
+                            'reconnects': 0,
+                            'cancelled': 0,
+                        }
+        self._calls = Queue.Queue()
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work,
+                                 name="AsyncEngine worker %d" % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+        self._loop = threading.Thread(target=self._run, name="AsyncEngine")
+        self._loop.daemon = True
+        self._loop.start()
+
+    def submit(self, plan, origin=None, budget=None):
+        """Run a plan on the event loop, returning a Future for its value
+
+        plan: generator as described in the module documentation
+        origin: name to which the plan's queries are attributed in
+                database.query_stats
+        budget: number of seconds that the plan may take or None
+        """
+        future = Future()
+        task = _Task(plan, future, origin, budget)
+        self.call_soon_threadsafe(self._start, task)
+        return future
+
+    def query(self, sql, params=None, cursor_factory=None, one=False,
+              origin=None, budget=None):
+        """Run one query on the event loop, returning a Future for the rows"""
+        def plan():
+            rows = yield Query(sql, params, cursor_factory, one)
+            raise Return(rows)
+        return self.submit(plan(), origin, budget)
+
+    def call_soon_threadsafe(self, func, *args):
+        """Call func(*args) on the event loop thread"""
+        with self._lock:
+            self._callbacks.append((func, args))
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError, e:
+            # a full pipe will wake the loop anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        """Stop the event loop, failing any plans that have not finished"""
+        if self._closed or not self._loop.is_alive():
+            return
+        self.call_soon_threadsafe(self._shutdown)
+        self._loop.join()
+        for t in self._workers:
+            self._calls.put(None)
+        for t in self._workers:
+            t.join()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def stats(self):
+        """Return a snapshot of the engine's usage counters"""
+        s = dict(self.counters)
+        s['size'] = self.size
+        s['open'] = self._opened
+        s['idle'] = len(self._idle)
+        s['pending'] = len(self._pending)
+        s['running'] = self._opened - len(self._idle)
+        return s
+
+    # The remaining methods are only called on the event loop thread
+
+    def _run(self):
+        while not self._closed:
+            self._run_callbacks()
+            if self._closed:
+                break
+            self._dispatch()
+            self._expire()
+            rlist = [self._wakeup_r]
+            wlist = []
+            for fd, (job, conn, mode) in self._waiting.items():
+                if mode == psycopg2.extensions.POLL_READ:
+                    rlist.append(fd)
+                else:
+                    wlist.append(fd)
+            r, w, x = select.select(rlist, wlist, [], self._timeout())
+            if self._wakeup_r in r:
+                os.read(self._wakeup_r, 4096)
+            for fd in r + w:
+                if fd in self._waiting:
+                    job, conn, mode = self._waiting.pop(fd)
+                    self._poll(job, conn)
+        for job, conn, mode in self._waiting.values():
+            self._resume(job.task, error=_error(
+                    psycopg2.pool.PoolError("The engine has been closed")))
+            conn.close()
+        for conn in self._idle:
+            conn.close()
+        self._run_callbacks()
+
+    def _shutdown(self):
+        self._closed = True
+        for job in self._pending:
+            self._resume(job.task, error=_error(
+                    psycopg2.pool.PoolError("The engine has been closed")))
+        self._pending.clear()
+
+    def _run_callbacks(self):
+        while True:
+            with self._lock:
+                if not self._callbacks:
+                    return
+                func, args = self._callbacks.popleft()
+            func(*args)
+
+    def _timeout(self):
+        """Return how long select() may wait before the loop has work"""
+        if self._callbacks:
+            return 0
+        now = time.time()
+        times = []
+        for job in self._pending:
+            times.append(job.not_before)
+            if job.task.expires is not None:
+                times.append(job.task.expires)
+        for job, conn, mode in self._waiting.values():
+            if job.task.expires is not None and not job.cancelled:
+                times.append(job.task.expires)
+        if not times:
+            return None
+        return max(0, min(times) - now)
+
+    def _start(self, task):
+        self.counters['plans'] += 1
+        self._step(task, None, None)
+
+    def _resume(self, task, value=None, error=None):
+        """Continue the task with the result of its last step"""
+        with self._lock:
+            self._callbacks.append((self._step, (task, value, error)))
+
+    def _step(self, task, value, error):
+        """Advance the task's plan and start its next step"""
+        if error is None and task.expired():
+            error = task.deadline_error()
+        try:
+            with database.query_origin(task.origin):
+                running, step = _advance(task.plan, value, error)
+        except Exception:
+            task.future.set_exception(sys.exc_info())
+            return
+        if not running:
+            task.future.set_result(step)
+        elif self._closed:
+            task.plan.close()
+            task.future.set_exception(_error(
+                    psycopg2.pool.PoolError("The engine has been closed")))
+        elif isinstance(step, Query):
+            self.counters['queries'] += 1
+            self._pending.append(_Job(task, step))
+        elif isinstance(step, Call):
+            self.counters['calls'] += 1
+            self._calls.put((task, step))
+        elif isinstance(step, types.GeneratorType):
+            child = _Task(step, Future(), task.origin, None)
+            child.expires = task.expires
+            child.budget = task.budget
+            child.future.add_done_callback(
+                lambda f: self._resume(task, f._value, f._error))
+            self._step(child, None, None)
+        else:
+            self._resume(task, error=_error(
+                    TypeError("Unknown step in plan: %r" % step)))
+
+    def _dispatch(self):
+        """Send the pending queries on idle (or new) connections"""
+        now = time.time()
+        pending = self._pending
+        self._pending = collections.deque()
+        while pending:
+            job = pending.popleft()
+            if job.task.expired(now):
+                self._resume(job.task, error=job.task.deadline_error())
+            elif job.not_before > now:
+                self._pending.append(job)
+            elif self._idle:
+                self._execute(job, self._idle.pop())
+            elif self._opened < self.size:
+                self._open(job)
+            else:
+                self._pending.append(job)
+
+    def _open(self, job):
+        """Open a new connection on which to run the job"""
+        try:
+            conn = self._connect()
+        except psycopg2.Error:
+            return self._lost(job, None, sys.exc_info())
+        self._opened += 1
+        self.counters['opened'] += 1
+        self._poll(job, conn)
+
+    def _execute(self, job, conn):
+        """Send the job's query on a connection that is ready"""
+        job.start = time.time()
+        try:
+            job.cursor = conn.cursor(cursor_factory=job.query.cursor_factory)
+            job.cursor.execute(job.query.sql, job.query.params)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return self._lost(job, conn, sys.exc_info())
+        except psycopg2.Error:
+            return self._finished(job, conn, sys.exc_info())
+        self._poll(job, conn)
+
+    def _poll(self, job, conn):
+        """Advance the connection's state and wait on it if need be"""
+        try:
+            state = conn.poll()
+        except psycopg2.extensions.QueryCanceledError:
+            if job.cancelled:
+                return self._finished(job, conn, job.task.deadline_error())
+            return self._finished(job, conn, sys.exc_info())
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return self._lost(job, conn, sys.exc_info())
+        except psycopg2.Error:
+            return self._finished(job, conn, sys.exc_info())
+        if state == psycopg2.extensions.POLL_OK:
+            if job.cursor is None:
+                # the connection has just been established
+                if job.task.expired():
+                    self._idle.append(conn)
+                    return self._resume(job.task,
+                                        error=job.task.deadline_error())
+                self._execute(job, conn)
+            else:
+                self._finished(job, conn)
+        elif state in (psycopg2.extensions.POLL_READ,
+                       psycopg2.extensions.POLL_WRITE):
+            self._waiting[conn.fileno()] = (job, conn, state)
+        else:
+            self._lost(job, conn, _error(psycopg2.OperationalError(
+                                "Unexpected connection state %r" % state)))
+
+    def _finished(self, job, conn, error=None):
+        """Collect the result of the job's query and continue the plan"""
+        value = None
+        if error is None:
+            try:
+                if job.query.one:
+                    value = job.cursor.fetchone()
+                else:
+                    value = job.cursor.fetchall()
+            except psycopg2.Error:
+                error = sys.exc_info()
+        database.query_stats.record(job.query.sql,
+                                    (time.time() - job.start) * 1000,
+                                    job.task.origin, error=error is not None)
+        self._idle.append(conn)
+        self._resume(job.task, value, error)
+
+    def _lost(self, job, conn, error):
+        """Discard a broken connection and retry the job if permitted"""
+        if conn is not None:
+            self._opened -= 1
+            conn.close()
+        # the idle connections have usually gone too
+        for idle in self._idle:
+            idle.close()
+        self._opened -= len(self._idle)
+        self._idle = []
+        job.attempts += 1
+        if job.attempts > self.retries:
+            return self._resume(job.task, error=error)
+        self.counters['reconnects'] += 1
+        job.cursor = None
+        job.cancelled = False
+        job.not_before = time.time() + self.backoff * 2 ** (job.attempts - 1)
+        self._pending.append(job)
+
+    def _expire(self):
+        """Cancel the queries of plans that have run out of time"""
+        now = time.time()
+        for job, conn, mode in self._waiting.values():
+            if not job.cancelled and job.task.expired(now) and \
+                    job.cursor is not None:
+                job.cancelled = True
+                self.counters['cancelled'] += 1
+                try:
+                    conn.cancel()
+                except psycopg2.Error:
+                    pass
+
+    # Worker threads
+
+    def _work(self):
+        while True:
+            item = self._calls.get()
+            if item is None:
+                return
+            task, step = item
+            value = error = None
+            try:
+                with database.query_origin(task.origin):
+                    with database.deadline(task.remaining()):
+                        value = step.run()
+            except Exception:
+                error = sys.exc_info()
+            self.call_soon_threadsafe(self._step, task, value, error)
@@ -0,0 +1,176 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Index of the names of the binary and source packages in UDD
+
+Many of the names that are looked up do not exist in the release, being
+typing mistakes or packages from another release, and each of them costs
+one or more queries to find nothing (more for Release.Source, which goes
+on to look for a binary package of that name). The names of all the binary
+and source packages of a release are instead kept in sorted lists from
+which those that are certainly absent are rejected without a query and
+from which the near names are suggested.
+
+An index is built the first time that a name is not found in the release
+(see Release.not_found) and is then used for all the lookups in the release
+until it is cleared, e.g. when UDD has imported new packages, or is older
+than max_age. A one-off lookup, as made by the command line tools, thus
+does not pay for reading all the names of the release. The indexes are
+held in a NameRegistry that belongs to the database (see
+Udd.name_registry).
+
+Typical usage:
+    registry = nameindex.NameRegistry()
+    index = registry.index(pool, ('sid',))
+    if not index.contains('dpgk'):
+        print index.suggest('dpgk')
+"""
+
+import time
+import bisect
+import difflib
+import database
+from cache import _sizeof
+from provides import ProvidesRegistry
+
+
+class NameIndex(object):
+    """Sorted lists of the names of the packages in a release"""
+
+    def __init__(self, release):
+        self.release = release
+        self.arch = None
+        self.binaries = []
+        self.sources = []
+        self.rejected = 0
+        self.built = None
+        self.build_time = 0
+        self.bytes = 0
+
+    def build(self, dbconn):
+        """Read the names of the binary and source packages of the release
+
+        The binary packages of all the architectures are included.
+        """
+        start = time.time()
+        rows = database.query(dbconn,
+                  r"""SELECT DISTINCT package, 0 AS source
+                      FROM packages
+                      WHERE release = ANY(%(release)s)
+                    UNION
+                    SELECT DISTINCT source, 1 AS source
+                      FROM sources
+                      WHERE release = ANY(%(release)s)""",
+                  dict(release=list(self.release)))
+        binaries = []
+        sources = []
+        for name, source in rows:
+            if source:
+                sources.append(intern(name))
+            else:
+                binaries.append(intern(name))
+        binaries.sort()
+        sources.sort()
+        self.binaries = binaries
+        self.sources = sources
+        self.built = time.time()
+        self.build_time = (self.built - start) * 1000
+        self.bytes = _sizeof(binaries) + _sizeof(sources)
+
+    def contains(self, package, binary=True, source=False):
+        """Test if there is a package of that name in the release
+
+        binary, source: the kinds of package to look for
+
+        The names that are not found are counted as rejected lookups.
+        """
+        found = binary and _contains(self.binaries, package) or \
+                    source and _contains(self.sources, package)
+        if not found:
+            self.rejected += 1
+        return found
+
+    def suggest(self, package, binary=True, source=False, n=3):
+        """Return up to n names in the release that are near to a name
+
+        binary, source: the kinds of package whose names are suggested
+
+        Only the names that start with the same letter are compared, so
+        that the lists are not scanned; they are also more likely to be
+        what was meant.
+        """
+        names = set()
+        for wanted, l in ((binary, self.binaries), (source, self.sources)):
+            if wanted and package:
+                lo = bisect.bisect_left(l, package[:1])
+                hi = bisect.bisect_left(l, package[:1] + '\x7f')
+                names.update(l[lo:hi])
+        return difflib.get_close_matches(package, sorted(names), n, 0.7)
+
+    def stats(self):
+        """Return the size of the index and the time taken to build it"""
+        return {
+                'release': self.release,
+                'binaries': len(self.binaries),
+                'sources': len(self.sources),
+                'rejected': self.rejected,
+                'build_ms': self.build_time,
+                'bytes': self.bytes,
+                'age': self.built and time.time() - self.built,
+               }
+
+
+def _contains(names, package):
+    i = bisect.bisect_left(names, package)
+    return i < len(names) and names[i] == package
+
+
+class NameRegistry(ProvidesRegistry):
+    """The name indexes of each release"""
+
+    def index(self, dbconn, release, arch=None):
+        """Return the index for the release, building it if needed
+
+        The index is the same for all architectures.
+        """
+        return ProvidesRegistry.index(self, dbconn, release, None)
+
+    def current(self, release):
+        """Return the index for the release if it has been built or None"""
+        with self._lock:
+            idx = self._indexes.get((tuple(release), None))
+        if self._stale(idx):
+            return None
+        return idx
+
+    def _make(self, release, arch):
+        return NameIndex(release)
+
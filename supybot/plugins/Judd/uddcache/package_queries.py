@@ -35,6 +35,10 @@
 ###
 
 from udd import Udd
+import database
+from rows import RowCursor
+from versions import version_key
+from engine import Query, Call, Return, synchronous, asynchronous
 from packages import *
 from relations import *
 from resolver import *
@@ -46,14 +50,22 @@ except:
     from debian_bundle import debian_support
 
 
-class Commands(object):
+class Queries(object):
+    """
+    The package queries, written as plans (see engine.py)
+
+    Use Commands to run them synchronously or AsyncCommands to run them on
+    the event loop of an AsyncUdd. The plans check for imports into UDD
+    with Udd.check_imports_plan() and then take their releases from
+    Udd.releases, since Udd.BindRelease would poll UDD on the event loop.
+    """
 
     def __init__(self, udd):
         self.udd = udd
 
     def versions(self, package, release, arch):
-        c = self.udd.psql.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        if package.startswith('src:'):
+        source = package.startswith('src:')
+        if source:
             packagename = package[4:]
             sql = r"""SELECT DISTINCT release,version,component
                       FROM sources
@@ -69,23 +81,34 @@ class Commands(object):
             if release:
                 sql += " AND release=%(release)s"
 
-        sql += ' ORDER BY version'
-        c.execute(sql,
+        yield self.udd.check_imports_plan()
+        r = release and self.udd.releases.get(release, arch)
+        if r and not r.exists(packagename, not source, source):
+            raise r.not_found(packagename, not source, source)
+        pkgs = yield Query(sql,
                   dict(package=packagename,
                        arch=arch,
-                       release=release))
-
-        pkgs = c.fetchall()
+                       release=release),
+                  cursor_factory=RowCursor, cache=True)
+        if not pkgs and r:
+            e = yield Call(r.not_found, packagename, not source, source)
+            raise e
         if not pkgs:
             raise PackageNotFoundError(package)
 
-        return pkgs
+        # sorted here by the memoised version keys rather than by the server
+        raise Return(sorted(pkgs, key=lambda row: version_key(row['version'])))
 
     def info(self, package, release, arch):
-        c = self.udd.psql.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        c.execute(r"""SELECT p.section, p.priority, p.version,
-                      p.size, p.installed_size, p.description,
-                      p.homepage, s.screenshot_url
+        columns = ", ".join(["p." + c for c in
+                                PROFILES['packages']['display']])
+        # names known to be absent are rejected without a query
+        yield self.udd.check_imports_plan()
+        r = self.udd.releases.get(release, arch)
+        if not r.exists(package):
+            raise r.not_found(package)
+        pkg = yield Query(
+                   r"""SELECT """ + columns + """, s.screenshot_url
                     FROM packages as p
                       LEFT JOIN screenshots as s ON p.package=s.package
                     WHERE p.package=%(package)s AND
@@ -93,19 +116,18 @@ class Commands(object):
                       p.release=%(release)s""",
                    dict(package=package,
                          arch=arch,
-                         release=release))
-
-        pkg = c.fetchone()
+                         release=release),
+                   cursor_factory=RowCursor, one=True,
+                   cache=True)
         if not pkg:
-            raise PackageNotFoundError(package)
-        return pkg
+            e = yield Call(r.not_found, package)
+            raise e
+        raise Return(pkg)
 
     def names(self, package, release, arch):
         """
         Search package names with * and ? as wildcards.
         """
-        c = self.udd.psql.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
         packagesql = package.replace("*", "%")
         packagesql = packagesql.replace("?", "_")
 
@@ -125,34 +147,39 @@ class Commands(object):
                         release=%(release)s
                       ORDER BY package"""
 
-        c.execute(sql,
+        rows = yield Query(sql,
                   dict(package=packagesql,
                        arch=arch,
-                       release=release))
-        return c.fetchall()
+                       release=release),
+                  cursor_factory=RowCursor, cache=True)
+        raise Return(rows)
 
     def archs(self, package, release):
         """
         Find in which architectures a package is available.
         """
-        c = self.udd.psql.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        c.execute(r"""SELECT architecture, version
+        yield self.udd.check_imports_plan()
+        r = self.udd.releases.get(release)
+        if not r.exists(package):
+            raise r.not_found(package)
+        archs = yield Query(
+                   r"""SELECT architecture, version
                       FROM packages
                       WHERE package=%(package)s
                         AND release=%(release)s""",
                    dict(package=package,
-                        release=release))
-        archs = c.fetchall()
+                        release=release),
+                   cursor_factory=RowCursor, cache=True)
         if not archs:
-            raise PackageNotFoundError(package)
-        return archs
+            e = yield Call(r.not_found, package)
+            raise e
+        raise Return(archs)
 
     def uploads(self, package, version="", max=0):
         """
         Return the dates and versions of recent uploads of the specified source
         package.
         """
-        c = self.udd.psql.cursor(cursor_factory=psycopg2.extras.DictCursor)
         if type(package) == str:
             p = package
         else:
@@ -166,14 +193,14 @@ class Commands(object):
         if max:
             sql += """ ORDER BY date DESC LIMIT %(max)s"""
 
-        c.execute(sql,
+        ups = yield Query(sql,
                   dict(package=p,
                        version=version,
-                       max=max))
-        ups = c.fetchall()
+                       max=max),
+                  cursor_factory=RowCursor, cache=True)
         if not ups:
             raise PackageNotFoundError(package)
-        return ups
+        raise Return(ups)
 
     def popcon(self, package):
         """
@@ -181,15 +208,16 @@ class Commands(object):
         binary package.
         See also: http://popcon.debian.org/FAQ
         """
-        c = self.udd.psql.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        c.execute(r"""SELECT insts, vote, olde, recent, nofiles
+        data = yield Query(
+                  r"""SELECT insts, vote, olde, recent, nofiles
                       FROM popcon
                       WHERE package=%(package)s""",
-                  dict(package=package))
-        data = c.fetchone()
+                  dict(package=package),
+                  cursor_factory=RowCursor, one=True,
+                  cache=True)
         if not data:
             raise PackageNotFoundError(package)
-        return data
+        raise Return(data)
 
     def checkdeps(self, package, release, arch, relations):
         """
@@ -197,23 +225,65 @@ class Commands(object):
         specified release and architecture.
         """
         releases = self.udd.data.list_dependent_releases(release)
-        r = self.udd.BindRelease(arch=arch, release=releases)
+        yield self.udd.check_imports_plan()
+        r = self.udd.releases.get(releases, arch)
         relchecker = Checker(r)
+        # look up the packages named in all of the relations in one go
+        yield Call(relchecker.Prefetch, package, relations)
 
         statusdict = {}
         for rel in relations:
             # raises PackageNotFoundError if package not found
-            status = relchecker.Check(package, rel)
+            status = yield Call(relchecker.Check, package, rel)
             statusdict[rel] = status
-        return statusdict
+        raise Return(statusdict)
+
+    def checkdeps_arches(self, package, release, arches, relations):
+        """
+        Check the dependencies of a package in several architectures
+
+        The package and the packages named in its relationships are looked
+        up in all the architectures at once (see ReleaseArches) rather than
+        for each architecture in turn.
+        Returns a dict of architecture to the statusdict of checkdeps for
+        each of the architectures in which the package exists.
+        """
+        releases = self.udd.data.list_dependent_releases(release)
+        yield self.udd.check_imports_plan()
+        ra = self.udd.releases.arches(releases,
+                                      arches or self.udd.data.list_arches())
+        yield Call(ra.prefetch, [package])
+        checkers = {}
+        wanted = []
+        for r in ra.releases:
+            if r.Package(package).Found():
+                checkers[r.arch] = Checker(r)
+                wanted.extend(checkers[r.arch].RelatedPackages(package,
+                                                               relations))
+        if not checkers:
+            e = yield Call(ra.releases[0].not_found, package)
+            raise e
+        # look up the packages named in the relations in all the arches
+        yield Call(ra.prefetch, wanted)
+        yield Call(ra.prefetch_providers)
+
+        statusdicts = {}
+        for arch, relchecker in checkers.items():
+            statusdict = {}
+            for rel in relations:
+                status = yield Call(relchecker.Check, package, rel)
+                statusdict[rel] = status
+            statusdicts[arch] = statusdict
+        raise Return(statusdicts)
 
     def checkInstall(self, package, release, arch, withrecommends):
         releases = self.udd.data.list_dependent_releases(release)
-        r = Release(self.udd.psql, arch=arch, release=releases)
+        yield self.udd.check_imports_plan()
+        r = self.udd.releases.get(releases, arch)
         relchecker = InstallChecker(r)
         # raises PackageNotFoundError if package not found
-        solverh = relchecker.Check(package, withrecommends)
-        return solverh
+        solverh = yield Call(relchecker.Check, package, withrecommends)
+        raise Return(solverh)
 
     def checkBackport(self, package, fromrelease, torelease):
         """
@@ -223,9 +293,10 @@ class Commands(object):
         """
         relchecker = BuildDepsChecker(torelease)
 
-        s = fromrelease.Source(package)
+        s = yield Call(fromrelease.ResolveSource, package)
         # raises PackageNotFoundError if package not found
-        return relchecker.Check(s)
+        status = yield Call(relchecker.Check, s)
+        raise Return(status)
 
     def why(self, package1, package2, release, arch, withrecommends):
         """
@@ -243,11 +314,38 @@ class Commands(object):
         BUGS: check that package2 exists before doing expensive work?
         """
         releases = self.udd.data.list_dependent_releases(release)
-        r = Release(self.udd.psql, arch=arch, release=releases)
+        yield self.udd.check_imports_plan()
+        r = self.udd.releases.get(releases, arch)
         relchecker = InstallChecker(r)
         # raises PackageNotFoundError if package not found
-        solverh = relchecker.Check(package1, withrecommends)
+        solverh = yield Call(relchecker.Check, package1, withrecommends)
 
         chains = solverh.chains()
         chains = chains.truncated(package2).unique().sorted()
-        return chains
+        raise Return(chains)
+
+
+@database.query_origins
+@synchronous
+class Commands(Queries):
+    """
+    The package queries, each returning its result
+
+    Typical usage:
+        dispatcher = Commands(Udd())
+        print dispatcher.popcon('dpkg')
+    """
+    pass
+
+
+@asynchronous
+class AsyncCommands(Queries):
+    """
+    The package queries, each returning an engine.Future for its result
+
+    Typical usage:
+        dispatcher = AsyncCommands(AsyncUdd())
+        future = dispatcher.popcon('dpkg')
+        future.add_done_callback(lambda f: reply(f.result()))
+    """
+    pass
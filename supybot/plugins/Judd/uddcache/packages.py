@@ -32,40 +32,216 @@
 ###
 
 import re
+import sys
+import threading
+import collections
 import psycopg2
-import psycopg2.extras
-from psycopg2.extensions import adapt
+import database
+import provides
+import sourcemap
+import nameindex
+from cache import _sizeof
+from rows import RowCursor
+from versions import version_key, satisfies
 from relations import *
 
 
 class Release(object):
     """ Class that represents the contents of a release
     i.e lists of binary and source packages """
-    def __init__(self, dbconn, arch="i386", release="lenny", pins=None):
+    def __init__(self, dbconn, arch="i386", release="lenny", pins=None,
+                 cache=None, profile='relations', slices=None,
+                 provides_registry=None, sourcemap_registry=None,
+                 name_registry=None):
+        """
+        cache: ObjectCache in which to keep the packages that have been
+                looked up or None to keep them for the life of this object
+        profile: name of the set of columns of the packages that are read
+                when they are looked up (see PROFILES) or None to read all
+                the columns at once; the other columns are read if they
+                are used
+        slices: SliceStore holding releases that are kept in memory; the
+                packages of a release without pins that is held there are
+                looked up without queries (see slices.py)
+        provides_registry: ProvidesRegistry holding the indexes of virtual
+                packages of the database (see provides.py), shared by its
+                Releases; by default the Release has a registry of its own
+        sourcemap_registry: SourceMapRegistry holding the maps of binary to
+                source packages of the database (see sourcemap.py), shared
+                in the same way
+        name_registry: NameRegistry holding the indexes of the names of the
+                packages of the database (see nameindex.py), shared in the
+                same way
+        """
         self.dbconn = dbconn
+        self.profile = profile
+        self.slices = slices
+        if provides_registry is None:
+            provides_registry = provides.ProvidesRegistry()
+        self.provides_registry = provides_registry
+        if sourcemap_registry is None:
+            sourcemap_registry = sourcemap.SourceMapRegistry()
+        self.sourcemap_registry = sourcemap_registry
+        if name_registry is None:
+            name_registry = nameindex.NameRegistry()
+        self.name_registry = name_registry
         self.arch = arch
-        if type(release) is tuple:
-            self.release = release
-        elif type(release) is list:
-            self.release = tuple(release)
-        else:
-            self.release = (release,)
+        self.key = release_key(release, arch, pins)
+        self.release = self.key[0]
         self.pins = pins
-        self.cache = {}
-        self.scache = {}
+        if cache is None:
+            self.cache = {}
+            self.scache = {}
+            self.candidates = {}
+            self.resolved = {}
+        else:
+            self.cache = cache.namespace(self.key + ('binary',))
+            self.scache = cache.namespace(self.key + ('source',))
+            self.candidates = cache.namespace(self.key + ('candidates',))
+            self.resolved = cache.namespace(self.key + ('resolved',))
 
     def Package(self, package, version=None, operator=None):
         """Look up a binary package by name in the current release.
             package: name of the package (string)
             returns Package object
+
+        All the versions of the package in the release are loaded the first
+        time that it is looked up (see Candidates); the version constraint
+        is then tested against them without further queries.
         """
         phash = self._mkpackagehash(package, operator, version)
-        if not phash in self.cache:
-            self.cache[phash] = Package(self.dbconn, arch=self.arch, \
+        p = self.cache.get(phash)
+        if p is None:
+            if version and operator and not operator in sql_operators:
+                raise ValueError("Illegal version operator: %s" % operator)
+            p = Package(self.dbconn, arch=self.arch, \
                                   release=self.release, package=package, \
                                   pins=self.pins,
-                                  version=version, operator=operator)
-        return self.cache[phash]
+                                  version=version, operator=operator,
+                                  fetch=False)
+            p.data = None
+            p.index = self._Slice()
+            p.registry = self.provides_registry
+            for row in self.Candidates(package):
+                if not (version and operator) or \
+                        satisfies(row['version'], operator, version):
+                    p.data = row
+                    break
+            self.cache[phash] = p
+        return p
+
+    def Packages(self, packages):
+        """Look up several binary packages at once in the current release.
+            packages: list of names of packages or of
+                      (name, operator, version) tuples
+            returns list of Package objects
+
+        The packages are prefetched together (see prefetch) before being
+        looked up.
+        """
+        packages = [self._split(p) for p in packages]
+        self.prefetch(packages)
+        return [self.Package(name, version=version, operator=operator)
+                    for name, operator, version in packages]
+
+    def Candidates(self, package):
+        """All the versions of a binary package in the current release.
+            package: name of the package (string)
+            returns list of rows of the packages table, best first
+
+        The versions are ordered by pin (if any) and then by version.
+        """
+        sl = self._Slice()
+        if sl is not None:
+            return sl.candidates(package)
+        rows = self.candidates.get(package)
+        if rows is None:
+            if not self.exists(package):
+                return []
+            rows = self._LoadCandidates([package])[package]
+        return rows
+
+    def prefetch(self, packages):
+        """Look up many binary packages at once in the current release.
+            packages: list of names of packages or of
+                      (name, operator, version) tuples
+
+        All the versions of the packages that have not already been loaded
+        are found with a single query, respecting the pins, so that
+        Package() needs no further queries for them.
+        """
+        packages = [self._split(p) for p in packages]
+        names = set([name for name, operator, version in packages
+                        if not name in self.candidates and self.exists(name)])
+        if names and self._Slice() is None:
+            self._LoadCandidates(names)
+        for name, operator, version in packages:
+            self.Package(name, version=version, operator=operator)
+
+    def _LoadCandidates(self, names):
+        return self._StoreCandidates(names,
+                                     self._QueryCandidates(names, [self.arch]))
+
+    def _QueryCandidates(self, names, arches):
+        """ The rows of the packages in the release in some architectures """
+        params = dict(packages=sorted(names),
+                      arches=list(arches),
+                      release=list(self.release))
+        pin, order = _pin_order(self.pins, self.release, params)
+        rows = database.query(self.dbconn,
+                   r"""SELECT """ + self._Columns('packages') + pin + """
+                      FROM packages
+                      WHERE package = ANY(%(packages)s)
+                        AND (architecture='all'
+                                OR architecture = ANY(%(arches)s))
+                        AND release = ANY(%(release)s)
+                      ORDER BY package, """ + order + """version DESC""",
+                   params, cursor_factory=RowCursor,
+                   prepare=True)
+        return self._Lazy('packages', rows)
+
+    def _StoreCandidates(self, names, rows):
+        """ Keep the rows as the candidates of the packages """
+        found = dict([(name, []) for name in names])
+        for row in rows:
+            found.setdefault(row['package'], []).append(row)
+        for name, candidates in found.items():
+            self.candidates[name] = candidates
+        return found
+
+    def prefetch_sources(self, packages):
+        """Look up many source packages at once in the current release.
+            packages: list of names of source packages
+
+        As for prefetch(), the newest version of each source package that is
+        not already in the cache is found with a single query.
+        """
+        wanted = {}
+        for name in packages:
+            phash = self._mkpackagehash(name, None, None)
+            if not phash in self.scache:
+                wanted[name] = phash
+        if not wanted:
+            return
+        rows = database.query(self.dbconn,
+                   r"""SELECT DISTINCT ON (source) """ +
+                        self._Columns('sources') + """
+                      FROM sources
+                      WHERE source = ANY(%(packages)s)
+                        AND release = ANY(%(release)s)
+                      ORDER BY source, version DESC""",
+                   dict(packages=sorted(wanted.keys()),
+                        release=list(self.release)),
+                   cursor_factory=RowCursor,
+                   prepare=True)
+        rows = self._Lazy('sources', rows)
+        found = dict([(row['source'], row) for row in rows])
+        for name, phash in wanted.items():
+            p = SourcePackage(self.dbconn, arch=self.arch,
+                              release=self.release, package=name,
+                              pins=self.pins, fetch=False)
+            p.data = found.get(name)
+            self.scache[phash] = p
 
     def Source(self, package, autoBin2Src=True, version=None, operator=None):
         """Look up a source package by name in the current release.
@@ -73,34 +249,138 @@ class Release(object):
             autoBin2Src: (default true) convert names of binary packages to
                             source packages automatically if needed
             returns Package object
+
+        With autoBin2Src, the source package of that name and the source
+        of the binary package of that name (see bin2src) are looked up
+        together so that a single query is needed either way.
         """
         phash = self._mkpackagehash(package, operator, version)
-        if not phash in self.scache:
-            self.scache[phash] = SourcePackage(self.dbconn, arch=self.arch, \
+        p = self.scache.get(phash)
+        if p is None and not self.exists(package, binary=autoBin2Src,
+                                         source=True):
+            raise self.not_found(package, binary=autoBin2Src, source=True)
+        if p is None and autoBin2Src and not (version or operator):
+            names = [package]
+            source = self.sourcemap().source(package)
+            if source and source != package and \
+                    not self.sourcemap().is_source(package):
+                names.append(source)
+            self.prefetch_sources(names)
+            p = self.scache.get(phash)
+        if p is None:
+            p = SourcePackage(self.dbconn, arch=self.arch, \
                                   release=self.release, package=package,
                                   pins=self.pins,
                                   version=version, operator=operator)
-            if autoBin2Src and not self.scache[phash].Found():
-                p = self.bin2src(package)
-                return self.Source(p, False)
-        if not self.scache[phash].Found():
-            raise PackageNotFoundError(package)
-        return self.scache[phash]
+            self.scache[phash] = p
+        if autoBin2Src and not p.Found():
+            return self.Source(self.bin2src(package), False)
+        if not p.Found():
+            raise self.not_found(package, binary=False, source=True)
+        return p
+
+    def ResolveSource(self, package):
+        """Look up a source package and its binary packages by either name
+            package: name of a source package or of a binary package
+            returns SourcePackage object whose Binaries() are already known
+
+        The source package of that name, or else the source of the binary
+        package of that name, is found together with the names of its
+        binary packages by a single query, needing neither the map of
+        binary to source packages nor a query for the binaries.
+        """
+        source = self.resolved.get(package)
+        if source is not None:
+            p = self.scache.get(self._mkpackagehash(source, None, None))
+            if p is not None and p._BinariesList is not None:
+                return p
+        if not self.exists(package, binary=True, source=True):
+            raise self.not_found(package, binary=True, source=True)
+        params = dict(package=package, release=list(self.release))
+        rows = database.query(self.dbconn,
+                   r"""WITH wanted AS (
+                          SELECT source FROM (
+                              SELECT 0 AS priority, source
+                                FROM sources
+                                WHERE source = %(package)s
+                                  AND release = ANY(%(release)s)
+                              UNION ALL
+                              SELECT 1 AS priority, source
+                                FROM packages
+                                WHERE package = %(package)s
+                                  AND release = ANY(%(release)s)
+                            ) AS names
+                          ORDER BY priority
+                          LIMIT 1),
+                        bins AS (
+                          SELECT DISTINCT package AS binary_name,
+                                 source AS binary_source
+                            FROM packages
+                            WHERE source IN (SELECT source FROM wanted)
+                              AND release = ANY(%(release)s))
+                      SELECT """ + self._Columns('sources') + """,
+                             binary_name
+                        FROM sources LEFT JOIN bins
+                          ON binary_source = source
+                        WHERE source IN (SELECT source FROM wanted)
+                          AND release = ANY(%(release)s)
+                        ORDER BY version DESC, binary_name""",
+                   params, cursor_factory=RowCursor,
+                   prepare=True)
+        if not rows:
+            raise self.not_found(package, binary=True, source=True)
+        rows = self._Lazy('sources', rows)
+        newest = rows[0]
+        p = SourcePackage(self.dbconn, arch=self.arch, release=self.release,
+                          package=newest['source'], pins=self.pins,
+                          fetch=False)
+        p.data = newest
+        p._BinariesList = [row['binary_name'] for row in rows
+                            if row['version'] == newest['version'] and
+                                row['binary_name'] is not None]
+        self.scache[self._mkpackagehash(p.package, None, None)] = p
+        self.resolved[package] = p.package
+        return p
 
     def bin2src(self, package):
-        """Returns the source package for a given binary package"""
-        c = self.dbconn.cursor()
-        c.execute(r"""SELECT source
-                      FROM packages
-                      WHERE package=%(package)s
-                        AND release IN %(release)s LIMIT 1""",
-                   dict(package=package,
-                         release=self.release))
-        row = c.fetchone()
-        if row:
-            return row[0]
-        else:
-            raise PackageNotFoundError(package)
+        """Returns the source package for a given binary package
+
+        The source is found in the resident slice of the release or in the
+        map of binary to source packages of the release (see sourcemap.py)
+        rather than by a query.
+        """
+        sl = self._Slice()
+        source = sl and sl.source(package) or \
+                    self.sourcemap().source(package)
+        if source is None:
+            raise self.not_found(package)
+        return source
+
+    def exists(self, package, binary=True, source=False):
+        """Test whether a package might be in the current release
+            binary, source: the kinds of package of that name to look for
+
+        The package is only known to be absent once the index of the names
+        of the release has been built (see nameindex.py and not_found), in
+        which case it need not be looked for with a query.
+        """
+        idx = self.name_registry.current(self.release)
+        return idx is None or idx.contains(package, binary, source)
+
+    def not_found(self, package, binary=True, source=False):
+        """PackageNotFoundError for a package, suggesting near names
+            binary, source: the kinds of package whose names are suggested
+
+        The index of the names of the release is built if it has not been,
+        so that later lookups of absent names need no queries.
+        """
+        idx = self.name_registry.index(self.dbconn, self.release)
+        return PackageNotFoundError(package,
+                                    idx.suggest(package, binary, source))
+
+    def sourcemap(self):
+        """Returns the map of binary to source packages for the release"""
+        return self.sourcemap_registry.index(self.dbconn, self.release)
 
     def arch_applies(self, proposed):
         def kern_arch_split(archspec):
@@ -121,15 +401,343 @@ class Release(object):
             return skern == pkern
         return parch == sarch and pkern == skern
 
+    def _Columns(self, table):
+        if self.profile is None:
+            return '*'
+        return ','.join(PROFILES[table][self.profile])
+
+    def _Lazy(self, table, rows):
+        """ Wrap rows of the profile's columns to read the others on use """
+        if self.profile is None:
+            return rows
+        load = row_loader(self.dbconn, table)
+        return [LazyRow(row, load) for row in rows]
+
+    def _Slice(self):
+        """ The resident slice of the release's packages, if there is one """
+        if self.slices is None or self.pins:
+            return None
+        return self.slices.get(self.release, self.arch)
+
     def _mkpackagehash(self, package, operator, version):
         return "%s|%s|%s" % (package, operator, version)
 
+    def _split(self, package):
+        if isinstance(package, basestring):
+            return (package, None, None)
+        return package
+
     def __str__(self):
         return "Release: %s.\n" \
                 "\t%d binary packages and %d source packages in cache." % \
                         (self.release, len(self.cache), len(self.scache))
 
 
+class ReleaseArches(object):
+    """ A release in several architectures, looked up in all of them at once
+
+    The packages are looked up in all the architectures with one query
+    rather than with one for each architecture, the rows of the packages
+    of architecture 'all' being shared between them. Each architecture's
+    Release is then used as usual without further queries for those
+    packages.
+
+    Typical usage:
+        ra = udd.BindArches('sid', ['amd64', 'armel', 'i386'])
+        ra.prefetch(['libc6', 'dpkg'])
+        for arch, p in ra.Package('dpkg').items():
+            print arch, p.Found()
+    """
+    def __init__(self, releases):
+        """
+        releases: the Release objects of the architectures, all having the
+                same release and pins
+        """
+        self.releases = releases
+        self.arches = [r.arch for r in releases]
+
+    def Release(self, arch):
+        """ The Release object of one of the architectures """
+        return self.releases[self.arches.index(arch)]
+
+    def Package(self, package, version=None, operator=None):
+        """Look up a binary package by name in all the architectures
+            returns a dict of architecture to Package object
+        """
+        return dict([(r.arch, r.Package(package, version, operator))
+                        for r in self.releases])
+
+    def prefetch(self, packages):
+        """Look up many binary packages at once in all the architectures
+            packages: list of names of packages or of
+                      (name, operator, version) tuples
+
+        The packages that have not already been loaded in some of the
+        architectures are found for all of those architectures with a
+        single query (see Release.prefetch).
+        """
+        if not self.releases:
+            return
+        packages = [self.releases[0]._split(p) for p in packages]
+        names = set()
+        wanted = []
+        for r in self.releases:
+            if r._Slice() is not None:
+                continue
+            missing = [name for name, operator, version in packages
+                            if not name in r.candidates and r.exists(name)]
+            if missing:
+                names.update(missing)
+                wanted.append(r)
+        if names:
+            rows = wanted[0]._QueryCandidates(names,
+                                              [r.arch for r in wanted])
+            for r in wanted:
+                r._StoreCandidates(names, [row for row in rows
+                        if row['architecture'] in ('all', r.arch)])
+        for r in self.releases:
+            for name, operator, version in packages:
+                r.Package(name, version=version, operator=operator)
+
+    def prefetch_providers(self):
+        """Build the provides indexes of all the architectures at once
+
+        The indexes that are not already built are read with a single
+        query (see provides.py); those of the architectures held in memory
+        are not needed.
+        """
+        arches = [r.arch for r in self.releases if r._Slice() is None]
+        if arches:
+            r = self.releases[0]
+            r.provides_registry.indexes(r.dbconn, r.release, arches)
+
+
+def release_key(release, arch, pins=None):
+    """ The key of a Release: its tuple of release names, arch and pins """
+    if type(release) is list:
+        release = tuple(release)
+    elif type(release) is not tuple:
+        release = (release,)
+    return (release, arch, pins and tuple(sorted(pins.items())))
+
+
+class ReleaseRegistry(object):
+    """ The Release objects bound to a database, by release, arch and pins
+
+    All the Releases keep their packages in the one ObjectCache, so that the
+    packages that have been looked up stay available between commands
+    within the limits set on the cache.
+    """
+    def __init__(self, dbconn, cache, profile='relations', slices=None,
+                 provides_registry=None, sourcemap_registry=None,
+                 name_registry=None):
+        self.dbconn = dbconn
+        self.cache = cache
+        self.profile = profile
+        self.slices = slices
+        if provides_registry is None:
+            provides_registry = provides.ProvidesRegistry()
+        self.provides_registry = provides_registry
+        if sourcemap_registry is None:
+            sourcemap_registry = sourcemap.SourceMapRegistry()
+        self.sourcemap_registry = sourcemap_registry
+        if name_registry is None:
+            name_registry = nameindex.NameRegistry()
+        self.name_registry = name_registry
+        self._releases = {}
+        self._lock = threading.Lock()
+
+    def get(self, release="lenny", arch="i386", pins=None):
+        """Return the Release for the release, arch and pins"""
+        key = release_key(release, arch, pins)
+        with self._lock:
+            r = self._releases.get(key)
+        if r is not None:
+            return r
+        r = Release(self.dbconn, arch=arch, release=release, pins=pins,
+                    cache=self.cache, profile=self.profile,
+                    slices=self.slices,
+                    provides_registry=self.provides_registry,
+                    sourcemap_registry=self.sourcemap_registry,
+                    name_registry=self.name_registry)
+        with self._lock:
+            return self._releases.setdefault(key, r)
+
+    def arches(self, release, arches, pins=None):
+        """Return the ReleaseArches for the release in the arches"""
+        return ReleaseArches([self.get(release, arch, pins)
+                                for arch in arches])
+
+    def flush(self):
+        """Drop all the cached packages, e.g. once UDD has been updated"""
+        self.cache.flush()
+
+    def stats(self):
+        """Return the usage counters of the cache of packages"""
+        s = self.cache.stats()
+        s['releases'] = len(self._releases)
+        return s
+
+
+def package_size(value):
+    """ Estimate the number of bytes of memory used by a cached package
+
+    value: Package object or list of candidate rows for a package
+    """
+    size = 0
+    if isinstance(value, AbstractPackage):
+        size = sys.getsizeof(value.__dict__)
+        value = [value.data]
+    return size + sum([_sizeof(getattr(row, '_row', row)) for row in value])
+
+
+# SQL equivalents of the version comparison operators used in relationships
+sql_operators = {
+                    '>>': '>',
+                    '>=': '>=',
+                    '=':  '=',
+                    '<=': '<=',
+                    '<<': '<',
+                }
+
+# The columns that identify a row of the packages and sources tables
+KEYS = {
+        'packages': ['package', 'version', 'architecture', 'distribution',
+                     'release', 'component'],
+        'sources': ['source', 'version', 'distribution', 'release',
+                    'component'],
+       }
+
+# The columns read for the packages looked up for different uses; the rows
+# are wrapped in a LazyRow so that the other columns can still be used.
+#   relations: checking the relationships between packages (Checkers)
+#   display: showing the details of a package (info)
+PROFILES = {
+        'packages': {
+            'relations': KEYS['packages'] + ['source', 'provides',
+                            'depends', 'pre_depends', 'recommends',
+                            'suggests', 'enhances', 'conflicts', 'breaks',
+                            'replaces'],
+            'display': KEYS['packages'] + ['section', 'priority', 'size',
+                            'installed_size', 'description', 'homepage'],
+        },
+        'sources': {
+            'relations': KEYS['sources'] + ['architecture', 'build_depends',
+                            'build_depends_indep', 'build_conflicts',
+                            'build_conflicts_indep'],
+        },
+    }
+
+
+def row_loader(dbconn, table):
+    """ Return a function that reads the whole of a partial row of a table
+
+    The row is found by the columns in KEYS (see LazyRow).
+    """
+    keys = KEYS[table]
+    sql = r"""SELECT * FROM """ + table + """
+              WHERE """ + " AND ".join(["%s=%%(%s)s" % (k, k) for k in keys])
+
+    def load(row):
+        return database.query(dbconn, sql, dict([(k, row[k]) for k in keys]),
+                    cursor_factory=RowCursor, one=True,
+                    prepare=True)
+    return load
+
+
+class LazyRow(object):
+    """ Some of the columns of a row, reading the rest when first used
+
+    The row is accessed by column name as for the rows of a RowCursor (see
+    rows.py), and as for those rows it iterates over its values. When a
+    column that was not read is used, or all the columns are wanted, the
+    whole row is read with the load function, which is given the partial
+    row.
+    """
+    __slots__ = ('_row', '_load')
+
+    def __init__(self, row, load):
+        self._row = row
+        self._load = load
+
+    def _Full(self):
+        if self._load is not None:
+            full = self._load(self._row)
+            row = collections.OrderedDict(self._row.items())
+            if full is not None:
+                row.update(full.items())
+            self._row = row
+            self._load = None
+
+    def __getitem__(self, key):
+        try:
+            return self._row[key]
+        except KeyError:
+            if self._load is None:
+                raise
+        self._Full()
+        return self._row[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if not key in self._row:
+            self._Full()
+        return key in self._row
+
+    def has_key(self, key):
+        return key in self
+
+    def __len__(self):
+        self._Full()
+        return len(self._row)
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def keys(self):
+        self._Full()
+        return self._row.keys()
+
+    def values(self):
+        self._Full()
+        return self._row.values()
+
+    def items(self):
+        self._Full()
+        return self._row.items()
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "LazyRow(%r)" % dict(self._row.items())
+
+
+def _pin_order(pins, release, params):
+    """ SQL to select and order by the pin of each package's release
+
+    Returns the extra column and the ORDER BY prefix; the pins are added to
+    params.
+    """
+    if not pins or not release:
+        return '', ''
+    cases = []
+    for i, r in enumerate(sorted(pins.keys())):
+        cases.append("WHEN release = %%(pinrel%d)s "
+                     "THEN %%(pin%d)s::integer" % (i, i))
+        params['pinrel%d' % i] = r
+        params['pin%d' % i] = pins[r]
+    return ", CASE %s ELSE 0 END AS pin" % ' '.join(cases), "pin DESC, "
+
+
 class AbstractPackage(object):
     fields = ['*']
     table = ''
@@ -138,7 +746,7 @@ class AbstractPackage(object):
     data = []
 
     def __init__(self, dbconn, arch="i386", release="lenny", package=None,
-                 pins=None, version=None, operator=None):
+                 pins=None, version=None, operator=None, fetch=True):
         """
         Bind a specified binary or source package.
 
@@ -152,6 +760,9 @@ class AbstractPackage(object):
 
         Note that the "pinning" used here is a very simple rank order not the
         sophisticated system used by apt as described in apt_preferences(5).
+
+        With fetch=False, the package data is not looked up; it must be set
+        from the query given by _FetchQuery() (see Release.prefetch).
         """
         if not package:
             raise ValueError("Package name not specified")
@@ -175,34 +786,41 @@ class AbstractPackage(object):
         self.pins = pins
         self.version = version
         self.operator = operator
-        self._Fetch()
+        if fetch:
+            self._Fetch()
 
     def _Fetch(self):
-        c = self.dbconn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        f = ','.join(self.fields)
-        pin = ''
-        if self.pins and self.release:
-            pin = "pin DESC, "
-            cases = ["WHEN release = %s THEN %s" % \
-                        (adapt(r), adapt(self.pins[r])) \
-                            for r in self.pins.keys()]
-            f += ", CASE %s ELSE 0 END AS pin" % ' '.join(cases)
+        sql, params = self._FetchQuery()
+        self.data = database.query(self.dbconn, sql, params,
+                   cursor_factory=RowCursor, one=True,
+                   prepare=True)
+
+    def _FetchQuery(self):
+        """Return the SQL and parameters that look up the package data"""
+        # The query text depends only on the number of pins and on whether
+        # a version constraint is given; all values are passed as parameters
+        # so that each shape is prepared once per connection.
+        params = dict(package=self.package,
+                      arch=self.arch,
+                      release=list(self.release))
+        pinfield, pin = _pin_order(self.pins, self.release, params)
+        f = ','.join(self.fields) + pinfield
         verwhere = ""
         if self.version and self.operator:
-            verwhere = "AND version %s debversion(%s)" % \
-                        (self.operator.replace('>>', '>').replace('<<', '<'),
-                            adapt(self.version))
-        c.execute(r"""SELECT """ + f + """
+            if not self.operator in sql_operators:
+                raise ValueError("Illegal version operator: %s" %
+                                 self.operator)
+            verwhere = "AND version %s debversion(%%(version)s)" % \
+                        sql_operators[self.operator]
+            params['version'] = self.version
+        sql = r"""SELECT """ + f + """
                       FROM """ + self.table + """
                       WHERE """ + self.column + """=%(package)s
                         AND (architecture='all' OR architecture=%(arch)s)
-                        AND release IN %(release)s """ + verwhere + """
+                        AND release = ANY(%(release)s) """ + verwhere + """
                       ORDER BY """ + pin + """version DESC
-                      LIMIT 1""",
-                   dict(package=self.package,
-                         arch=self.arch,
-                         release=self.release))
-        self.data = c.fetchone()
+                      LIMIT 1"""
+        return sql, params
 
     def Found(self):
         '''Does the package exist in the database for the release specified?
@@ -224,15 +842,14 @@ class AbstractPackage(object):
         rels = RelationshipOptionsList()
         l = self.RelationEntry(relation, combinePreDepends)
         if l:
-            for r in re.split(r"\s*,\s*", l):
-                roptions = RelationshipOptions(r)
-                rels.append(roptions)
+            for r, parsed in parse_relationships(l):
+                rels.append(RelationshipOptions(r, parsed))
         return rels
 
 
 class Package(AbstractPackage):
     def __init__(self, dbconn, arch="i386", release="lenny", package=None,
-                 pins=None, version=None, operator=None):
+                 pins=None, version=None, operator=None, fetch=True):
         """
         Bind a specified binary package from a releases, list of releases
         or tuple of releases
@@ -242,8 +859,11 @@ class Package(AbstractPackage):
         self.column = 'package'
         self._ProvidersList = None
         self.installable = None
+        self.index = None
+        self.registry = None
         AbstractPackage.__init__(self, dbconn, arch, release, package,
-                                 pins=pins, version=version, operator=operator)
+                                 pins=pins, version=version, operator=operator,
+                                 fetch=fetch)
 
     def IsVirtual(self):
         """Test if the package is a virtual package.
@@ -260,33 +880,22 @@ class Package(AbstractPackage):
         return self.Found() or self.IsVirtual()
 
     def ProvidersList(self):
+        """The names of the packages that provide this package
+
+        The providers are found in the index given as 'index' or in the
+        provides index of the release from the ProvidesRegistry given as
+        'registry' (see provides.py) rather than by searching the packages
+        table; a package that has neither searches the table.
+        """
         if self._ProvidersList == None:
-            # remove all characters from the package name that aren't legal in
-            # a package name i.e. not in:
-            #    a-z0-9-.+
-            # see §5.6.1 of Debian Policy "Source" for details.
-            # http://www.debian.org/doc/debian-policy/ch-controlfields.html#s-f-Source
-            #
-            # \m is start word boundary, \M is finish word boundary
-            # (but - in package name is a word boundary)
-            # \A is start string,        \Z is finish string
-            # http://www.postgresql.org/docs/8.3/static/functions-matching.html
-            packagere = r"(?:\A|[, ])%s(?:\Z|[, ])" % \
-                        re.escape(re.sub(r"[^a-z\d\-+.]", "", self.package))
-            # print packagere
-            c = self.dbconn.cursor()
-            c.execute(r"""SELECT DISTINCT package
-                          FROM packages
-                          WHERE provides ~ %(package)s
-                            AND (architecture='all' OR architecture=%(arch)s)
-                            AND release IN %(release)s""",
-                      dict(package=packagere,
-                            arch=self.arch,
-                            release=self.release))
-            pkgs = []
-            for row in c.fetchall():
-                pkgs.append(row[0])
-            self._ProvidersList = pkgs
+            if self.index is not None:
+                self._ProvidersList = self.index.providers(self.package)
+            elif self.registry is not None:
+                self._ProvidersList = self.registry.providers(
+                        self.dbconn, self.release, self.arch, self.package)
+            else:
+                self._ProvidersList = provides.find_providers(
+                        self.dbconn, self.release, self.arch, self.package)
         return self._ProvidersList
 
     def PreDepends(self):
@@ -344,38 +953,48 @@ class Package(AbstractPackage):
 
 class SourcePackage(AbstractPackage):
     def __init__(self, dbconn, arch="i386", release="lenny", package=None,
-                 pins=None, version=None, operator=None):
+                 pins=None, version=None, operator=None, fetch=True):
         #self.fields = ['build_depends', 'build_depends_indep', 'version']
         self.table = 'sources'
         self.column = 'source'
+        self._BinariesList = None
         #self.autobin2src = kwargs.get('bin2src', True)
         AbstractPackage.__init__(self, dbconn, arch, release, package,
-                                 pins=pins, version=version, operator=operator)
+                                 pins=pins, version=version, operator=operator,
+                                 fetch=fetch)
 
     def _Fetch(self):
-        c = self.dbconn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         f = ','.join(self.fields)
-        c.execute(r"""SELECT """ + f + """
+        self.data = database.query(self.dbconn,
+                   r"""SELECT """ + f + """
                       FROM """ + self.table + """
                       WHERE """ + self.column + """=%(package)s
-                        AND release IN %(release)s
+                        AND release = ANY(%(release)s)
                       ORDER BY version DESC
                       LIMIT 1""",
                    dict(package=self.package,
-                         release=self.release))
-        self.data = c.fetchone()
+                         release=list(self.release)),
+                   cursor_factory=RowCursor, one=True,
+                   prepare=True)
 
     def Binaries(self):
-        c = self.dbconn.cursor()
-        c.execute(r"""SELECT DISTINCT package
+        """The names of the binary packages built from this source package
+
+        The names are read with the package if it was looked up with
+        Release.ResolveSource.
+        """
+        if self._BinariesList is not None:
+            return self._BinariesList
+        rows = database.query(self.dbconn,
+                   r"""SELECT DISTINCT package
                       FROM packages
                       WHERE source=%(package)s
-                        AND release IN %(release)s""",
+                        AND release = ANY(%(release)s)""",
                    dict(package=self.package,
-                         arch=self.arch,
-                         release=self.release))
+                         release=list(self.release)),
+                   prepare=True)
         pkgs = []
-        for row in c.fetchall():
+        for row in rows:
             pkgs.append(row[0])
         return pkgs
 
@@ -395,8 +1014,9 @@ class SourcePackage(AbstractPackage):
 class PackageNotFoundError(LookupError):
     """Exception raised when a package is assumed to exist but doesn't"""
 
-    def __init__(self, package):
+    def __init__(self, package, suggestions=None):
         self.package = package
+        self.suggestions = suggestions or []
 
     def __str__(self):
         return "Package was not found: %s" % self.package
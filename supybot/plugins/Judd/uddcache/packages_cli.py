@@ -41,6 +41,7 @@ import clibase
 import udd
 import package_queries
 import bug_queries
+import snapshot
 
 from packages import PackageNotFoundError
 from bts import BugNotFoundError
@@ -74,6 +75,7 @@ class Cli(clibase.CliBase):
                 'checkinstall': self.checkinstall,
                 'checkbackport': self.checkbackport,
                 'why':          self.why,
+                'snapshot':     self.snapshot,
                 }
         self.command_aliases = {
                 'show':         'info',
@@ -89,8 +91,12 @@ class Cli(clibase.CliBase):
 
     @staticmethod
     def notfound(package, release=None, arch=None,
-                 message="No package named '%s' was found%s."):
-        """ print a message indicating that the package was not found """
+                 message="No package named '%s' was found%s.", error=None):
+        """ print a message indicating that the package was not found
+
+        error: the PackageNotFoundError, whose suggested names are added to
+                the message
+        """
         if release:
             if arch:
                 tag = " in %s/%s" % (release, arch)
@@ -101,7 +107,10 @@ class Cli(clibase.CliBase):
                 tag = " in %s" % arch
             else:
                 tag = ""
-        print message % (package, tag)
+        message = message % (package, tag)
+        if error is not None and error.suggestions:
+            message += " Did you mean: %s?" % ", ".join(error.suggestions)
+        print message
 
     def versions(self, command, package, args):
         """ look up the version of a package in a release or releases """
@@ -111,8 +120,8 @@ class Cli(clibase.CliBase):
 
         try:
             pkgs = self.dispatcher.versions(package, release, arch)
-        except PackageNotFoundError:
-            return self.notfound(package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, arch, error=e)
 
         replies = []
         for row in pkgs:
@@ -135,8 +144,8 @@ class Cli(clibase.CliBase):
 
         try:
             p = self.dispatcher.info(package, release, arch)
-        except PackageNotFoundError:
-            return self.notfound(package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, arch, error=e)
 
         print "Package: %s (%s, %s)" % \
                         (package, p['section'], p['priority'])
@@ -183,8 +192,8 @@ class Cli(clibase.CliBase):
 
         try:
             pkgs = self.dispatcher.archs(package, release)
-        except PackageNotFoundError:
-            return self.notfound(package, release)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, error=e)
 
         replies = []
         for row in pkgs:
@@ -253,8 +262,8 @@ class Cli(clibase.CliBase):
 
         try:
             p = r.bin2src(package)
-        except PackageNotFoundError:
-            return self.notfound(package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, arch, error=e)
 
         print "Source: %s" % p
 
@@ -270,8 +279,8 @@ class Cli(clibase.CliBase):
 
         try:
             p = self.udd.BindSourcePackage(package, release)
-        except PackageNotFoundError:
-            return self.notfound(package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, arch, error=e)
 
         print "Binaries: %s" % ", ".join(p.Binaries())
 
@@ -286,8 +295,8 @@ class Cli(clibase.CliBase):
 
         try:
             p = self.udd.BindSourcePackage(package, release)
-        except PackageNotFoundError:
-            return self.notfound(package, release)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, error=e)
 
         self._package_relation_lookup(p, release, 'build_depends')
         self._package_relation_lookup(p, release, 'build_depends_indep',
@@ -379,6 +388,33 @@ class Cli(clibase.CliBase):
         print "  recent:    %d" % d['recent']
         print "  nofiles:   %d" % d['nofiles']
 
+    def snapshot(self, command, filename, args):
+        """
+        Write the package tables of some releases to a snapshot file
+
+        The releases are those given with --release (separated by commas)
+        or as further arguments, along with the releases that they depend
+        on; only the architectures given with --arch are included, e.g.
+            udd-cache snapshot udd.sqlite sid experimental --arch=amd64
+        The snapshot is then queried with the --snapshot option.
+        """
+        releases = []
+        for name in args + (self.options.release or '').split(','):
+            for r in self.udd.data.list_dependent_releases(name):
+                if not r in releases:
+                    releases.append(r)
+        if not releases:
+            print "No releases were given for the snapshot."
+            return
+        archs = [a for a in (self.options.arch or '').split(',') if a]
+
+        counts = self.udd.export_snapshot(filename, releases, archs)
+        print "Snapshot of %s (%s) written to %s:" % \
+                (", ".join(releases), ", ".join(archs) or "all architectures",
+                 filename)
+        for table, where, indexes in snapshot.TABLES:
+            print "  %-15s %d rows" % (table, counts[table])
+
     def checkdeps(self, command, package, args):
         """
         Check a package's dependencies are satisfiable
@@ -388,7 +424,9 @@ class Cli(clibase.CliBase):
         specified release and architecture. In contrast to the "checkinstall"
         function, this check is not done recursively.
 
-        By default, the current stable release and i386 are used.
+        By default, the current stable release and i386 are used. With
+        --arch=any (or all), every architecture is checked and only those
+        in which the dependencies are unsatisfiable are listed.
         """
         release = self.udd.data.clean_release_name(self.options.release,
                                                    args=args)
@@ -402,10 +440,13 @@ class Cli(clibase.CliBase):
         if not relation:
             relation = self.udd.data.relations
 
+        if self.options.arch in ('any', 'all'):
+            return self._checkdeps_arches(package, release, relation)
+
         try:
             status = self.dispatcher.checkdeps(package, release, arch, relation)
-        except PackageNotFoundError:
-            return self.notfound(package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, arch, error=e)
 
         for rel in self.udd.data.relations:
             if rel in relation:
@@ -417,6 +458,32 @@ class Cli(clibase.CliBase):
                     print "%s: satisfied" % label
 
 
+    def _checkdeps_arches(self, package, release, relation):
+        """ Print the architectures with unsatisfiable dependencies """
+        try:
+            statuses = self.dispatcher.checkdeps_arches(package, release,
+                                                        None, relation)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, error=e)
+
+        failed = 0
+        for arch in sorted(statuses.keys()):
+            status = statuses[arch]
+            bad = [rel for rel in self.udd.data.relations
+                        if rel in relation and status[rel].bad]
+            if bad:
+                failed += 1
+                print "%s:" % arch
+            for rel in bad:
+                print "  %s: unsatisfied: %s" % \
+                        (rel.title().replace('_', '-'), str(status[rel].bad))
+        if failed:
+            print "Unsatisfied on %d of %d architectures." % \
+                    (failed, len(statuses))
+        else:
+            print "All dependencies satisfied on %d architectures." % \
+                    len(statuses)
+
     def checkbuilddeps(self, command, package, args):
         """
         Check a package's build-dependencies are satisfiable
@@ -453,8 +520,8 @@ class Cli(clibase.CliBase):
         try:
             solverh = self.dispatcher.checkInstall(package, release,
                                     arch, self.options.withrecommends)
-        except PackageNotFoundError:
-            return self.notfound(package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, arch, error=e)
 
         flatlist = solverh.flatten()
         print flatlist
@@ -518,8 +585,8 @@ class Cli(clibase.CliBase):
         try:
             chains = self.dispatcher.why(package, package2, release, arch,
                               self.options.withrecommends)
-        except PackageNotFoundError:
-            return self.notfound(package, release, arch)
+        except PackageNotFoundError, e:
+            return self.notfound(package, release, arch, error=e)
 
         if chains:
             print "Packages %s and %s are linked by %d chains." \
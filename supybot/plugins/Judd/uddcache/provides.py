@@ -0,0 +1,298 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Index of the virtual packages provided by the binary packages in UDD
+
+Finding the providers of a virtual package in the packages table needs a
+regular expression match on the provides column, which cannot use an index
+and so scans the whole release. The resolver does this for every virtual
+package that it meets (mail-transport-agent, awk, c-compiler...) so instead
+the provides column of a release and architecture is read once and turned
+into a map of virtual package name to the packages providing it.
+
+The indexes are held in a ProvidesRegistry that belongs to the database
+they were read from (see Udd.provides_registry) so that they are shared by
+all the Release and Package objects of that database and rebuilt once they
+are older than max_age.
+
+Typical usage:
+    registry = provides.ProvidesRegistry()
+    index = registry.index(pool, ('sid',), 'i386')
+    print index.providers('mail-transport-agent')
+    print registry.stats()
+"""
+
+import re
+import time
+import threading
+import database
+from cache import _sizeof
+from rows import RowCursor
+
+
+class ProvidesIndex(object):
+    """Map of the virtual packages to their providers in a release"""
+
+    def __init__(self, release, arch):
+        self.release = release
+        self.arch = arch
+        self.virtuals = {}
+        self.built = None
+        self.build_time = 0
+        self.bytes = 0
+
+    def build(self, dbconn):
+        """Read the provides column of the release and build the index"""
+        start = time.time()
+        rows = database.query(dbconn,
+                  r"""SELECT DISTINCT package, provides
+                      FROM packages
+                      WHERE provides <> ''
+                        AND (architecture='all' OR architecture=%(arch)s)
+                        AND release = ANY(%(release)s)""",
+                  dict(arch=self.arch, release=list(self.release)),
+                  cursor_factory=RowCursor)
+        self.fill(rows, start)
+
+    def fill(self, rows, start):
+        """Build the index from the rows of package names and provides
+
+        start: the time at which the rows were asked for
+        """
+        virtuals = {}
+        for row in rows:
+            package = intern(row['package'])
+            for name in parse_provides(row['provides']):
+                providers = virtuals.setdefault(intern(name), [])
+                if not package in providers:
+                    providers.append(package)
+        for providers in virtuals.values():
+            providers.sort()
+        self.virtuals = virtuals
+        self.built = time.time()
+        self.build_time = (self.built - start) * 1000
+        self.bytes = _sizeof(virtuals)
+
+    def providers(self, package):
+        """Return the names of the packages that provide a package"""
+        return list(self.virtuals.get(clean_name(package), []))
+
+    def stats(self):
+        """Return the size of the index and the time taken to build it"""
+        return {
+                'release': self.release,
+                'arch': self.arch,
+                'virtuals': len(self.virtuals),
+                'providers': sum([len(p) for p in self.virtuals.values()]),
+                'build_ms': self.build_time,
+                'bytes': self.bytes,
+                'age': self.built and time.time() - self.built,
+               }
+
+
+class ProvidesRegistry(object):
+    """The provides indexes of each release and architecture
+
+    Each release and architecture has its own build lock, so that the
+    concurrent lookups of an index that is being built wait for that one
+    build rather than each scanning the release, while the indexes of the
+    other releases and architectures remain available. An index that is
+    being rebuilt because it is older than max_age is still used by the
+    other lookups until the new one is ready.
+    """
+
+    def __init__(self, max_age=3600):
+        """
+        max_age: number of seconds after which an index is rebuilt
+        """
+        self.max_age = max_age
+        self.builds = 0
+        self._indexes = {}
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def index(self, dbconn, release, arch):
+        """Return the index for the release and arch, building it if needed
+
+        release: tuple of release names
+        """
+        key = (tuple(release), arch)
+        idx, building = self._lookup(key)
+        if idx is not None and not self._stale(idx):
+            return idx
+        if not building.acquire(idx is None):
+            # another thread is rebuilding it; use the old index meanwhile
+            return idx
+        try:
+            idx, building = self._lookup(key)
+            if idx is None or self._stale(idx):
+                idx = self._make(key[0], arch)
+                idx.build(dbconn)
+                self._store([(key, idx)])
+            return idx
+        finally:
+            building.release()
+
+    def indexes(self, dbconn, release, arches):
+        """Return the indexes for several architectures of a release
+
+        The indexes that need to be built are built together from a single
+        query (see build_arches).
+        """
+        key = tuple(release)
+        found = {}
+        for arch in arches:
+            idx = self._lookup((key, arch))[0]
+            if not self._stale(idx):
+                found[arch] = idx
+        stale = sorted(set(arches) - set(found))
+        if stale:
+            # the build locks are always taken in the same order
+            locks = [self._lookup((key, arch))[1] for arch in stale]
+            for lock in locks:
+                lock.acquire()
+            try:
+                for arch in stale:
+                    idx = self._lookup((key, arch))[0]
+                    if not self._stale(idx):
+                        found[arch] = idx
+                stale = [arch for arch in stale if not arch in found]
+                if stale:
+                    built = build_arches(dbconn, key, stale)
+                    self._store([((key, idx.arch), idx) for idx in built])
+                    found.update([(idx.arch, idx) for idx in built])
+            finally:
+                for lock in locks:
+                    lock.release()
+        return [found[arch] for arch in arches]
+
+    def _lookup(self, key):
+        """Return the index for a key, if any, and its build lock"""
+        with self._lock:
+            building = self._building.get(key)
+            if building is None:
+                building = self._building[key] = threading.Lock()
+            return self._indexes.get(key), building
+
+    def _stale(self, idx):
+        return idx is None or idx.built < time.time() - self.max_age
+
+    def _store(self, indexes):
+        with self._lock:
+            for key, idx in indexes:
+                self._indexes[key] = idx
+                self.builds += 1
+
+    def _make(self, release, arch):
+        return ProvidesIndex(release, arch)
+
+    def providers(self, dbconn, release, arch, package):
+        """Return the names of the packages that provide a package"""
+        return self.index(dbconn, release, arch).providers(package)
+
+    def clear(self):
+        """Drop all the indexes so that they are rebuilt on next use"""
+        with self._lock:
+            self._indexes = {}
+
+    def stats(self):
+        """Return the stats of each index that has been built"""
+        with self._lock:
+            indexes = self._indexes.values()
+        return [idx.stats() for idx in indexes]
+
+
+def build_arches(dbconn, release, arches):
+    """Build the provides indexes of several architectures of a release
+
+    The provides column is read for all the architectures with one query;
+    the packages of architecture 'all' are included in every index.
+    Returns a list of ProvidesIndex objects.
+    """
+    start = time.time()
+    rows = database.query(dbconn,
+              r"""SELECT DISTINCT package, architecture, provides
+                  FROM packages
+                  WHERE provides <> ''
+                    AND (architecture='all' OR architecture = ANY(%(arches)s))
+                    AND release = ANY(%(release)s)""",
+              dict(arches=list(arches), release=list(release)),
+              cursor_factory=RowCursor)
+    indexes = []
+    for arch in arches:
+        idx = ProvidesIndex(release, arch)
+        idx.fill([row for row in rows
+                    if row['architecture'] in ('all', arch)], start)
+        indexes.append(idx)
+    return indexes
+
+
+def find_providers(dbconn, release, arch, package):
+    """Return the names of the packages that provide a package
+
+    The provides column is searched for the one package without building
+    an index, for packages that were not looked up through a Release.
+    """
+    # \A is start string, \Z is finish string
+    # http://www.postgresql.org/docs/8.3/static/functions-matching.html
+    packagere = r"(?:\A|[, ])%s(?:\Z|[, (])" % re.escape(clean_name(package))
+    rows = database.query(dbconn,
+              r"""SELECT DISTINCT package
+                  FROM packages
+                  WHERE provides ~ %(package)s
+                    AND (architecture='all' OR architecture=%(arch)s)
+                    AND release = ANY(%(release)s)""",
+              dict(package=packagere, arch=arch, release=list(release)),
+              prepare=True)
+    return sorted([row[0] for row in rows])
+
+
+def parse_provides(provides):
+    """Return the names of the packages in a Provides field
+
+    Versioned provides such as "foo (= 1.0)" give just the package name.
+    """
+    names = []
+    for entry in provides.split(','):
+        entry = entry.split('(')[0].strip()
+        if entry:
+            names.append(entry)
+    return names
+
+
+def clean_name(package):
+    """Remove the characters that can't be in a package name
+
+    See §5.6.1 of Debian Policy "Source" for details.
+    http://www.debian.org/doc/debian-policy/ch-controlfields.html#s-f-Source
+    """
+    return re.sub(r"[^a-z\d\-+.]", "", package)
+
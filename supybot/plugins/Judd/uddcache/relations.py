@@ -32,12 +32,107 @@
 ###
 
 import re
+import collections
+from cache import ObjectCache
 try:
     from debian import debian_support
 except:
     from debian_bundle import debian_support
 
 
+# The same relationship strings, such as "libc6 (>= 2.13)", are declared by
+# many packages and are read again for each check of them. They are parsed
+# once into immutable forms that are kept, by their text, in a bounded LRU
+# cache and shared by all their users; the objects that record the outcome
+# of a check (Relationship, RelationshipOptions) are made afresh from them
+# for each check.
+
+
+class ParsedRelation(collections.namedtuple('ParsedRelation',
+                            ['relation', 'package', 'operator', 'version',
+                             'arch'])):
+    """ A single relationship as parsed from its text
+
+    arch is a tuple of the architecture restrictions
+    """
+    __slots__ = ()
+
+
+_relation_re = re.compile(r"""(?x)
+                  ^\s*
+                  (?P<package>[\w\d.+-]+)
+                  (?:
+                    \s*
+                    \(\s*
+                      (?P<operator>\>\>|\>=|=|\<\<|\<=)\s*(?P<version>[^\s]+)
+                    \s*\)
+                  )?
+                  (?:
+                    \s*
+                    \[\s*
+                      (?P<arch>[^]]+)
+                    \s*\]
+                  )?
+                  \s*$
+                  """)
+
+parse_cache = ObjectCache(entries=50000)
+""" cache of the parsed relationships, options and lists by their text """
+
+
+def parse_relation(relation):
+    """ Parse the text of a single relationship into a ParsedRelation
+
+    e.g. "libc6 (>= 2.13) [amd64]"; ValueError is raised if it cannot be
+    parsed.
+    """
+    p = parse_cache.get('relation', relation)
+    if p is None:
+        m = _relation_re.match(relation)
+        if not m:
+            raise ValueError("Couldn't parse the relationship expression")
+        arch = m.group('arch')
+        p = ParsedRelation(relation, _intern(m.group('package')),
+                           m.group('operator'), m.group('version'),
+                           tuple([_intern(a) for a in (arch or '').split()]))
+        parse_cache.put('relation', relation, p)
+    return p
+
+
+def _intern(s):
+    if type(s) is str:
+        return intern(s)
+    return s
+
+
+def parse_options(options):
+    """ Parse the alternatives of a relationship, e.g. "foo | bar"
+
+    Returns a tuple of ParsedRelation, one for each alternative.
+    """
+    p = parse_cache.get('options', options)
+    if p is None:
+        p = tuple([parse_relation(r)
+                   for r in re.split(r"\s*\|\s*", options)])
+        parse_cache.put('options', options, p)
+    return p
+
+
+def parse_relationships(relationships):
+    """ Parse a list of relationships, e.g. the Depends of a package
+
+    Returns a tuple of (text, alternatives) pairs, one for each of the
+    relationships in the list, the alternatives being as given by
+    parse_options().
+    """
+    p = parse_cache.get('list', relationships)
+    if p is None:
+        p = tuple([(r, parse_options(r))
+                   for r in re.split(r"\s*,\s*", relationships)])
+        parse_cache.put('list', relationships, p)
+    return p
+
+
 class Relationship(object):
     """Representation of a single package relationship
 
@@ -52,16 +147,28 @@ class Relationship(object):
     operator: operator part of the relationship (<<, <=, = >=, >>)
     version:  version part of the relationship
     arch:     architecture part of the relationship (either a list
-                of valid architecture keywords e.g.
+                or tuple of valid architecture keywords e.g.
                 ['amd64', 'i386'], or a space separated string of
-                keywords e.g. 'amd64 i386')
+                keywords e.g. 'amd64 i386'); it is held as a tuple
 
     Typical usage:
         rel = Relationship(relation="libc6")
         rel = Relationship(relation="libc6 (>= 1.2.3)")
         rel = Relationship(package="libc6", operator=">=", version="1.2.3")
+        rel = Relationship(parsed=parse_relation("libc6 (>= 1.2.3)"))
+
+    The outcome of checking the relationship is recorded in the object, so
+    each check uses its own Relationship objects; the parsed form of the
+    text (see parse_relation) is shared. A check makes a great many of
+    them, so their attributes are held in slots.
     """
+    __slots__ = ('relation', 'package', 'operator', 'version', 'arch',
+                 'archIgnore', 'virtual', 'packagedata')
+
     def __init__(self, **kwargs):
+        parsed = kwargs.pop('parsed', None)
+        if parsed is not None:
+            kwargs['relation'] = parsed.relation
         self.relation = kwargs.get('relation', None)
         """ textual representation of the entire relationship"""
         self.package = kwargs.get('package', None)
@@ -71,7 +178,7 @@ class Relationship(object):
         self.version = kwargs.get('version', None)
         """ version string from the relationship as a string """
         self.arch = self._archsplit(kwargs.get('arch', None))
-        """ architecture specification for the relationship as a list """
+        """ architecture specification for the relationship as a tuple """
         self.archIgnore = False
         """ boolean: this relationship is to be ignored in this architecture"""
         self.virtual = False
@@ -88,34 +195,17 @@ class Relationship(object):
             raise ValueError("If one of 'operator' or 'version' keyword "
                             "arguments is specified, both must be given")
         if self.relation:
-            self._ParseRelation(self.relation)
+            self._ParseRelation(self.relation, parsed)
         self._checkOperatorSyntax()
 
-    def _ParseRelation(self, relationship):
-        #print "checking item %s" % item
-        m = re.match(r"""(?x)
-                  ^\s*
-                  (?P<package>[\w\d.+-]+)
-                  (?:
-                    \s*
-                    \(\s*
-                      (?P<operator>\>\>|\>=|=|\<\<|\<=)\s*(?P<version>[^\s]+)
-                    \s*\)
-                  )?
-                  (?:
-                    \s*
-                    \[\s*
-                      (?P<arch>[^]]+)
-                    \s*\]
-                  )?
-                  \s*$
-                  """, relationship)
-        if not m:
-            raise ValueError("Couldn't parse the relationship expression")
-        self.package = m.group('package')
-        self.operator = m.group('operator')
-        self.version = m.group('version')
-        self.arch = self._archsplit(m.group('arch'))
+    def _ParseRelation(self, relationship, parsed=None):
+        """ take the parts of the relationship from its parsed form """
+        if parsed is None:
+            parsed = parse_relation(relationship)
+        self.package = parsed.package
+        self.operator = parsed.operator
+        self.version = parsed.version
+        self.arch = parsed.arch
 
     def isVersioned(self):
         return self.operator != None
@@ -127,13 +217,13 @@ class Relationship(object):
                              self.operator)
 
     def _archsplit(self, value):
-        """ split up whitespace separated into list of archs accept lists"""
+        """ split up whitespace separated into tuple of archs accept lists"""
         if value and type(value) is str:
-            return re.split(r"\s+", value.strip())
-        elif type(value) is list:
-            return value
+            return tuple([_intern(a) for a in value.split()])
+        elif type(value) in (list, tuple):
+            return tuple(value)
         else:
-            return []
+            return ()
 
     def __str__(self):
         if self.relation:
@@ -157,7 +247,10 @@ class RelationshipOptions(list):
     rel = RelationshipOptions("default-mta | mail-transport-agent")
     rel = RelationshipOptions("dpkg (>> 1.15.4)")
     """
-    def __init__(self, options):
+    __slots__ = ('relation', 'satisfiedBy', 'satisfied', 'virtual',
+                 'archIgnore', 'status')
+
+    def __init__(self, options, parsed=None):
         """Create a list of Relationship objects that represent a
         single package relationship, parsing the standard
         'foo | bar' format for the option syntax.
@@ -167,19 +260,18 @@ class RelationshipOptions(list):
             'foo'
             'foo | bar'
             'foo (>> 1.2-3)'
+        parsed: the alternatives as given by parse_options(options), if
+            they are already known
         """
         self.relation = options   # text representation
         self.satisfiedBy = None   # Relationship alternative that satisfies
         self.satisfied = False  # relationship is satisfied (boolean)
         self.virtual = False  # used virtual package to satisfy
+        self.archIgnore = False  # satisfied as it is not for this arch
         self.status = None   # Extended status (SolverHierarchy)
-        list.__init__(self)
-        for rel in self._SplitOptions(options):
-            #print "found rel=%s" % rel
-            self.append(Relationship(relation=rel))
-
-    def _SplitOptions(self, item):
-        return re.split(r"\s*\|\s*", item)
+        if parsed is None:
+            parsed = parse_options(options)
+        list.__init__(self, [Relationship(parsed=rel) for rel in parsed])
 
     def __str__(self):
         return self.relation
@@ -193,6 +285,7 @@ class RelationshipOptionsList(list):
     list of objects represents all of these relationships (e.g. the entire
     Depends entry for the package).
     """
+    __slots__ = ()
 
     def ReleaseMap(self):
         """
@@ -39,8 +39,10 @@ SolverHierarchy -- TODO: complete
 """
 
 import copy
+import database
 from relations import *
 from packages import *
+from versions import satisfies
 
 
 class Checker(object):
@@ -87,13 +89,49 @@ class Checker(object):
         """
         p = self.release.Package(package)
         if not p.Found():
-            raise PackageNotFoundError(package)
+            raise self.release.not_found(package)
         status = self.CheckRelationshipOptionsList(
                                     p.RelationshipOptionsList(relation))
         if relation == 'conflicts':
             status.swap()
         return status
 
+    def Prefetch(self, package, relations):
+        """Look up the packages named in some relationships of a package
+
+        The packages are looked up together so that checking the
+        relationships afterwards does not need a query for each of them.
+            package: name of the package (string)
+            relations: list of package relationships (depends, recommends...)
+        """
+        self.release.prefetch(self.RelatedPackages(package, relations))
+
+    def RelatedPackages(self, package, relations):
+        """The packages named in some relationships of a package
+
+        Returns a list of (name, operator, version) tuples for the
+        relationships that apply to the architecture, or an empty list if
+        the package does not exist.
+            package: name of the package (string)
+            relations: list of package relationships (depends, recommends...)
+        """
+        p = self.release.Package(package)
+        if not p.Found():
+            return []
+        wanted = []
+        for relation in relations:
+            wanted.extend(self._Wanted(p.RelationshipOptionsList(relation)))
+        return wanted
+
+    def _Wanted(self, relationlist):
+        """ The packages needed to check a RelationshipOptionsList """
+        wanted = []
+        for opts in relationlist:
+            for rel in opts:
+                if self.CheckRelationArch(rel.arch):
+                    wanted.append((rel.package, rel.operator, rel.version))
+        return wanted
+
     def CheckRelationshipOptionsList(self, relationlist):
         """Check a set of package relationships to see if they are satisfied
 
@@ -106,7 +144,10 @@ class Checker(object):
         if relationlist == None:
             return status
 
+        # look up all the packages at once rather than one at a time
+        self.release.prefetch(self._Wanted(relationlist))
         for opts in relationlist:
+            database.check_deadline()
             #print "Considering fragment %s" % str(opts)
             satisfied = False
             for item in opts:    # item is a RelationshipOptions object
@@ -128,13 +169,13 @@ class Checker(object):
 
     def CheckRelationArch(self, arch_restriction):
         """
-        Compare architecture restriction (in list form) to arch of release
-        being studied. Examples:
+        Compare architecture restriction (in list or tuple form) to arch of
+        release being studied. Examples:
           ['i386']
           ['i386', 'amd64']
           ['!i386', '!amd64']
 
-        arch_restriction: list of architecture specifications to test
+        arch_restriction: list or tuple of architecture specifications to test
 
         Returns current release-arch satisfies the restriction
 
@@ -149,8 +190,8 @@ class Checker(object):
         if not arch_restriction:
             return True
 
-        if not type(arch_restriction) is list:
-            raise TypeError("'arch' parameter must be a list")
+        if not type(arch_restriction) in (list, tuple):
+            raise TypeError("'arch' parameter must be a list or tuple")
 
         if arch_restriction[0].startswith('!'):
             # Policy requires all specifiers be positive or all be negative
@@ -194,24 +235,11 @@ class Checker(object):
         version = p.data['version']
         # see policy §7.1
         # http://www.debian.org/doc/debian-policy/ch-relationships.html
+        # the version in the archive is compared with the one from the dep
+        # line by their memoised sort keys (see versions.py)
         relOK = True
         if rel.operator:
-            # version from dep line
-            depver = debian_support.Version(rel.version)
-            # version in archive
-            aver = debian_support.Version(version)
-            #print "    versions comparison %s %s %s %s" % \
-            #               (rel.package, aver, rel.operator, depver)
-            if rel.operator == ">>":    # strictly greater than
-                relOK = aver > depver
-            elif rel.operator == ">=":  # greater than or equal to
-                relOK = aver >= depver
-            elif rel.operator == "=":   # equal to
-                relOK = aver == depver
-            elif rel.operator == "<=":  # less than or equal to
-                relOK = aver <= depver
-            elif rel.operator == "<<":  # strictly less than
-                relOK = aver < depver
+            relOK = satisfies(version, rel.operator, rel.version)
         if relOK:
             rel.packagedata = p
         return relOK
@@ -252,6 +280,7 @@ class InstallChecker(Checker):
 
         if package in self._checkInstallCache:
             return
+        database.check_deadline()
         self._checkInstallCache[package] = True
         s.depends = super(InstallChecker, self).Check(package, 'depends')
         assert(s.depends != None)
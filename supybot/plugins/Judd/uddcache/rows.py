@@ -0,0 +1,179 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compact rows of query results
+
+The rows given by psycopg2's DictCursor are lists that can also be read by
+column name; each holds its values in a separately allocated array, and
+the cursor's dict of column names is shared only by the rows of the same
+query. A lookup that reads thousands of rows, such as a full InstallChecker
+tree or the bugs of a popular package, keeps thousands of these.
+
+The rows given by RowCursor are instead tuples of a class made for the
+columns of the query (see row_class), holding the values inline and
+nothing else: the index of the column names is shared, as a class
+attribute, by all the rows of the same shape of query. The rows are read
+by position, by column name as for a DictCursor, or as attributes as for
+a namedtuple:
+
+    rows = database.query(pool, "SELECT package, version FROM packages ...",
+                          cursor_factory=rows.RowCursor)
+    rows[0]['version'] == rows[0].version == rows[0][1]
+"""
+
+import operator
+import threading
+import psycopg2.extensions
+
+
+class Row(tuple):
+    """A row that is read by position, column name or attribute
+
+    Rows are made by the subclass for their columns given by row_class;
+    _fields holds the names of the columns and _index their positions.
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, x):
+        if not isinstance(x, (int, long, slice)):
+            x = self._index[x]
+        return tuple.__getitem__(self, x)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def has_key(self, key):
+        return key in self._index
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "Row(%s)" % ", ".join(["%s=%r" % (k, v)
+                                      for k, v in self.items()])
+
+    def __reduce__(self):
+        return (_make, (self._fields, tuple(self)))
+
+
+_classes = {}
+_lock = threading.Lock()
+
+
+def row_class(fields):
+    """The Row subclass for rows of the given columns
+
+    There is one class for each distinct list of columns, so that the rows
+    of all the queries of the same shape share their index.
+    """
+    fields = tuple(fields)
+    cls = _classes.get(fields)
+    if cls is None:
+        with _lock:
+            cls = _classes.get(fields)
+            if cls is None:
+                attrs = {'__slots__': (),
+                         '_fields': fields,
+                         '_index': dict([(f, i) for i, f
+                                         in enumerate(fields)])}
+                for f, i in attrs['_index'].items():
+                    if _attribute(f) and not hasattr(Row, f):
+                        attrs[f] = property(operator.itemgetter(i))
+                cls = _classes[fields] = type('Row', (Row,), attrs)
+    return cls
+
+
+def _attribute(name):
+    return isinstance(name, str) and name and \
+            (name[0].isalpha() or name[0] == '_') and \
+            name.replace('_', 'a').isalnum()
+
+
+def _make(fields, values):
+    return row_class(fields)(values)
+
+
+class RowCursor(psycopg2.extensions.cursor):
+    """A cursor whose rows are Rows rather than tuples (see module docs)"""
+
+    def _class(self):
+        return row_class([d[0] for d in self.description])
+
+    def fetchone(self):
+        row = psycopg2.extensions.cursor.fetchone(self)
+        if row is None:
+            return None
+        return self._class()(row)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            rows = psycopg2.extensions.cursor.fetchmany(self)
+        else:
+            rows = psycopg2.extensions.cursor.fetchmany(self, size)
+        if not rows:
+            return rows
+        cls = self._class()
+        return [cls(row) for row in rows]
+
+    def fetchall(self):
+        rows = psycopg2.extensions.cursor.fetchall(self)
+        if not rows:
+            return rows
+        cls = self._class()
+        return [cls(row) for row in rows]
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
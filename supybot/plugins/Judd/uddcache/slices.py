@@ -0,0 +1,255 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Releases held in memory so that their packages are looked up without queries
+
+The channels mostly ask about the same few releases and architectures
+(stable on i386, sid on amd64...). The packages of these are read into a
+ReleaseSlice, which stores the columns used to check relationships (see
+packages.PROFILES) as one list per column, with the rows of each package
+next to each other, newest version first. The name of each package maps to
+the range of its rows. The strings are interned, so that the many copies
+of the same name or relationship string are stored once.
+
+A Release that is held in a slice answers Package, Candidates, bin2src and
+ProvidersList from the slice; the Checkers therefore need no queries. The
+other columns of the packages are still read from the database if they are
+used (see packages.LazyRow).
+
+The slices are held by a SliceStore, which reloads them in the background
+when UDD imports new packages; the old slices are used until the new ones
+are ready.
+
+Typical usage:
+    store = SliceStore(pool, [(('sid',), 'amd64')])
+    store.reload()
+    release = Release(pool, release='sid', arch='amd64', slices=store)
+"""
+
+import time
+import threading
+import database
+from cache import _sizeof
+from packages import PROFILES, LazyRow, row_loader
+from provides import parse_provides, clean_name
+
+
+class ReleaseSlice(object):
+    """The packages of a release and architecture stored by column"""
+
+    columns = PROFILES['packages']['relations']
+
+    def __init__(self, release, arch):
+        self.release = tuple(release)
+        self.arch = arch
+        self.index = {}
+        self.data = dict([(c, []) for c in self.columns])
+        self.virtuals = {}
+        self.load = None
+        self.loaded = None
+        self.load_time = 0
+        self.bytes = 0
+
+    def read(self, dbconn):
+        """Read the packages of the release from the database"""
+        start = time.time()
+        rows = database.query(dbconn,
+                  r"""SELECT """ + ','.join(self.columns) + """
+                      FROM packages
+                      WHERE (architecture='all' OR architecture=%(arch)s)
+                        AND release = ANY(%(release)s)
+                      ORDER BY package, version DESC""",
+                  dict(arch=self.arch, release=list(self.release)))
+        index = {}
+        data = [[] for c in self.columns]
+        virtuals = {}
+        package = self.columns.index('package')
+        provides = self.columns.index('provides')
+        for i, row in enumerate(rows):
+            for values, value in zip(data, row):
+                if isinstance(value, str):
+                    value = intern(value)
+                values.append(value)
+            name = data[package][i]
+            first, last = index.get(name, (i, i))
+            index[name] = (first, i + 1)
+            for v in parse_provides(row[provides] or ''):
+                providers = virtuals.setdefault(intern(v), [])
+                if not name in providers:
+                    providers.append(name)
+        self.index = index
+        self.data = dict(zip(self.columns, data))
+        self.virtuals = virtuals
+        self.load = row_loader(dbconn, 'packages')
+        self.loaded = time.time()
+        self.load_time = (self.loaded - start) * 1000
+        self.bytes = _sizeof(index) + _sizeof(virtuals) + \
+                        sum([_sizeof(values) for values in data])
+
+    def candidates(self, package):
+        """Return the rows of a package, newest version first"""
+        first, last = self.index.get(package, (0, 0))
+        return [LazyRow(SliceRow(self, i), self.load)
+                    for i in range(first, last)]
+
+    def providers(self, package):
+        """Return the names of the packages that provide a package"""
+        return sorted(self.virtuals.get(clean_name(package), []))
+
+    def source(self, package):
+        """Return the name of the source of a binary package or None"""
+        first, last = self.index.get(package, (None, None))
+        if first is None:
+            return None
+        return self.data['source'][first]
+
+    def stats(self):
+        """Return the size of the slice and the time taken to read it"""
+        return {
+                'release': self.release,
+                'arch': self.arch,
+                'packages': len(self.index),
+                'rows': len(self.data['package']),
+                'virtuals': len(self.virtuals),
+                'load_ms': self.load_time,
+                'bytes': self.bytes,
+                'age': self.loaded and time.time() - self.loaded,
+               }
+
+
+class SliceRow(object):
+    """A row of a ReleaseSlice, accessed by column name"""
+
+    __slots__ = ('slice', 'i')
+
+    def __init__(self, slice, i):
+        self.slice = slice
+        self.i = i
+
+    def __getitem__(self, column):
+        return self.slice.data[column][self.i]
+
+    def get(self, column, default=None):
+        if column in self.slice.data:
+            return self.slice.data[column][self.i]
+        return default
+
+    def __contains__(self, column):
+        return column in self.slice.data
+
+    def keys(self):
+        return list(self.slice.columns)
+
+    def items(self):
+        return [(c, self.slice.data[c][self.i]) for c in self.slice.columns]
+
+
+class SliceStore(object):
+    """The releases and architectures held in memory"""
+
+    def __init__(self, dbconn, wanted):
+        """
+        dbconn: pool from which to read the releases
+        wanted: list of (tuple of release names, arch) to hold
+        """
+        self.dbconn = dbconn
+        self.wanted = [(tuple(r), a) for r, a in wanted]
+        self.loads = 0
+        self.errors = 0
+        self.last_error = None
+        # called once new slices are in use, to drop what was built from
+        # the old ones
+        self.listeners = []
+        self._slices = {}
+        self._lock = threading.Lock()
+        self._loader = None
+        self._pending = False
+
+    def get(self, release, arch):
+        """Return the slice for the release and arch or None"""
+        return self._slices.get((release, arch))
+
+    def load(self):
+        """Read all the wanted slices, replacing the current ones"""
+        slices = {}
+        for release, arch in self.wanted:
+            sl = ReleaseSlice(release, arch)
+            sl.read(self.dbconn)
+            slices[(sl.release, arch)] = sl
+        self._slices = slices
+        self.loads += 1
+        for listener in self.listeners:
+            listener()
+
+    def reload(self):
+        """Read the slices again in the background
+
+        The current slices are used until the new ones are ready; a reload
+        that is asked for while one is running is made again once it is
+        done, as the running one may have read the tables before they
+        changed.
+        """
+        if not self.wanted:
+            return
+        with self._lock:
+            if self._loader is not None:
+                self._pending = True
+                return
+            self._loader = threading.Thread(target=self._reload,
+                                            name="uddcache-slices")
+            self._loader.daemon = True
+            self._loader.start()
+
+    def _reload(self):
+        while True:
+            with self._lock:
+                self._pending = False
+            # the slices are an optimisation: if they can't be read, the
+            # releases keep using the old ones (or the database)
+            try:
+                self.load()
+            except Exception, e:
+                self.errors += 1
+                self.last_error = str(e)
+            with self._lock:
+                if not self._pending:
+                    self._loader = None
+                    return
+
+    def wait(self, timeout=None):
+        """Wait for a reload in the background to finish"""
+        loader = self._loader
+        if loader is not None:
+            loader.join(timeout)
+
+    def stats(self):
+        """Return the stats of each slice held"""
+        return [sl.stats() for sl in self._slices.values()]
@@ -0,0 +1,348 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Snapshots of the package tables of UDD in a local SQLite file
+
+The packages, sources, popcon, upload_history and screenshots tables for
+some releases and architectures are exported into a single file, which
+can then be queried instead of the database server (see Udd), e.g. when
+the server is out of reach or to avoid its latency for data that changes
+once a day. The file is opened with the tables memory-mapped and has its
+own indexes on the columns that the package queries look up.
+
+The queries are written for PostgreSQL and are translated for SQLite as
+they are run (see translate()); version columns are compared in the same
+way as the debversion type of UDD.
+
+Typical usage:
+    snapshot.export(pool, 'udd.sqlite', ['sid', 'experimental'], ['amd64'])
+    udd = Udd(snapshot='udd.sqlite')
+"""
+
+import os
+import re
+import time
+import datetime
+import decimal
+import sqlite3
+import threading
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import database
+import versions
+from rows import row_class
+
+
+# the tables that are exported, the rows wanted from each and their indexes
+TABLES = [
+    ('packages',
+        """release = ANY(%(release)s)
+           AND (architecture = 'all' OR architecture = ANY(%(arch)s))""",
+        [('package', 'release'), ('source', 'release'),
+         ('release', 'architecture')]),
+    ('sources',
+        """release = ANY(%(release)s)""",
+        [('source', 'release')]),
+    ('popcon',
+        """package IN (SELECT package FROM packages
+                       WHERE release = ANY(%(release)s))""",
+        [('package',)]),
+    ('upload_history',
+        """source IN (SELECT source FROM sources
+                      WHERE release = ANY(%(release)s))""",
+        [('source',)]),
+    ('screenshots',
+        """package IN (SELECT package FROM packages
+                       WHERE release = ANY(%(release)s))""",
+        [('package',)]),
+]
+
+FORMAT = '1'
+
+# bytes of the file that are memory-mapped
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+def export(dbconn, filename, releases, archs=None):
+    """Write a snapshot of some releases and architectures to a file
+
+    dbconn: a ConnectionPool or connection to UDD
+    filename: the snapshot file, which is replaced once it has been written
+    releases: the names of the releases to include
+    archs: the architectures to include, all of them if not given
+
+    Returns a dict of the number of rows written for each table.
+    """
+    params = dict(release=list(releases), arch=list(archs or []))
+    new = filename + '.new'
+    if os.path.exists(new):
+        os.remove(new)
+    db = _open(new)
+    counts = {}
+    try:
+        for table, where, indexes in TABLES:
+            if table == 'packages' and not archs:
+                where = "release = ANY(%(release)s)"
+            with database.connection(dbconn) as conn:
+                c = conn.cursor()
+                c.execute("SELECT * FROM %s WHERE %s" % (table, where),
+                          params)
+                counts[table] = _copy(db, table, c)
+            for i, columns in enumerate(indexes):
+                db.execute("CREATE INDEX %s_%d ON %s (%s)" %
+                           (table, i, table, ", ".join(columns)))
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.executemany("INSERT INTO meta VALUES (?, ?)", [
+                    ('format', FORMAT),
+                    ('created', str(int(time.time()))),
+                    ('releases', " ".join(releases)),
+                    ('archs', " ".join(archs or [])),
+                ])
+        db.commit()
+        db.execute("ANALYZE")
+        db.close()
+    except:
+        db.close()
+        os.remove(new)
+        raise
+    os.rename(new, filename)
+    return counts
+
+
+def _copy(db, table, cursor):
+    # create the table from the description of the result and copy the rows
+    columns = [(d[0], _column_type(d[0], d[1])) for d in cursor.description]
+    db.execute("CREATE TABLE %s (%s)" % (table,
+               ", ".join(['"%s" %s' % c for c in columns])))
+    insert = "INSERT INTO %s VALUES (%s)" % (table,
+               ", ".join(["?"] * len(columns)))
+    count = 0
+    while True:
+        rows = cursor.fetchmany(1000)
+        if not rows:
+            break
+        db.executemany(insert, [[_value(v) for v in row] for row in rows])
+        count += len(rows)
+    return count
+
+
+def _column_type(name, type_code):
+    # the declared type of a column, which also selects the converter that
+    # is used when the column is read (see _open)
+    if name == 'version' or name.endswith('_version'):
+        return 'TEXT COLLATE DEBVERSION'
+    if type_code in psycopg2.extensions.PYDATETIME.values:
+        return 'timestamp'
+    if type_code in psycopg2.extensions.PYDATE.values:
+        return 'date'
+    if psycopg2.NUMBER == type_code:
+        return 'NUMERIC'
+    return 'TEXT'
+
+
+def _value(v):
+    # store the values of the types that SQLite does not know as text
+    if v is None or isinstance(v, (int, long, float, basestring)):
+        return v
+    if isinstance(v, datetime.datetime):
+        if v.tzinfo is not None:
+            v = (v - v.utcoffset()).replace(tzinfo=None)
+        return v
+    if isinstance(v, datetime.date):
+        return v
+    if isinstance(v, decimal.Decimal):
+        return float(v)
+    return str(v)
+
+
+def _open(filename):
+    db = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES,
+                         check_same_thread=False)
+    # text is returned as str, as it is by psycopg2
+    db.text_factory = str
+    db.create_collation('DEBVERSION', versions.compare)
+    db.execute("PRAGMA case_sensitive_like = ON")
+    db.execute("PRAGMA mmap_size = %d" % MMAP_SIZE)
+    return db
+
+
+_distinct_on = re.compile(r"\bDISTINCT\s+ON\s*\(\s*(\w+)\s*\)\s*", re.I)
+_any = re.compile(r"=\s*ANY\s*\(\s*%\((\w+)\)s\s*\)", re.I)
+_cast = re.compile(r"(%\(\w+\)s)::\w+")
+_placeholder = re.compile(r"%\((\w+)\)s|%%")
+_session = re.compile(r"\s*(SET|RESET)\s", re.I)
+
+
+def translate(sql, params=None):
+    """Rewrite a query written for PostgreSQL to be run by SQLite
+
+    Returns the query, its parameters and the column given to DISTINCT ON,
+    if any, which SQLite does not have: the rows are instead left out by
+    the cursor after the first of each value of that column.
+
+    The placeholders are rewritten as named parameters and the lists
+    given to "= ANY(%(name)s)" are expanded as for IN.
+    """
+    params = dict(params or {})
+    distinct = None
+    m = _distinct_on.search(sql)
+    if m:
+        distinct = m.group(1)
+        sql = sql[:m.start()] + sql[m.end():]
+
+    def expand(m):
+        names = []
+        for i, value in enumerate(params[m.group(1)]):
+            name = "%s__%d" % (m.group(1), i)
+            params[name] = value
+            names.append(":" + name)
+        return "IN (%s)" % ", ".join(names)
+
+    sql = _any.sub(expand, sql)
+    sql = _cast.sub(r"\1", sql)
+    sql = _placeholder.sub(lambda m: m.group(1) and ":" + m.group(1) or "%",
+                           sql)
+    return sql, params, distinct
+
+
+class SnapshotCursor(object):
+    """A cursor on a Snapshot, with the rows fetched as by psycopg2"""
+
+    def __init__(self, snapshot, cursor_factory=None):
+        self.connection = snapshot
+        self.cursor_factory = cursor_factory
+        self.description = None
+        self.rowcount = -1
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        if _session.match(sql):
+            # settings for the PostgreSQL session such as statement_timeout
+            self._rows = []
+            return
+        sql, params, distinct = translate(sql, params)
+        rows, self.description = self.connection.run(sql, params)
+        # sqlite3 gives no description for a WITH query without rows
+        columns = [d[0] for d in self.description or ()]
+        if distinct and rows:
+            i = columns.index(distinct)
+            seen = set()
+            unique = []
+            for row in rows:
+                if not row[i] in seen:
+                    seen.add(row[i])
+                    unique.append(row)
+            rows = unique
+        factory = self.cursor_factory
+        if factory is not None and \
+                issubclass(factory, psycopg2.extras.RealDictCursor):
+            rows = [dict(zip(columns, row)) for row in rows]
+        elif factory is not None:
+            cls = row_class(columns)
+            rows = [cls(row) for row in rows]
+        self._rows = rows
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        if not self._rows:
+            return None
+        return self._rows.pop(0)
+
+    def fetchmany(self, size=1000):
+        rows = self._rows[:size]
+        self._rows = self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows = self._rows
+        self._rows = []
+        return rows
+
+    def close(self):
+        self._rows = []
+
+
+class Snapshot(object):
+    """A snapshot file standing in for the pool of database connections
+
+    The snapshot is used in the same way as a bare connection (see
+    database.query()); the queries of all threads are run in turn on one
+    SQLite connection.
+    """
+
+    def __init__(self, filename):
+        if not os.path.isfile(filename):
+            raise IOError("Snapshot file not found '%s'." % filename)
+        self.filename = filename
+        self.closed = False
+        self.queries = 0
+        self._lock = threading.Lock()
+        self._db = _open(filename)
+        self._db.execute("PRAGMA query_only = ON")
+        self.meta = dict(self._db.execute("SELECT key, value FROM meta"))
+
+    def cursor(self, name=None, cursor_factory=None, **kwargs):
+        return SnapshotCursor(self, cursor_factory)
+
+    def run(self, sql, params):
+        """Run a translated query, returning its rows and description"""
+        with self._lock:
+            self.queries += 1
+            try:
+                c = self._db.execute(sql, params)
+                return c.fetchall(), c.description
+            except sqlite3.OperationalError, e:
+                if str(e) == 'interrupted':
+                    raise psycopg2.extensions.QueryCanceledError(str(e))
+                raise
+
+    def cancel(self):
+        """Stop the query that is running (see database.Deadline)"""
+        self._db.interrupt()
+
+    def close(self):
+        if not self.closed:
+            self._db.close()
+            self.closed = True
+
+    def closeall(self):
+        self.close()
+
+    def stats(self):
+        """Return the contents and age of the snapshot"""
+        return {
+                'snapshot': self.filename,
+                'releases': self.meta.get('releases', '').split(),
+                'archs': self.meta.get('archs', '').split(),
+                'age': time.time() - int(self.meta.get('created', 0)),
+                'queries': self.queries,
+               }
@@ -0,0 +1,129 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Map of the binary packages in UDD to the source packages that build them
+
+Looking up a source package by the name of one of its binary packages
+took a query on the packages table for each name (see Release.bin2src)
+followed by more queries on the sources table. The names of the binary
+packages and their sources are instead read once for each release and
+kept in a map, which is shared by all the Release objects of the database
+in the same way as the indexes of virtual packages (see provides.py and
+Udd.sourcemap_registry).
+
+Typical usage:
+    registry = sourcemap.SourceMapRegistry()
+    sources = registry.index(pool, ('sid',))
+    print sources.source('libc6')
+"""
+
+import time
+import database
+from cache import _sizeof
+from rows import RowCursor
+from provides import ProvidesRegistry
+
+
+class SourceMap(object):
+    """Map of the binary packages in a release to their source packages"""
+
+    def __init__(self, release):
+        self.release = release
+        self.arch = None
+        self.binaries = {}
+        self.sources = set()
+        self.built = None
+        self.build_time = 0
+        self.bytes = 0
+
+    def build(self, dbconn):
+        """Read the names of the binary and source packages of the release
+
+        If a binary package is built from different sources in the
+        releases, the source of its newest version is used.
+        """
+        start = time.time()
+        rows = database.query(dbconn,
+                  r"""SELECT DISTINCT ON (package) package, source
+                      FROM packages
+                      WHERE release = ANY(%(release)s)
+                      ORDER BY package, version DESC""",
+                  dict(release=list(self.release)),
+                  cursor_factory=RowCursor)
+        binaries = {}
+        sources = set()
+        for row in rows:
+            source = intern(row['source'])
+            binaries[intern(row['package'])] = source
+            sources.add(source)
+        self.binaries = binaries
+        self.sources = sources
+        self.built = time.time()
+        self.build_time = (self.built - start) * 1000
+        self.bytes = _sizeof(binaries) + _sizeof(list(sources))
+
+    def source(self, package):
+        """Return the name of the source of a binary package or None"""
+        return self.binaries.get(package)
+
+    def is_source(self, package):
+        """Test if a source package builds binary packages in the release"""
+        return package in self.sources
+
+    def stats(self):
+        """Return the size of the map and the time taken to build it"""
+        return {
+                'release': self.release,
+                'binaries': len(self.binaries),
+                'sources': len(self.sources),
+                'build_ms': self.build_time,
+                'bytes': self.bytes,
+                'age': self.built and time.time() - self.built,
+               }
+
+
+class SourceMapRegistry(ProvidesRegistry):
+    """The maps of binary to source packages of each release"""
+
+    def index(self, dbconn, release, arch=None):
+        """Return the map for the release, building it if needed
+
+        The map is the same for all architectures.
+        """
+        return ProvidesRegistry.index(self, dbconn, release, None)
+
+    def _make(self, release, arch):
+        return SourceMap(release)
+
+    def source(self, dbconn, release, package):
+        """Return the name of the source of a binary package or None"""
+        return self.index(dbconn, release).source(package)
+
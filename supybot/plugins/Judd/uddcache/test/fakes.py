@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+""" Stand-ins for database connections, shared by the unit tests """
+
+import psycopg2
+
+
+class FakeCursor(object):
+    """ Stand-in for a cursor, whose results are given by its connection """
+    def __init__(self, connection, cursor_factory=None):
+        self.connection = connection
+        self.cursor_factory = cursor_factory
+        self.description = None
+        self.rows = []
+
+    @property
+    def executed(self):
+        return self.connection.executed
+
+    def execute(self, sql, params=None):
+        conn = self.connection
+        if conn.broken:
+            conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection "
+                                            "unexpectedly")
+        conn.executed.append((sql, params))
+        if conn.error:
+            raise psycopg2.ProgrammingError("syntax error")
+        self.rows = list(conn.answer(self, sql, params))
+
+    def fetchone(self):
+        if not self.rows:
+            return None
+        return self.rows.pop(0)
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """ Stand-in for a bare psycopg2 connection that records its statements
+
+    Each statement is recorded as (sql, params) in 'executed' and returns
+    the canned 'rows'; subclasses work out the rows from the statement by
+    overriding answer(). Statements fail with ProgrammingError if 'error'
+    is set, and as if the server had gone away if 'broken' is set.
+    """
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.executed = []
+        self.error = False
+        self.broken = False
+        self.closed = False
+        self.cancelled = 0
+
+    def answer(self, cursor, sql, params):
+        """ Return the rows for a statement run on the cursor """
+        return self.rows
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self, cursor_factory)
+
+    def close(self):
+        self.closed = True
+
+    def cancel(self):
+        self.cancelled += 1
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+""" Unit tests for batches of queries """
+
+import unittest2 as unittest
+import psycopg2
+import psycopg2.extras
+from uddcache.udd import Udd
+from uddcache.database import query
+from uddcache.batch import Batch
+from uddcache.engine import Query, Return, run
+from uddcache.bts import Bts
+from uddcache.resolver import Checker
+from uddcache.test.fakes import FakeConnection
+
+
+class Columns(object):
+    """ Stand-in for a DictCursor, giving the column names of a row """
+    def __init__(self, *names):
+        self.description = names
+        self.index = dict([(n, i) for i, n in enumerate(names)])
+
+
+def dictrow(columns, *values):
+    row = psycopg2.extras.DictRow(columns)
+    row[:] = values
+    return row
+
+
+class BatchTests(unittest.TestCase):
+    def testScalars(self):
+        """Test combining scalar queries into one round trip"""
+        conn = FakeConnection([(10, 20, None)])
+        b = Batch(conn)
+        f1 = b.scalar("SELECT count(*) FROM bugs WHERE severity=%(s)s;",
+                      {'s': 'serious'})
+        f2 = b.scalar("SELECT count(*) FROM bugs WHERE title LIKE 'RM:%'")
+        f3 = b.scalar("SELECT max(id) FROM bugs WHERE id > %s", (5,))
+        self.assertEqual(len(b), 3)
+        b.execute()
+        self.assertEqual((f1.result(), f2.result(), f3.result()),
+                         (10, 20, None))
+        self.assertEqual(b.round_trips, 1)
+        self.assertEqual(b.queries, 3)
+        sql, params = conn.executed[0]
+        self.assertEqual(sql, "SELECT "
+                    "(SELECT count(*) FROM bugs WHERE severity=%(_b0_s)s) "
+                    "AS _b0, "
+                    "(SELECT count(*) FROM bugs WHERE title LIKE 'RM:%%') "
+                    "AS _b1, "
+                    "(SELECT max(id) FROM bugs WHERE id > %(_b2_0)s) AS _b2")
+        self.assertEqual(params, {'_b0_s': 'serious', '_b2_0': 5})
+        self.assertEqual(len(b), 0)
+
+    def testRows(self):
+        """Test combining row queries of the same shape into one round trip"""
+        columns = Columns('_batch', '_row', 'id', 'tag')
+        conn = FakeConnection([dictrow(columns, 0, 1, 1, 'patch'),
+                               dictrow(columns, 2, 1, 3, 'moreinfo'),
+                               dictrow(columns, 2, 2, 3, 'patch')])
+        b = Batch(conn)
+        sql = "SELECT id, tag FROM bugs_tags WHERE id IN %(bugs)s"
+        f1 = b.query(sql, {'bugs': (1,)})
+        f2 = b.query(sql, {'bugs': (2,)}, one=True)
+        f3 = b.query("SELECT id, tag FROM archived_bugs_tags "
+                     "WHERE id IN %(bugs)s", {'bugs': (3,)},
+                     cursor_factory=psycopg2.extras.DictCursor, shape=sql)
+        b.execute()
+        self.assertEqual(f1.result(), [(1, 'patch')])
+        self.assertEqual(f2.result(), None)
+        self.assertEqual([r['tag'] for r in f3.result()],
+                         ['moreinfo', 'patch'])
+        self.assertEqual(f3.result()[0].keys(), ['id', 'tag'])
+        self.assertEqual(b.round_trips, 1)
+        self.assertEqual(conn.executed[0][0].count("UNION ALL"), 2)
+
+        # different shapes need a round trip each
+        b = Batch(conn)
+        b.query(sql, {'bugs': (1,)})
+        b.query("SELECT 1")
+        b.execute()
+        self.assertEqual(b.round_trips, 2)
+        self.assertEqual(conn.executed[-1], ("SELECT 1", None))
+
+        # ordered queries are run alone so that their order is kept
+        b = Batch(conn)
+        ordered = sql + " ORDER BY tag"
+        b.query(ordered, {'bugs': (1,)})
+        b.query(ordered, {'bugs': (2,)})
+        b.execute()
+        self.assertEqual(b.round_trips, 2)
+        self.assertEqual(conn.executed[-1], (ordered, {'bugs': (2,)}))
+
+    def testFutures(self):
+        """Test executing the batch when a result is first wanted"""
+        conn = FakeConnection([(1,)])
+        with Batch(conn) as b:
+            f = b.scalar("SELECT 1")
+        self.assert_(f.done())
+        b = Batch(conn)
+        f = b.scalar("SELECT 1")
+        self.assertEqual(f.result(), 1)
+        self.assertEqual(b.round_trips, 1)
+        f = Batch().scalar("SELECT 1")
+        self.assertRaises(RuntimeError, f.result)
+
+    def testErrors(self):
+        """Test failing the futures of a statement that fails"""
+        conn = FakeConnection([(1,)])
+        conn.error = True
+        b = Batch(conn)
+        futures = [b.scalar("SELECT 1"), b.scalar("SELECT 2")]
+        b.execute()
+        for f in futures:
+            self.assertRaises(psycopg2.ProgrammingError, f.result)
+
+    def testPlan(self):
+        """Test running a batch within a plan"""
+        def plan():
+            b = Batch()
+            f = b.scalar("SELECT 1")
+            yield b.plan()
+            row = yield Query("SELECT 2", one=True)
+            raise Return((f.result(), row))
+        self.assertEqual(run(plan(), FakeConnection([(1,)])), (1, (1,)))
+
+
+class BatchQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.udd = Udd()
+
+    def tearDown(self):
+        self.udd = None
+
+    def testBatch(self):
+        """Test running a batch of queries on the database"""
+        sql = "SELECT version FROM packages WHERE package=%(p)s " \
+              "ORDER BY version"
+        with self.udd.batch() as b:
+            count = b.scalar("SELECT count(*) FROM packages "
+                             "WHERE package=%(p)s", {'p': 'dpkg'})
+            dpkg = b.query(sql, {'p': 'dpkg'},
+                           cursor_factory=psycopg2.extras.DictCursor)
+            apt = b.query(sql, {'p': 'apt'})
+        self.assertEqual(b.round_trips, 3)
+        self.assertEqual(count.result(), len(dpkg.result()))
+        self.assertEqual([r['version'] for r in dpkg.result()],
+                         [r[0] for r in query(self.udd.pool, sql,
+                                              {'p': 'dpkg'})])
+        self.assertEqual(apt.result(), query(self.udd.pool, sql,
+                                             {'p': 'apt'}))
+
+    def testBugs(self):
+        """Test looking up bugs and their tags together"""
+        tracker = self.udd.Bts(True)
+        numbers = [500000, 500001, 500002, 666666]
+        bugs = tracker.bugs(numbers, tags=True)
+        self.assertEqual(sorted([b.id for b in bugs]), numbers)
+        for b in bugs:
+            plain = tracker.bug(b.id)
+            tracker.get_bugs_tags(plain)
+            self.assertEqual(sorted(b.tags), sorted(plain.tags))
+
+    def testPrefetch(self):
+        """Test looking up the dependencies of a package at once"""
+        release = self.udd.BindRelease(arch='i386', release='sid')
+        checker = Checker(release)
+        checker.Prefetch('dpkg', ['depends', 'recommends'])
+        cached = len(release.cache)
+        self.assert_(cached > 2)
+        checker.Check('dpkg', 'depends')
+        self.assertEqual(len(release.cache), cached)
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
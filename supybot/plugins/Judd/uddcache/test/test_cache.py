@@ -0,0 +1,267 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+""" Unit tests for the cache of query results """
+
+import time
+import unittest2 as unittest
+from uddcache.udd import Udd
+from uddcache.config import Config
+from uddcache.database import query
+from uddcache.cache import QueryCache, ImportWatcher, ObjectCache
+from uddcache.engine import run
+from uddcache.test.fakes import FakeConnection
+
+
+class QueryCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeConnection()
+
+    def testHits(self):
+        """Test reusing the results of identical queries"""
+        results = QueryCache()
+        self.conn.cache = results
+        sql = "SELECT * FROM popcon WHERE package=%(p)s"
+        r1 = query(self.conn, sql, {'p': 'dpkg'}, cache=True)
+        r2 = query(self.conn, "SELECT *  FROM popcon\n WHERE package=%(p)s",
+                   {'p': 'dpkg'}, cache=True)
+        self.assertEqual(r1, r2)
+        self.assert_(r1 is not r2, 'Callers get their own list of rows')
+        query(self.conn, sql, {'p': 'apt'}, cache=True)
+        query(self.conn, sql, {'p': 'apt'}, one=True, cache=True)
+        query(self.conn, sql, {'p': 'apt'})
+        self.assertEqual(len(self.conn.executed), 4)
+        s = results.stats()
+        self.assertEqual(s['hits'], 1)
+        self.assertEqual(s['misses'], 3)
+        self.assertEqual(s['entries'], 3)
+        self.assertEqual(s['hit_rate'], 0.25)
+
+        # unhashable parameters are not cached; lists and tuples differ
+        query(self.conn, sql, {'p': set(['dpkg'])}, cache=True)
+        self.assertEqual(results.stats()['entries'], 3)
+        self.assertNotEqual(results.key(sql, {'p': ['a']}, None, False),
+                            results.key(sql, {'p': ('a',)}, None, False))
+
+    def testSize(self):
+        """Test evicting the least recently used results"""
+        results = QueryCache(size=1500)
+        def fetch(i):
+            results.fetch("SELECT %d" % i, None, None, False,
+                          lambda: ['x' * 500])
+        for i in range(3):
+            fetch(i)
+        s = results.stats()
+        self.assert_(s['bytes'] <= 1500)
+        self.assertEqual(s['entries'], 2)
+        self.assertEqual(s['evictions'], 1)
+        fetch(1)
+        fetch(3)
+        fetch(2)
+        s = results.stats()
+        self.assertEqual(s['hits'], 1)
+        self.assertEqual(s['misses'], 5,
+                         'The least recently used result was evicted')
+        results.fetch("SELECT big", None, None, False, lambda: ['x' * 5000])
+        self.assertEqual(results.stats()['oversize'], 1)
+        results.clear()
+        self.assertEqual(results.stats()['bytes'], 0)
+
+    def testTTL(self):
+        """Test expiring results according to the tables they read"""
+        results = QueryCache(ttl=60, table_ttls=[('bugs*', 0.05),
+                                                 ('popcon', 120)])
+        self.assertEqual(results.ttl_for(['packages']), 60)
+        self.assertEqual(results.ttl_for(['popcon']), 60)
+        self.assertEqual(results.ttl_for(['bugs_packages', 'packages']), 0.05)
+        sql = "SELECT * FROM bugs b JOIN bugs_packages p ON b.id=p.id"
+        results.fetch(sql, None, None, False, lambda: [])
+        results.fetch(sql, None, None, False, lambda: [])
+        time.sleep(0.1)
+        results.fetch(sql, None, None, False, lambda: [])
+        s = results.stats()
+        self.assertEqual(s['hits'], 1)
+        self.assertEqual(s['expirations'], 1)
+
+    def testImports(self):
+        """Test dropping the results made stale by imports"""
+        self.conn.rows = [('debian-sid', 1), ('popcon', 1)]
+        results = QueryCache(self.conn, check_interval=0)
+        self.conn.cache = results
+        query(self.conn, "SELECT * FROM packages", cache=True)
+        query(self.conn, "SELECT * FROM popcon", cache=True)
+        query(self.conn, "SELECT * FROM packages p "
+                         "JOIN popcon c ON p.package=c.package", cache=True)
+        self.assertEqual(results.stats()['entries'], 3)
+        self.conn.rows = [('debian-sid', 2), ('popcon', 1)]
+        query(self.conn, "SELECT * FROM popcon", cache=True)
+        s = results.stats()
+        self.assertEqual(s['entries'], 1)
+        self.assertEqual(s['invalidations'], 2)
+        self.assertEqual(s['hits'], 1)
+        self.conn.rows = [('debian-sid', 2), ('lintian', 1),
+                                    ('popcon', 1)]
+        flushed = []
+        results.listeners.append(flushed.append)
+        results.check_imports()
+        self.assertEqual(results.stats()['entries'], 0,
+                         'Unknown importers drop the whole cache')
+        self.assertEqual(flushed, [None])
+
+    def testSharedWatcher(self):
+        """Test telling the cache and other listeners about imports"""
+        self.conn.rows = [('debian-sid', 1), ('bugs', 1)]
+        watcher = ImportWatcher(self.conn, interval=0)
+        results = QueryCache(watcher=watcher)
+        flushed = []
+        watcher.listeners.append(flushed.append)
+        watcher.check()
+        results.store('key', "SELECT * FROM bugs", [(1,)])
+        self.conn.rows = [('debian-sid', 1), ('bugs', 2)]
+        watcher.check()
+        self.assertEqual(results.stats()['entries'], 0)
+        self.assertEqual(flushed, [['bugs*', 'archived_bugs*']])
+
+    def testWatcher(self):
+        """Test polling the timestamps table"""
+        self.conn.rows = [('bugs', 1)]
+        watcher = ImportWatcher(self.conn, interval=60)
+        self.assertEqual(watcher.changed(), [])
+        self.conn.rows = [('bugs', 2)]
+        self.assertEqual(watcher.changed(), [], 'Polls are rate limited')
+        watcher.interval = 0
+        watcher._next = 0
+        self.assertEqual(watcher.changed(), ['bugs'])
+        self.conn.error = True
+        self.assertEqual(watcher.changed(), [])
+        self.assertEqual(watcher.polls, 2)
+        self.assertEqual(watcher.errors, 1)
+
+    def testWatcherPlan(self):
+        """Test polling the timestamps table from a plan"""
+        self.conn.rows = [('bugs', 1)]
+        watcher = ImportWatcher(self.conn, interval=0)
+        flushed = []
+        watcher.listeners.append(flushed.append)
+        run(watcher.plan(), self.conn)
+        self.conn.rows = [('bugs', 2)]
+        run(watcher.plan(), self.conn)
+        self.assertEqual(flushed, [['bugs*', 'archived_bugs*']])
+        watcher._next = time.time() + 60
+        self.conn.rows = [('bugs', 3)]
+        run(watcher.plan(), self.conn)
+        self.assertEqual(watcher.polls, 2, 'Polls are rate limited')
+        watcher._next = 0
+        self.conn.error = True
+        run(watcher.plan(), self.conn)
+        self.assertEqual(watcher.errors, 1)
+
+
+class ObjectCacheTests(unittest.TestCase):
+    def testNamespaces(self):
+        """Test keeping the objects of several users apart"""
+        objects = ObjectCache()
+        a = objects.namespace('a')
+        b = objects.namespace('b')
+        a['x'] = 1
+        b['x'] = 2
+        self.assertEqual((a['x'], b['x']), (1, 2))
+        self.assert_('x' in a)
+        self.assertFalse('y' in a)
+        self.assertEqual(a.get('y'), None)
+        self.assertRaises(KeyError, lambda: a['y'])
+        self.assertEqual((len(a), len(b)), (1, 1))
+        a.clear()
+        self.assertEqual((len(a), len(b)), (0, 1))
+        s = objects.stats()
+        self.assertEqual((s['hits'], s['misses']), (2, 2))
+        self.assertEqual(s['namespaces'], 1)
+
+    def testLimits(self):
+        """Test evicting the least recently used objects"""
+        objects = ObjectCache(entries=3)
+        ns = objects.namespace('ns')
+        for i in range(3):
+            ns[i] = i
+        ns[0]
+        ns[3] = 3
+        self.assertFalse(1 in ns, 'The least recently used is evicted')
+        self.assert_(0 in ns)
+        self.assertEqual(len(ns), 3)
+        self.assertEqual(objects.stats()['evictions'], 1)
+
+        objects = ObjectCache(size=1500)
+        ns = objects.namespace('ns')
+        for i in range(3):
+            ns[i] = ['x' * 500]
+        s = objects.stats()
+        self.assert_(s['bytes'] <= 1500)
+        self.assertEqual(s['entries'], 2)
+        objects.flush()
+        s = objects.stats()
+        self.assertEqual((s['entries'], s['bytes'], s['flushes']), (0, 0, 1))
+
+
+class UddCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.udd = Udd()
+
+    def tearDown(self):
+        self.udd = None
+
+    def testCache(self):
+        """Test caching the results of the package queries"""
+        self.udd.cache.clear()
+        sql = "SELECT version FROM packages WHERE package=%(p)s"
+        r1 = query(self.udd.pool, sql, {'p': 'dpkg'}, cache=True)
+        r2 = query(self.udd.pool, sql, {'p': 'dpkg'}, cache=True)
+        self.assertEqual(r1, r2)
+        self.assertEqual(self.udd.cache_stats()['hits'], 1)
+        self.assert_(self.udd.cache_stats()['import_polls'])
+
+    def testWithoutCache(self):
+        """Test watching for imports with the cache of results disabled"""
+        udd = Udd(Config(confdict={'cache_size': '0'}))
+        self.assertEqual(udd.cache, None)
+        self.assert_(udd.watcher is not None)
+        udd.BindRelease(release='sid')
+        self.assert_(udd.watcher.polls)
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -91,10 +91,103 @@ class config(unittest.TestCase):
         self.assertEqual(conf.get('nosuchsection', 'hostname', 'quux'), 'quux')
         self.assertEqual(conf.get('database', 'nosuchkey', 'quux'), 'quux')
 
+    def testPool(self):
+        conf = Config(skipDefaultFiles=True, confdict={'database': 'udd'})
+        self.assertEqual(conf.db_pool_size(), 4)
+        self.assertEqual(conf.db_pool_timeout(), 30)
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'pool_size': '2', 'pool_timeout': '5.5'})
+        self.assertEqual(conf.db_pool_size(), 2)
+        self.assertEqual(conf.db_pool_timeout(), 5.5)
+
+    def testPreparedStatements(self):
+        conf = Config(skipDefaultFiles=True, confdict={'database': 'udd'})
+        self.assert_(conf.db_prepared_statements())
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'prepared_statements': 'no'})
+        self.assertFalse(conf.db_prepared_statements())
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'prepared_statements': False})
+        self.assertFalse(conf.db_prepared_statements())
+
+    def testReconnect(self):
+        """Test the reconnection options"""
+        conf = Config(skipDefaultFiles=True, confdict={'database': 'udd'})
+        self.assertEqual(conf.db_reconnect_attempts(), 3)
+        self.assertEqual(conf.db_reconnect_backoff(), 0.5)
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'reconnect_attempts': '0',
+                                'reconnect_backoff': 2})
+        self.assertEqual(conf.db_reconnect_attempts(), 0)
+        self.assertEqual(conf.db_reconnect_backoff(), 2)
+
+    def testReplicas(self):
+        """Test the replica routing options"""
+        conf = Config(skipDefaultFiles=True, confdict={'database': 'udd'})
+        self.assertEqual(conf.db_replicas(), [])
+        self.assertEqual(conf.db_routing(), 'round-robin')
+        self.assertEqual(conf.db_health_check_interval(), 30)
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'replicas': 'host=a; host=b port=5433 \n'
+                                            'postgresql://c/udd;',
+                                'routing': 'latency',
+                                'health_check_interval': '5'})
+        self.assertEqual(conf.db_replicas(), ['host=a', 'host=b port=5433',
+                                              'postgresql://c/udd'])
+        self.assertEqual(conf.db_routing(), 'latency')
+        self.assertEqual(conf.db_health_check_interval(), 5)
+
+    def testCache(self):
+        """Test the query result cache options"""
+        conf = Config(skipDefaultFiles=True, confdict={'database': 'udd'})
+        self.assertEqual(conf.db_cache_size(), 16 * 1024 * 1024)
+        self.assertEqual(conf.db_cache_ttl(), 3600)
+        self.assertEqual(conf.db_cache_table_ttls(), [])
+        self.assertEqual(conf.db_cache_check_interval(), 60)
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'cache_size': '0',
+                                'cache_table_ttls': 'bugs*=600, popcon=86400',
+                                'cache_check_interval': 5})
+        self.assertEqual(conf.db_cache_size(), 0)
+        self.assertEqual(conf.db_cache_table_ttls(),
+                         [('bugs*', 600), ('popcon', 86400)])
+        self.assertEqual(conf.db_cache_check_interval(), 5)
+
+    def testReleaseCache(self):
+        """Test the options for the packages kept for the releases"""
+        conf = Config(skipDefaultFiles=True, confdict={'database': 'udd'})
+        self.assertEqual(conf.db_release_cache_entries(), 20000)
+        self.assertEqual(conf.db_release_cache_size(), 0)
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'release_cache_entries': '500',
+                                'release_cache_size': 1024})
+        self.assertEqual(conf.db_release_cache_entries(), 500)
+        self.assertEqual(conf.db_release_cache_size(), 1024)
+
+    def testReleaseSlices(self):
+        """Test the list of releases held in memory"""
+        conf = Config(skipDefaultFiles=True, confdict={'database': 'udd'})
+        self.assertEqual(conf.db_release_slices(), [])
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'release_slices': 'stable/i386, sid/amd64'})
+        self.assertEqual(conf.db_release_slices(),
+                         [('stable', 'i386'), ('sid', 'amd64')])
+
     def testLogging(self):
         conf = Config()
         self.assert_(conf.db_logging())
 
+    def testLogSampling(self):
+        """Test the query log sampling options"""
+        conf = Config(skipDefaultFiles=True, confdict={'database': 'udd'})
+        self.assertEqual(conf.db_log_slow_ms(), 100)
+        self.assertEqual(conf.db_log_sample_rate(), 0.01)
+        conf = Config(skipDefaultFiles=True,
+                      confdict={'log_slow_ms': '50',
+                                'log_sample_rate': 1})
+        self.assertEqual(conf.db_log_slow_ms(), 50)
+        self.assertEqual(conf.db_log_sample_rate(), 1)
+
 ###########################################################
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,675 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+
+""" Unit tests for the database connection layer """
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest2 as unittest
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+from uddcache.udd import Udd
+from uddcache.config import Config
+from uddcache.database import ConnectionPool, PoolTimeoutError, connection, \
+                              ReplicaRouter, \
+                              query, PreparedStatements, deadline, \
+                              current_deadline, check_deadline, \
+                              DeadlineExceededError, fingerprint, \
+                              LatencyHistogram, QueryStats, query_stats, \
+                              query_origin, query_origins, current_origin, \
+                              QueryLog, query_log, _logging_cursor
+from uddcache.test.fakes import FakeConnection
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def testCheckout(self):
+        """Test checking connections out of and back in to the pool"""
+        pool = ConnectionPool(FakeConnection, size=2, timeout=1)
+        c1 = pool.getconn()
+        c2 = pool.getconn()
+        self.assertNotEqual(c1, c2)
+        self.assertEqual(pool.stats()['in_use'], 2)
+        pool.putconn(c1)
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertEqual(pool.getconn(), c1, 'Idle connections are reused')
+        pool.putconn(c1)
+        pool.putconn(c2, close=True)
+        self.assert_(c2.closed)
+        self.assertEqual(pool.stats()['opened'], 2)
+        self.assertEqual(pool.stats()['in_use'], 0)
+        self.assertRaises(ValueError, ConnectionPool, FakeConnection, size=0)
+
+    def testContextManager(self):
+        """Test checking out a connection for a with block"""
+        pool = ConnectionPool(FakeConnection, size=1, timeout=1)
+        with pool.connection() as conn:
+            self.assertEqual(pool.stats()['in_use'], 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+        with connection(pool) as c:
+            self.assertEqual(c, conn)
+        bare = FakeConnection()
+        with connection(bare) as c:
+            self.assertEqual(c, bare, 'Bare connections are passed through')
+
+    def testSaturation(self):
+        """Test waiting for a connection from a saturated pool"""
+        pool = ConnectionPool(FakeConnection, size=1, timeout=0.1)
+        conn = pool.getconn()
+        self.assertRaises(PoolTimeoutError, pool.getconn)
+        stats = pool.stats()
+        self.assertEqual(stats['saturated'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+
+        def release():
+            time.sleep(0.05)
+            pool.putconn(conn)
+        t = threading.Thread(target=release)
+        t.start()
+        self.assertEqual(pool.getconn(timeout=5), conn)
+        t.join()
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assert_(stats['wait_time'] > 0)
+        self.assert_(stats['max_wait'] > 0)
+
+    def testCloseAll(self):
+        """Test closing all connections in the pool"""
+        pool = ConnectionPool(FakeConnection, size=2)
+        c1 = pool.getconn()
+        c2 = pool.getconn()
+        pool.putconn(c1)
+        pool.closeall()
+        self.assert_(c1.closed)
+        self.assertRaises(psycopg2.pool.PoolError, pool.getconn)
+        pool.putconn(c2)
+        self.assert_(c2.closed, 'Connections returned after closeall are closed')
+
+
+class PreparedStatementsTests(unittest.TestCase):
+    def testPrepare(self):
+        """Test preparing a query once and executing it with parameters"""
+        registry = PreparedStatements()
+        c = FakeConnection().cursor()
+        sql = "SELECT * FROM packages WHERE package=%(package)s " \
+              "AND release = ANY(%(release)s) AND package LIKE 'lib%%' " \
+              "AND source=%(package)s"
+        registry.execute(c, sql, {'package': 'libc6', 'release': ['sid']})
+        self.assertEqual(len(c.executed), 2)
+        prepare, execute = c.executed
+        self.assert_(prepare[0].startswith("PREPARE udd_"))
+        self.assert_(prepare[0].endswith("WHERE package=$1 "
+                        "AND release = ANY($2) AND package LIKE 'lib%' "
+                        "AND source=$1"))
+        self.assertEqual(prepare[1], None)
+        self.assert_(execute[0].startswith("EXECUTE udd_"))
+        self.assert_(execute[0].endswith(" (%s, %s)"))
+        self.assertEqual(execute[1], ['libc6', ['sid']])
+
+        registry.execute(c, sql, {'package': 'dpkg', 'release': ['sid']})
+        self.assertEqual(len(c.executed), 3, 'Shape is only prepared once')
+        self.assertEqual(c.executed[2][1], ['dpkg', ['sid']])
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(registry.executions, 2)
+
+    def testStatementNames(self):
+        """Test that statement names depend only on the query shape"""
+        c1 = FakeConnection().cursor()
+        c2 = FakeConnection().cursor()
+        PreparedStatements().execute(c1, "SELECT %(a)s", {'a': 1})
+        PreparedStatements().execute(c2, "SELECT %(a)s", {'a': 2})
+        self.assertEqual(c1.executed[0][0], c2.executed[0][0])
+        PreparedStatements().execute(c2, "SELECT 1")
+        self.assertNotEqual(c1.executed[0][0], c2.executed[2][0])
+        self.assertEqual(c2.executed[3], ("EXECUTE %s" %
+                            c2.executed[2][0].split()[1], None))
+
+
+class ReconnectTests(unittest.TestCase):
+    def testRetry(self):
+        """Test retrying a query after the connection is lost"""
+        pool = ConnectionPool(FakeConnection, size=2, retries=3, backoff=0.01)
+        conn = pool.getconn()
+        other = pool.getconn()
+        pool.putconn(other)
+        pool.putconn(conn)
+        conn.broken = True
+        self.assertEqual(query(pool, "SELECT 1"), [])
+        self.assert_(conn.closed)
+        self.assert_(other.closed, 'Idle connections are discarded')
+        stats = pool.stats()
+        self.assertEqual(stats['reconnects'], 1)
+        self.assertEqual(stats['opened'], 3)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 1)
+
+    def testGiveUp(self):
+        """Test giving up when the server does not come back"""
+        def connect():
+            conn = FakeConnection()
+            conn.broken = True
+            return conn
+        pool = ConnectionPool(connect, size=1, retries=2, backoff=0.01)
+        self.assertRaises(psycopg2.OperationalError, query, pool, "SELECT 1")
+        self.assertEqual(pool.stats()['reconnects'], 2)
+        self.assertEqual(pool.stats()['opened'], 3)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+        pool = ConnectionPool(connect, size=1, retries=0)
+        self.assertRaises(psycopg2.OperationalError, query, pool, "SELECT 1")
+        self.assertEqual(pool.stats()['reconnects'], 0)
+
+        pool = ConnectionPool(connect, size=1, retries=5, backoff=10)
+        start = time.time()
+        with deadline(0.1):
+            self.assertRaises(DeadlineExceededError, query, pool, "SELECT 1")
+        self.assert_(time.time() - start < 1, 'Retries respect deadlines')
+
+
+class ReplicaRouterTests(unittest.TestCase):
+    def setUp(self):
+        self.servers = {'a': FakeConnection, 'b': FakeConnection}
+
+    def router(self, policy='round-robin'):
+        def pool(name):
+            return ConnectionPool(lambda: self.servers[name](), size=2,
+                                  timeout=1, backoff=0.01)
+        return ReplicaRouter([('a', pool('a')), ('b', pool('b'))],
+                             policy=policy, check_interval=0, backoff=0.01)
+
+    def down(self):
+        raise psycopg2.OperationalError("could not connect to server")
+
+    def testRoundRobin(self):
+        """Test routing to each replica in turn"""
+        router = self.router()
+        used = []
+        for i in range(4):
+            with router.connection() as conn:
+                used.append(conn.replica)
+        self.assertEqual(used, ['a', 'b', 'a', 'b'])
+        stats = router.stats()
+        self.assertEqual(stats['checkouts'], 4)
+        self.assertEqual(stats['opened'], 2)
+        self.assertEqual(stats['replicas']['a']['checkouts'], 2)
+        self.assertRaises(ValueError, ReplicaRouter, [])
+        self.assertRaises(ValueError, ReplicaRouter,
+                          [('a', ConnectionPool(FakeConnection))],
+                          policy='random')
+
+    def testLatency(self):
+        """Test routing to the replica with the lowest latency"""
+        router = self.router('latency')
+        router.replicas[0].observe(50)
+        router.replicas[1].observe(10)
+        for i in range(3):
+            with router.connection() as conn:
+                self.assertEqual(conn.replica, 'b')
+        router.replicas[1].observe(1000)
+        with router.connection() as conn:
+            self.assertEqual(conn.replica, 'a')
+
+        # replicas that have not been measured are tried last
+        router = self.router('latency')
+        router.replicas[1].observe(10)
+        with router.connection() as conn:
+            self.assertEqual(conn.replica, 'b')
+            time.sleep(0.05)
+        self.assertEqual(router.replicas[1].latency, 10,
+                         'Holding a connection is not latency')
+        self.assertEqual(query(router, "SELECT 1"), [])
+        self.assert_(router.replicas[1].latency < 10,
+                     'The statements are timed')
+        self.assert_(router.replicas[0].latency is None)
+
+    def testFailover(self):
+        """Test failing over to another replica"""
+        router = self.router()
+        self.servers['a'] = self.down
+        for i in range(3):
+            with router.connection() as conn:
+                self.assertEqual(conn.replica, 'b')
+        stats = router.stats()
+        self.assertEqual(stats['failovers'], 1)
+        self.assertFalse(stats['replicas']['a']['healthy'])
+        self.assertEqual(stats['replicas']['a']['errors'], 1)
+
+        # a connection that breaks during a query also takes its replica
+        # out of use and the query is retried on the other replica
+        self.servers['a'] = FakeConnection
+        router.check()
+        self.assert_(router.stats()['replicas']['a']['healthy'])
+        conn = router.getconn()
+        router.putconn(conn)
+        conn.broken = True
+        self.assertEqual(query(router, "SELECT 1"), [])
+        self.assertEqual(query(router, "SELECT 1"), [])
+        stats = router.stats()
+        self.assertFalse(stats['replicas'][conn.replica]['healthy'])
+        self.assertEqual(stats['in_use'], 0)
+
+        # the last resort is a replica that is down
+        router = self.router()
+        self.servers['a'] = self.servers['b'] = self.down
+        self.assertRaises(psycopg2.OperationalError, router.getconn)
+        self.servers['a'] = FakeConnection
+        with router.connection() as conn:
+            self.assertEqual(conn.replica, 'a')
+        self.assert_(router.stats()['replicas']['a']['healthy'])
+
+    def testHealthCheck(self):
+        """Test checking the health of the replicas"""
+        router = self.router()
+        conn = router.replicas[0].pool.getconn()
+        conn.broken = True
+        router.replicas[0].pool.putconn(conn)
+        router.check()
+        stats = router.stats()['replicas']
+        self.assertFalse(stats['a']['healthy'])
+        self.assert_(stats['b']['healthy'])
+        self.assert_(stats['b']['latency'] is not None)
+        router.check()
+        self.assert_(router.stats()['replicas']['a']['healthy'])
+        router.closeall()
+
+        router = ReplicaRouter([('a', ConnectionPool(FakeConnection))],
+                               check_interval=0.01)
+        router.replicas[0].healthy = False
+        time.sleep(0.1)
+        self.assert_(router.replicas[0].healthy)
+        router.closeall()
+
+
+class DeadlineTests(unittest.TestCase):
+    def testBudget(self):
+        """Test running out of time within a deadline"""
+        self.assertEqual(current_deadline(), None)
+        with deadline(0.05) as d:
+            self.assertEqual(current_deadline(), d)
+            check_deadline()
+            time.sleep(0.1)
+            self.assertRaises(DeadlineExceededError, check_deadline)
+        self.assertEqual(current_deadline(), None)
+        check_deadline()
+
+    def testNesting(self):
+        """Test that nested deadlines can only shorten the budget"""
+        with deadline(None) as d:
+            self.assertEqual(d, None)
+        with deadline(10) as outer:
+            with deadline(20) as inner:
+                self.assertEqual(inner, outer)
+            with deadline(0) as inner:
+                self.assertEqual(inner, outer)
+            with deadline(1) as inner:
+                self.assertNotEqual(inner, outer)
+                self.assert_(inner.remaining() <= 1)
+            self.assertEqual(current_deadline(), outer)
+
+    def testThreads(self):
+        """Test that a deadline only applies to its own thread"""
+        seen = []
+        t = threading.Thread(target=lambda: seen.append(current_deadline()))
+        with deadline(10):
+            t.start()
+            t.join()
+        self.assertEqual(seen, [None])
+
+    def testStatementTimeout(self):
+        """Test limiting each query with statement_timeout"""
+        pool = ConnectionPool(FakeConnection, size=1)
+        query(pool, "SELECT 1")
+        with pool.connection() as conn:
+            self.assertEqual(conn.executed, [("SELECT 1", None)])
+        del conn.executed[:]
+        with deadline(5):
+            query(pool, "SELECT 1")
+            query(pool, "SELECT 2")
+        self.assertEqual(len(conn.executed), 3)
+        settimeout, select, select2 = conn.executed
+        self.assert_(settimeout[0].startswith("SET statement_timeout = "))
+        self.assert_(0 < int(settimeout[0].split()[-1]) <= 5000)
+        self.assertEqual(select[0], "SELECT 1")
+        self.assertEqual(select2[0], "SELECT 2")
+        del conn.executed[:]
+        # a similar budget reuses the timeout, a much shorter one does not
+        with deadline(5):
+            query(pool, "SELECT 1")
+        self.assertEqual(conn.executed, [("SELECT 1", None)])
+        del conn.executed[:]
+        with deadline(1):
+            query(pool, "SELECT 1")
+        self.assertEqual(len(conn.executed), 2)
+        self.assert_(0 < int(conn.executed[0][0].split()[-1]) <= 1000)
+        del conn.executed[:]
+        # queries without a deadline run with the server's default timeout
+        query(pool, "SELECT 1")
+        query(pool, "SELECT 1")
+        self.assertEqual(conn.executed, [("RESET statement_timeout", None),
+                                         ("SELECT 1", None),
+                                         ("SELECT 1", None)])
+        del conn.executed[:]
+        # as do connections handed out without a deadline
+        with deadline(5):
+            query(pool, "SELECT 1")
+        with connection(pool) as c:
+            c.cursor().execute("SELECT 1")
+        self.assertEqual(conn.executed[-2:], [("RESET statement_timeout",
+                                               None), ("SELECT 1", None)])
+        # and a bare connection is left as it was found
+        bare = FakeConnection()
+        with deadline(5):
+            query(bare, "SELECT 1")
+        self.assertEqual(bare.executed[-1], ("RESET statement_timeout", None))
+
+    def testCancel(self):
+        """Test cancelling queries when the budget runs out"""
+        pool = ConnectionPool(FakeConnection, size=1)
+        with deadline(0.05):
+            with connection(pool) as conn:
+                time.sleep(0.2)
+            self.assertEqual(conn.cancelled, 1)
+            self.assertRaises(DeadlineExceededError, query, pool, "SELECT 1")
+        with deadline(5):
+            def cancelled():
+                with connection(pool):
+                    raise psycopg2.extensions.QueryCanceledError()
+            self.assertRaises(DeadlineExceededError, cancelled)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+    def testPoolWait(self):
+        """Test that waiting for a connection is limited by the deadline"""
+        pool = ConnectionPool(FakeConnection, size=1, timeout=30)
+        conn = pool.getconn()
+        start = time.time()
+        with deadline(0.1):
+            self.assertRaises(DeadlineExceededError, query, pool, "SELECT 1")
+        self.assert_(time.time() - start < 1)
+        pool.putconn(conn)
+
+
+class QueryStatsTests(unittest.TestCase):
+    def testFingerprint(self):
+        """Test normalising queries to their fingerprints"""
+        self.assertEqual(fingerprint("SELECT *\n  FROM packages "
+                            "WHERE package='dpkg' AND release IN ('sid')"),
+                         "SELECT * FROM packages "
+                            "WHERE package=? AND release IN (?)")
+        self.assertEqual(fingerprint("SELECT 1 WHERE id IN (1, 2, 3) "
+                                     "AND x='it''s' AND y=1.5"),
+                         "SELECT ? WHERE id IN (?) AND x=? AND y=?")
+        self.assertEqual(fingerprint("SELECT * FROM bugs_rt_affects_testing "
+                            "WHERE package=%(package)s AND "
+                            "release = ANY(ARRAY['sid', 'wheezy'])"),
+                         "SELECT * FROM bugs_rt_affects_testing "
+                            "WHERE package=? AND release = ANY(?)")
+        self.assertEqual(fingerprint("SELECT %s, $1"), "SELECT ?, ?")
+
+    def testHistogram(self):
+        """Test estimating percentiles from the latency histogram"""
+        h = LatencyHistogram()
+        self.assertEqual(h.percentile(50), 0)
+        for ms in [0.5] * 90 + [15] * 9 + [40000]:
+            h.add(ms)
+        s = h.summary()
+        self.assertEqual(s['calls'], 100)
+        self.assertAlmostEqual(s['total'], 45 + 135 + 40000)
+        self.assertEqual(s['p50'], 1)
+        self.assertEqual(s['p95'], 20)
+        self.assertEqual(s['p99'], 20)
+        self.assertEqual(s['max'], 40000)
+        self.assertEqual(h.percentile(100), 40000)
+
+    def testRecord(self):
+        """Test collecting statistics by fingerprint and origin"""
+        stats = QueryStats()
+        stats.record("SELECT 1", 10, 'a')
+        stats.record("SELECT 2", 20, 'a')
+        stats.record("SELECT * FROM bugs", 5)
+        stats.record("SELECT 3", 50, 'b', 'mirror', error=True)
+        dump = stats.dump()
+        self.assertEqual(dump['fingerprints']['SELECT ?']['calls'], 3)
+        self.assertEqual(dump['fingerprints']['SELECT ?']['errors'], 1)
+        self.assertEqual(dump['origins']['a']['total'], 30)
+        self.assert_('(unknown)' in dump['origins'])
+        self.assertEqual(dump['replicas'].keys(), ['mirror'])
+        self.assertEqual(stats.top(by='replicas', key='errors')[0][0],
+                         'mirror')
+        top = stats.top(1)
+        self.assertEqual(len(top), 1)
+        self.assertEqual(top[0][0], 'SELECT ?')
+        self.assertEqual(stats.top(5, 'mean', 'origins')[0][0], 'b')
+        stats.reset()
+        self.assertEqual(stats.top(), [])
+
+    def testOrigins(self):
+        """Test attributing queries to the method that made them"""
+        @query_origins
+        class Commands(object):
+            def outer(self):
+                return current_origin(), self.inner()
+
+            def inner(self):
+                """inner docstring"""
+                return current_origin()
+
+            def _private(self):
+                return current_origin()
+
+        c = Commands()
+        self.assertEqual(c.outer(), ('test_database.outer',
+                                     'test_database.outer'))
+        self.assertEqual(c.inner(), 'test_database.inner')
+        self.assertEqual(c._private(), None)
+        self.assertEqual(Commands.inner.__doc__, 'inner docstring')
+        with query_origin('x'):
+            self.assertEqual(current_origin(), 'x')
+        self.assertEqual(current_origin(), None)
+
+    def testQuery(self):
+        """Test that queries are timed"""
+        pool = ConnectionPool(FakeConnection, size=1)
+        with query_origin('testQuery'):
+            query(pool, "SELECT 'testQuery'")
+        self.assertEqual(query_stats.dump()['origins']['testQuery']['calls'],
+                         1)
+
+
+class LoggedCursor(object):
+    """ Stand-in for a cursor that has executed a statement """
+    def __init__(self, query, rowcount=1):
+        self.query = query
+        self.rowcount = rowcount
+
+
+class QueryLogTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.logfile = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.logfile)
+
+    def lines(self):
+        return [json.loads(line) for line in open(self.logfile)]
+
+    def testSampling(self):
+        """Test logging slow statements and a sample of the rest"""
+        log = QueryLog(self.logfile, slow_ms=10, sample_rate=0)
+        log.log(LoggedCursor("SELECT 1"), 5)
+        with query_origin('testSampling'):
+            log.log(LoggedCursor("SELECT 'slow'", 0), 20)
+        log.flush()
+        lines = self.lines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['sql'], "SELECT 'slow'")
+        self.assertEqual(lines[0]['fingerprint'], "SELECT ?")
+        self.assertEqual(lines[0]['ms'], 20)
+        self.assertEqual(lines[0]['rows'], 0)
+        self.assertEqual(lines[0]['origin'], 'testSampling')
+        self.assert_(lines[0]['slow'])
+        self.assertAlmostEqual(lines[0]['ts'], time.time(), delta=5)
+
+        log.sample_rate = 1
+        log.log(LoggedCursor("SELECT 2"), 1)
+        log.log(LoggedCursor(None), 1)
+        log.close()
+        lines = self.lines()
+        self.assertEqual(len(lines), 3)
+        self.assertFalse(lines[1]['slow'])
+        self.assertEqual(lines[2]['sql'], '')
+        self.assertEqual(log.stats()['logged'], 3)
+        self.assertEqual(log.stats()['dropped'], 0)
+
+    def testSharedLog(self):
+        """Test that each log file has only one writer"""
+        log = query_log(self.logfile, slow_ms=5)
+        self.assertEqual(query_log(self.logfile), log)
+        self.assertEqual(log.slow_ms, 5)
+        self.assertEqual(query_log(self.logfile, sample_rate=0.5).slow_ms, 5)
+
+    def testLoggingCursor(self):
+        """Test that logging cursor classes are only made once"""
+        cls = _logging_cursor(psycopg2.extras.DictCursor)
+        self.assert_(issubclass(cls, psycopg2.extras.DictCursor))
+        self.assertEqual(_logging_cursor(psycopg2.extras.DictCursor), cls)
+        self.assertNotEqual(_logging_cursor(psycopg2.extensions.cursor), cls)
+
+
+class QueryTests(unittest.TestCase):
+    def setUp(self):
+        self.udd = Udd()
+
+    def tearDown(self):
+        self.udd = None
+
+    def testQuery(self):
+        """Test running a query on a pooled connection"""
+        self.assertEqual(query(self.udd.pool, "SELECT 1"), [(1,)])
+        self.assertEqual(query(self.udd.pool, "SELECT 1", one=True), (1,))
+        self.assertEqual(query(self.udd.pool, "SELECT %(x)s", {'x': 2},
+                               one=True), (2,))
+        self.assertEqual(self.udd.pool_stats()['in_use'], 0)
+
+    def testPreparedQuery(self):
+        """Test running a query as a prepared statement"""
+        sql = "SELECT %(x)s::integer + 1 WHERE 'a' = ANY(%(y)s)"
+        self.assertEqual(query(self.udd.pool, sql, {'x': 1, 'y': ['a']},
+                               prepare=True), [(2,)])
+        self.assertEqual(query(self.udd.pool, sql, {'x': 2, 'y': ['a']},
+                               prepare=True), [(3,)])
+        self.assertEqual(query(self.udd.pool, sql, {'x': 2, 'y': ['b']},
+                               prepare=True), [])
+        with self.udd.connection() as conn:
+            self.assert_(len(conn.prepared))
+
+    def testLogging(self):
+        """Test logging statements from a pooled connection"""
+        fd, logfile = tempfile.mkstemp()
+        os.close(fd)
+        udd = Udd(logfile=logfile)
+        querylog = query_log(logfile, slow_ms=0)
+        query(udd.pool, "SELECT %(x)s", {'x': 1},
+              cursor_factory=psycopg2.extras.DictCursor)
+        query(udd.pool, "SELECT %(x)s", {'x': 2}, prepare=True)
+        querylog.flush()
+        lines = [json.loads(line) for line in open(logfile)]
+        os.remove(logfile)
+        self.assert_("SELECT 1" in [l['sql'] for l in lines])
+
+    def testReconnect(self):
+        """Test recovering from the database backend being killed"""
+        release = self.udd.BindRelease(arch='i386', release='sid')
+        package = release.Package('dpkg')
+        with self.udd.connection() as victim:
+            pid = victim.get_backend_pid()
+            with self.udd.connection() as killer:
+                killer.cursor().execute("SELECT pg_terminate_backend(%s)",
+                                        (pid,))
+        self.assertEqual(query(self.udd.pool, "SELECT 1", one=True), (1,))
+        self.assertEqual(self.udd.pool_stats()['reconnects'], 1)
+        self.assert_(release.Package('dpkg') is package,
+                     'Release caches survive reconnection')
+        self.assert_(release.Package('libc6').Found())
+
+    def testDeadline(self):
+        """Test cancelling a query that exceeds its deadline"""
+        with self.udd.deadline(0.5):
+            self.assertRaises(DeadlineExceededError, query, self.udd.pool,
+                              "SELECT pg_sleep(5)")
+        self.assertEqual(query(self.udd.pool, "SHOW statement_timeout"),
+                         query(self.udd.pool, "RESET statement_timeout; "
+                                              "SHOW statement_timeout"))
+
+    def testReplicaFailover(self):
+        """Test failing over from a replica that cannot be reached"""
+        config = Config(confdict={'replicas': 'connect_timeout=5; '
+                                              'port=1 connect_timeout=1',
+                                  'health_check_interval': 0})
+        udd = Udd(config)
+        for i in range(4):
+            self.assertEqual(query(udd.pool, "SELECT 1", one=True), (1,))
+        stats = udd.pool_stats()
+        self.assertEqual(stats['failovers'], 1)
+        self.assertEqual([r['healthy'] for n, r in
+                            sorted(stats['replicas'].items())], [True, False])
+        self.assert_(udd.query_stats()['replicas'])
+
+    @unittest.skipUnless(os.environ.get('UDD_CACHE_REPLICAS'),
+                         "UDD_CACHE_REPLICAS lists no replicas to test")
+    def testReplicas(self):
+        """Test routing between replicas (see UDD_CACHE_REPLICAS)"""
+        config = Config(confdict={
+                            'replicas': os.environ['UDD_CACHE_REPLICAS'],
+                            'health_check_interval': 0})
+        udd = Udd(config)
+        for i in range(10):
+            self.assert_(udd.BindPackage('dpkg', 'sid', 'i386').Found())
+        stats = udd.pool_stats()['replicas']
+        self.assert_(len(stats) > 1)
+        for replica in stats.values():
+            self.assert_(replica['healthy'])
+            self.assert_(replica['checkouts'])
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
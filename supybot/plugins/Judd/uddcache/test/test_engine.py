@@ -0,0 +1,333 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+
+
+""" Unit tests for query plans and the event loop query engine """
+
+import time
+import types
+import threading
+import unittest2 as unittest
+import psycopg2
+from uddcache.udd import AsyncUdd
+from uddcache.database import deadline, query_origin, current_origin, \
+                              DeadlineExceededError
+from uddcache.engine import Query, Call, Return, Future, TimeoutError, \
+                            AsyncEngine, run, synchronous, asynchronous
+from uddcache import package_queries, bug_queries
+from uddcache.packages import PackageNotFoundError
+from uddcache.bts import Bts, BugNotFoundError
+from uddcache.test.fakes import FakeConnection
+
+
+class EchoConnection(FakeConnection):
+    """ Stand-in for a connection that returns the query as its result """
+    def answer(self, cursor, sql, params):
+        return [(sql, params)]
+
+
+def lookup(name):
+    """ A plan using each kind of step """
+    row = yield Query("SELECT %(name)s", {'name': name}, one=True)
+    value = yield Call(len, name)
+    try:
+        yield Call(int, name)
+    except ValueError:
+        value += 1
+    if name == 'missing':
+        raise PackageNotFoundError(name)
+    raise Return((row, value))
+
+
+def nested(name):
+    """ A plan with a sub-plan """
+    result = yield lookup(name)
+    raise Return(result[1])
+
+
+class Queries(object):
+    def __init__(self, udd):
+        self.udd = udd
+
+    def lookup(self, name):
+        """lookup docstring"""
+        value = yield Call(len, name)
+        raise Return((value, current_origin()))
+
+    def slow(self, seconds):
+        yield Call(time.sleep, seconds)
+
+    def helper(self):
+        return 'not a plan'
+
+
+@synchronous
+class Commands(Queries):
+    pass
+
+
+@asynchronous
+class AsyncCommands(Queries):
+    pass
+
+
+def queries_only(plan):
+    """ Run a plan, answering each query with no rows and refusing Calls """
+    steps = []
+    value = None
+    stack = [plan]
+    while stack:
+        try:
+            step = stack[-1].send(value)
+        except Return, r:
+            stack.pop()
+            value = r.value
+            continue
+        except StopIteration:
+            stack.pop()
+            value = None
+            continue
+        if isinstance(step, Query):
+            steps.append(step)
+            value = [] if not step.one else None
+        elif isinstance(step, types.GeneratorType):
+            stack.append(step)
+            value = None
+        else:
+            raise AssertionError("Blocking step in plan: %r" % step)
+    return steps, value
+
+
+class BtsStub(object):
+    """ Stand-in for a Udd instance that only has a bug tracker """
+    def Bts(self, include_archived=True):
+        return Bts(None, include_archived)
+
+
+class EngineStub(object):
+    """ Stand-in for a Udd instance that only has an engine """
+    def __init__(self, engine):
+        self.engine = engine
+        self.pool = None
+
+
+class FutureTests(unittest.TestCase):
+    def testResult(self):
+        """Test waiting for the result of a future"""
+        f = Future()
+        seen = []
+        f.add_done_callback(seen.append)
+        self.assertFalse(f.done())
+        self.assertRaises(TimeoutError, f.result, 0.01)
+        threading.Timer(0.05, f.set_result, [42]).start()
+        self.assertEqual(f.result(5), 42)
+        self.assert_(f.done())
+        self.assertEqual(seen, [f])
+        self.assertEqual(f.exception(), None)
+        f.add_done_callback(seen.append)
+        self.assertEqual(len(seen), 2, 'Callbacks run when already done')
+        self.assertRaises(RuntimeError, f.set_result, 1)
+
+    def testException(self):
+        """Test futures that finish with an exception"""
+        f = Future()
+        try:
+            raise KeyError('x')
+        except KeyError:
+            import sys
+            f.set_exception(sys.exc_info())
+        self.assertRaises(KeyError, f.result)
+        self.assert_(isinstance(f.exception(), KeyError))
+
+
+class RunTests(unittest.TestCase):
+    def testRun(self):
+        """Test running a plan synchronously"""
+        conn = EchoConnection()
+        self.assertEqual(run(lookup('dpkg'), conn),
+                         (("SELECT %(name)s", {'name': 'dpkg'}), 5))
+        self.assertEqual(run(lookup('12'), conn)[1], 2)
+        self.assertRaises(PackageNotFoundError, run, lookup('missing'), conn)
+        self.assertEqual(run(nested('dpkg'), conn), 5)
+
+        def empty():
+            yield Call(len, '')
+        self.assertEqual(run(empty(), conn), None)
+
+        def bad():
+            yield 'nonsense'
+        self.assertRaises(TypeError, run, bad(), conn)
+
+    def testSynchronous(self):
+        """Test turning plans into ordinary methods"""
+        c = Commands(EngineStub(None))
+        with query_origin('testSynchronous'):
+            self.assertEqual(c.lookup('abc'), (3, 'testSynchronous'))
+        self.assertEqual(Commands.lookup.__doc__, 'lookup docstring')
+        self.assertEqual(c.helper(), 'not a plan')
+        self.assert_(hasattr(package_queries.Commands, 'checkInstall'))
+        self.assert_(hasattr(bug_queries.AsyncCommands, 'rcbugs'))
+        self.assertFalse(hasattr(bug_queries.Commands.bug_package,
+                                 'next'))
+
+    def testBugPlans(self):
+        """Test that the bug plans only query the database in Query steps"""
+        q = bug_queries.Queries(BtsStub())
+        steps, value = queries_only(q.rm('dpkg'))
+        self.assertEqual(len(steps), 1)
+        self.assertEqual(value, [])
+        steps, value = queries_only(q.wnpp('dpkg'))
+        self.assertEqual(len(steps), 1)
+        self.assertRaises(BugNotFoundError, queries_only, q.bug(1, True))
+
+
+class AsyncEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = AsyncEngine(self.connect, size=1, workers=4,
+                                  retries=2, backoff=0.01)
+        self.connections = 0
+
+    def tearDown(self):
+        self.engine.close()
+
+    def connect(self):
+        self.connections += 1
+        raise psycopg2.OperationalError("could not connect to server")
+
+    def testCalls(self):
+        """Test running plans with blocking steps on the workers"""
+        c = AsyncCommands(EngineStub(self.engine))
+        f = c.lookup('abcd')
+        self.assertEqual(f.result(5), (4, 'test_engine.lookup'))
+        start = time.time()
+        futures = [c.slow(0.2) for i in range(4)]
+        [f.result(5) for f in futures]
+        self.assert_(time.time() - start < 0.6, 'Calls run concurrently')
+        self.assertEqual(self.engine.stats()['plans'], 5)
+        self.assertEqual(self.engine.stats()['calls'], 5)
+
+    def testSubPlans(self):
+        """Test running nested plans and errors on the event loop"""
+        def plan(name):
+            value = yield Call(len, name)
+            if not value:
+                raise PackageNotFoundError(name)
+            raise Return(value)
+
+        def outer():
+            value = yield plan('dpkg')
+            try:
+                yield plan('')
+            except PackageNotFoundError:
+                value += 1
+            raise Return(value)
+        self.assertEqual(self.engine.submit(outer()).result(5), 5)
+        self.assertRaises(PackageNotFoundError,
+                          self.engine.submit(plan('')).result, 5)
+
+        def bad():
+            yield 'nonsense'
+        self.assertRaises(TypeError, self.engine.submit(bad()).result, 5)
+
+    def testDeadline(self):
+        """Test that plans are stopped when their budget runs out"""
+        c = AsyncCommands(EngineStub(self.engine))
+        with deadline(0.1):
+            f = c.slow(0.3)
+        self.assertRaises(DeadlineExceededError, f.result, 5)
+
+        def plan():
+            yield Call(time.sleep, 0.2)
+            yield Call(len, 'never called')
+        f = self.engine.submit(plan(), budget=0.1)
+        self.assertRaises(DeadlineExceededError, f.result, 5)
+
+    def testConnectionFailure(self):
+        """Test retrying queries when the server cannot be reached"""
+        f = self.engine.query("SELECT 1")
+        self.assertRaises(psycopg2.OperationalError, f.result, 5)
+        self.assertEqual(self.connections, 3)
+        self.assertEqual(self.engine.stats()['reconnects'], 2)
+
+    def testClose(self):
+        """Test closing the engine"""
+        f = self.engine.query("SELECT 1")
+        self.engine.close()
+        self.assert_(f.done())
+        self.engine.close()
+
+
+class AsyncUddTests(unittest.TestCase):
+    def setUp(self):
+        self.udd = AsyncUdd()
+
+    def tearDown(self):
+        self.udd = None
+
+    def testQuery(self):
+        """Test running queries on the event loop"""
+        self.assertEqual(self.udd.engine.query("SELECT 1").result(10), [(1,)])
+        futures = [self.udd.engine.query("SELECT %(x)s", {'x': i}, one=True)
+                   for i in range(20)]
+        self.assertEqual([f.result(10)[0] for f in futures], range(20))
+        self.assert_(self.udd.engine_stats()['open'] <=
+                     self.udd.engine_stats()['size'])
+
+    def testCommands(self):
+        """Test the asynchronous versions of the commands"""
+        packages = package_queries.AsyncCommands(self.udd)
+        bugs = bug_queries.AsyncCommands(self.udd)
+        self.assert_(packages.versions('libc6', 'sid', 'i386').result(10))
+        self.assertRaises(PackageNotFoundError,
+                          packages.info('nosuchpackage', 'sid', 'i386').result,
+                          10)
+        self.assert_(packages.checkInstall('perl', 'sid', 'i386',
+                                           False).result(60))
+        self.assert_(bugs.bug(500000, True).result(10))
+        self.assert_(bugs.stats().result(60))
+
+    def testCancel(self):
+        """Test cancelling a query that runs out of time"""
+        f = self.udd.engine.query("SELECT pg_sleep(5)", budget=0.5)
+        self.assertRaises(DeadlineExceededError, f.result, 10)
+        self.assertEqual(self.udd.engine_stats()['cancelled'], 1)
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
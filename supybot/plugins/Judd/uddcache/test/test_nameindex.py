@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+
+""" Unit tests for the index of package names """
+
+import unittest2 as unittest
+from uddcache.udd import Udd
+from uddcache.packages import Release, PackageNotFoundError
+from uddcache.nameindex import NameRegistry
+from uddcache.test.fakes import FakeConnection
+
+
+class NamesConnection(FakeConnection):
+    """ Stand-in for a connection that has only the names of packages """
+    def __init__(self):
+        FakeConnection.__init__(self)
+        self.binaries = ['dpkg', 'dpkg-dev', 'libc6', 'libc6-dev', 'perl']
+        self.sources = ['dpkg', 'eglibc', 'perl']
+
+    def answer(self, cursor, sql, params):
+        if 'UNION' in sql:
+            return [(p, 0) for p in self.binaries] + \
+                   [(s, 1) for s in self.sources]
+        elif 'DISTINCT ON (package)' in sql:
+            return [{'package': p, 'source': p} for p in self.binaries]
+        return []
+
+
+class NameIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = NamesConnection()
+        self.registry = NameRegistry()
+
+    def testIndex(self):
+        """Test looking up and suggesting names"""
+        names = self.registry.index(self.conn, ('sid',))
+        self.assert_(names.contains('libc6'))
+        self.assertFalse(names.contains('eglibc'))
+        self.assert_(names.contains('eglibc', binary=False, source=True))
+        self.assertFalse(names.contains('libc6', binary=False, source=True))
+        self.assert_(names.contains('eglibc', source=True))
+        self.assertFalse(names.contains('nosuchpackage', source=True))
+        self.assertEqual(names.suggest('dpgk'), ['dpkg'])
+        self.assertEqual(names.suggest('libc7'), ['libc6'])
+        self.assertEqual(names.suggest('eglib'), [])
+        self.assertEqual(names.suggest('eglib', source=True), ['eglibc'])
+        self.assertEqual(names.suggest('qwerty'), [])
+        self.assertEqual(names.suggest(''), [])
+        s = self.registry.stats()[0]
+        self.assertEqual((s['binaries'], s['sources']), (5, 3))
+        self.assertEqual(s['rejected'], 3)
+        self.assert_(self.registry.current(('sid',)) is names)
+        self.assertEqual(self.registry.current(('wheezy',)), None)
+        self.registry.clear()
+        self.assertEqual(self.registry.current(('sid',)), None)
+
+    def testRelease(self):
+        """Test rejecting names that are not in a release"""
+        r = Release(self.conn, release='sid', arch='i386',
+                    name_registry=self.registry)
+        self.assertFalse(r.Package('dpgk').Found())
+        self.assertEqual(len(self.conn.executed), 1,
+                         'Looked up without an index')
+        e = r.not_found('dpgk')
+        self.assertEqual(e.package, 'dpgk')
+        self.assertEqual(e.suggestions, ['dpkg'])
+        self.assertEqual(len(self.conn.executed), 2, 'Index built')
+        self.assert_(self.registry.current(('sid',)))
+        self.assertEqual(Release(self.conn, release='sid').name_registry
+                            .current(('sid',)), None,
+                         'Index only shared through the registry')
+        self.assertFalse(r.Package('dpkgg').Found())
+        r.prefetch(['perll', 'libc66'])
+        self.assertRaises(PackageNotFoundError, r.Source, 'nosuchpackage')
+        self.assertRaises(PackageNotFoundError, r.Source, 'libc6',
+                          autoBin2Src=False)
+        self.assertEqual(len(self.conn.executed), 2,
+                         'Absent names rejected without queries')
+        try:
+            r.Source('eglib')
+        except PackageNotFoundError, e:
+            self.assertEqual(e.suggestions, ['eglibc'])
+        self.assertEqual(r.Package('perl').Found(), False)
+        self.assertEqual(len(self.conn.executed), 3, 'Known names looked up')
+
+
+class NameIndexQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.udd = Udd()
+
+    def tearDown(self):
+        self.udd = None
+
+    def testSuggest(self):
+        """Test suggesting names from the packages table"""
+        release = self.udd.BindRelease(release='sid')
+        e = release.not_found('dpgk')
+        self.assert_('dpkg' in e.suggestions)
+        self.assertFalse(release.exists('dpgk'))
+        self.assert_(release.exists('dpkg'))
+        self.assert_(self.udd.name_stats()[0]['binaries'] > 1000)
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
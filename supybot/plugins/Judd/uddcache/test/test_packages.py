@@ -39,6 +39,9 @@
 
 from uddcache.udd import Udd
 from uddcache.packages import *
+from uddcache import packages
+from uddcache.cache import ObjectCache
+from uddcache.test.fakes import FakeConnection
 import unittest2 as unittest
 
 
@@ -104,6 +107,53 @@ class ReleaseTests(unittest.TestCase):
         self.assert_(rd.Source('libc6').Found())
         self.assertRaises(PackageNotFoundError, rd.Source, 'libc6', autoBin2Src=False)
 
+    def testResolveSource(self):
+        """Test looking up a source package and its binaries by either name"""
+        rd = Release(self.udd.psql, release='sid')
+        s = rd.ResolveSource('libc6')
+        self.assertEqual(s.package, 'eglibc')
+        self.assert_('libc6' in s.Binaries())
+        self.assertEqual(sorted(s.Binaries()),
+                         sorted(SourcePackage(self.udd.psql, package='eglibc',
+                                              release='sid').Binaries()))
+        self.assertEqual(rd.ResolveSource('eglibc').data['version'],
+                         rd.Source('eglibc').data['version'])
+        self.assertRaises(PackageNotFoundError, rd.ResolveSource,
+                          'nosuchpackage')
+
+    def testPrefetch(self):
+        """Test looking up many binary packages at once"""
+        rs = Release(self.udd.psql, release='sid')
+        rs.prefetch(['libc6', 'dpkg', 'nosuchpackage',
+                     ('dpkg', '>=', '1.0'), ('dpkg', '<<', '1.0')])
+        self.assertEqual(len(rs.cache), 5)
+        self.assert_(rs.Package('libc6').Found())
+        self.assertFalse(rs.Package('nosuchpackage').Found())
+        self.assertEqual(rs.Package('dpkg', '1.0', '>=').data['version'],
+                         rs.Package('dpkg').data['version'])
+        self.assertFalse(rs.Package('dpkg', '1.0', '<<').Found())
+        fresh = Release(self.udd.psql, release='sid')
+        self.assertEqual(rs.Package('libc6').data['version'],
+                         fresh.Package('libc6').data['version'])
+        self.assertEqual(len(rs.Packages(['libc6', 'perl'])), 2)
+        self.assert_(rs.Package('perl').Found())
+
+        # pins decide between the releases, as for Package()
+        rb = Release(self.udd.psql, release=['lenny', 'lenny-backports'],
+                     pins={'lenny': 500, 'lenny-backports': 1})
+        rb.prefetch(['debhelper'])
+        self.assertEqual(rb.Package('debhelper').data['release'], 'lenny')
+
+    def testPrefetchSources(self):
+        """Test looking up many source packages at once"""
+        rs = Release(self.udd.psql, release='sid')
+        rs.prefetch_sources(['eglibc', 'dpkg', 'libc6'])
+        self.assertEqual(len(rs.scache), 3)
+        self.assert_(rs.Source('eglibc').Found())
+        self.assertEqual(rs.Source('libc6').package, 'eglibc')
+        self.assertRaises(PackageNotFoundError, rs.Source, 'libc6',
+                          autoBin2Src=False)
+
     def testArchApplies(self):
         """Test matching arch names and wildcard archs"""
         rd = Release(self.udd.psql, release='sid', arch='i386')
@@ -131,6 +181,178 @@ class ReleaseTests(unittest.TestCase):
         self.assert_(str(rd))
 
 
+class ReleaseCandidatesTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeConnection([
+                {'package': 'libc6', 'version': '2.13-38'},
+                {'package': 'libc6', 'version': '2.11.3-4'},
+            ])
+        self.release = Release(self.conn, release=['sid', 'squeeze'])
+
+    def testConstraints(self):
+        """Test choosing among the versions of a package without queries"""
+        r = self.release
+        self.assertEqual(len(r.Candidates('libc6')), 2)
+        self.assertEqual(r.Package('libc6').data['version'], '2.13-38')
+        self.assertEqual(r.Package('libc6', '2.13', '>=').data['version'],
+                         '2.13-38')
+        self.assertEqual(r.Package('libc6', '2.13', '<<').data['version'],
+                         '2.11.3-4')
+        self.assertEqual(r.Package('libc6', '2.11.3-4', '=').data['version'],
+                         '2.11.3-4')
+        self.assertFalse(r.Package('libc6', '2.11', '<<').Found())
+        self.assertFalse(r.Package('libc6', '2.14', '>>').Found())
+        self.assertEqual(len(self.conn.executed), 1)
+        self.assertRaises(ValueError, r.Package, 'libc6', '2.13', '>')
+
+    def testPrefetch(self):
+        """Test loading the versions of many packages at once"""
+        r = self.release
+        r.prefetch(['libc6', ('libc6', '>=', '2.12'), 'nosuchpackage'])
+        self.assertEqual(len(self.conn.executed), 1)
+        self.assertEqual(len(r.cache), 3)
+        self.assertEqual(r.Candidates('nosuchpackage'), [])
+        self.assertFalse(r.Package('nosuchpackage').Found())
+        r.prefetch(['libc6', ('libc6', '<<', '2.12')])
+        self.assertEqual(len(self.conn.executed), 1)
+
+    def testVersionKey(self):
+        """Test ordering versions as Debian does"""
+        self.assert_(version_key('1.0~rc1') < version_key('1.0'))
+        self.assert_(version_key('1:0.1') > version_key('2.0'))
+        self.assert_(version_key('1.0-1') == version_key('1.0-1'))
+        self.assert_(version_key('1.0') is version_key('1.0'))
+
+
+class ReleaseArchesTests(unittest.TestCase):
+    def setUp(self):
+        def row(arch, version):
+            return {'package': 'libc6', 'version': version,
+                    'architecture': arch}
+        self.conn = FakeConnection([row('amd64', '2.13-38'),
+                                    row('armel', '2.13-37'),
+                                    row('all', '2.11.3-4')])
+        releases = [Release(self.conn, release='sid', arch=arch)
+                        for arch in ('amd64', 'armel', 'mips')]
+        self.arches = ReleaseArches(releases)
+
+    def testPrefetch(self):
+        """Test looking up packages in several architectures at once"""
+        self.arches.prefetch(['libc6'])
+        sql, params = self.conn.executed[0]
+        self.assertEqual(params['arches'], ['amd64', 'armel', 'mips'])
+        packages = self.arches.Package('libc6')
+        self.assertEqual(packages['amd64'].data['version'], '2.13-38')
+        self.assertEqual(packages['armel'].data['version'], '2.13-37')
+        self.assertEqual(packages['mips'].data['version'], '2.11.3-4')
+        self.assertEqual(len(self.arches.Release('mips').Candidates('libc6')),
+                         1)
+        self.arches.prefetch(['libc6'])
+        self.assertEqual(len(self.conn.executed), 1)
+
+
+class ProfileTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeConnection([
+                {'package': 'libc6', 'version': '2.13-38',
+                 'architecture': 'i386', 'distribution': 'debian',
+                 'release': 'sid', 'component': 'main'},
+            ])
+
+    def testRelations(self):
+        """Test reading just the columns needed to check relationships"""
+        r = Release(self.conn, release='sid')
+        p = r.Package('libc6')
+        sql, params = self.conn.executed[0]
+        self.assertFalse('*' in sql)
+        self.assert_('depends' in sql)
+        self.assertEqual(p.data['version'], '2.13-38')
+        self.conn.rows = [{'package': 'libc6', 'version': '2.13-38',
+                           'maintainer': 'GNU Libc Maintainers'}]
+        self.assertEqual(p.data['maintainer'], 'GNU Libc Maintainers')
+        self.assertEqual(len(self.conn.executed), 2)
+        sql, params = self.conn.executed[1]
+        self.assertEqual(params['release'], 'sid')
+        self.assertEqual(params['component'], 'main')
+        self.assertEqual(p.data['release'], 'sid')
+        self.assertEqual(p.data.get('nosuchcolumn'), None)
+        self.assertEqual(len(self.conn.executed), 2)
+
+    def testAll(self):
+        """Test reading all the columns at once"""
+        r = Release(self.conn, release='sid', profile=None)
+        r.Package('libc6')
+        self.assert_('SELECT *' in self.conn.executed[0][0])
+
+    def testLazyRow(self):
+        """Test reading the rest of a row on first use"""
+        loads = []
+        def load(row):
+            loads.append(row)
+            return {'package': 'dpkg', 'section': 'admin'}
+        row = LazyRow({'package': 'dpkg'}, load)
+        self.assertEqual(row['package'], 'dpkg')
+        self.assertEqual(loads, [])
+        self.assert_('section' in row)
+        self.assertEqual(row['section'], 'admin')
+        self.assertRaises(KeyError, lambda: row['nosuchcolumn'])
+        self.assertEqual(sorted(row.keys()), ['package', 'section'])
+        self.assertEqual(len(loads), 1)
+        row = LazyRow({'package': 'dpkg'}, load)
+        self.assertEqual(len(row), 2)
+        self.assertEqual(list(row), ['dpkg', 'admin'])
+        self.assertEqual(row.values(), ['dpkg', 'admin'])
+        self.assertEqual(dict(row), {'package': 'dpkg', 'section': 'admin'})
+        self.assertEqual(row.copy(), dict(row.iteritems()))
+        self.assert_(row.has_key('section'))
+        self.assertEqual(len(loads), 2)
+
+
+class ReleaseRegistryTests(unittest.TestCase):
+    def testRegistry(self):
+        """Test sharing the releases and their packages"""
+        conn = FakeConnection([{'package': 'dpkg', 'version': '1.16'}])
+        releases = ReleaseRegistry(conn, ObjectCache())
+        r = releases.get('sid', 'i386')
+        self.assert_(r is releases.get(('sid',), 'i386'))
+        self.assert_(r is not releases.get('sid', 'amd64'))
+        pinned = releases.get(['sid', 'wheezy'], 'i386',
+                              pins={'sid': 1, 'wheezy': 2})
+        self.assert_(pinned is releases.get(('sid', 'wheezy'), 'i386',
+                              pins={'wheezy': 2, 'sid': 1}))
+        made = []
+        original = packages.Release
+        packages.Release = lambda *args, **kwargs: made.append(args)
+        try:
+            releases.get('sid', 'i386')
+        finally:
+            packages.Release = original
+        self.assertEqual(made, [], 'Releases are only made when missing')
+        p = r.Package('dpkg')
+        self.assert_(p is r.Package('dpkg'))
+        self.assert_(p is releases.get('sid', 'i386').Package('dpkg'))
+        self.assertEqual(len(conn.executed), 1)
+        releases.get('sid', 'amd64').Package('dpkg')
+        self.assertEqual(len(conn.executed), 2)
+        s = releases.stats()
+        self.assertEqual(s['releases'], 3)
+        self.assertEqual(s['entries'], 4, 'Packages and their candidates')
+        releases.flush()
+        self.assertEqual(len(r.cache), 0)
+        self.assert_(p is not r.Package('dpkg'))
+
+    def testUdd(self):
+        """Test binding the shared releases"""
+        udd = Udd()
+        r = udd.BindRelease('sid', 'i386')
+        self.assert_(r is udd.BindRelease(release='sid', arch='i386'))
+        p = udd.BindPackage('dpkg', 'sid', 'i386')
+        self.assert_(p is r.Package('dpkg'))
+        self.assertEqual(udd.release_stats()['entries'], 1)
+        udd.flush()
+        self.assertEqual(udd.release_stats()['entries'], 0)
+
+
 class PackageTests(unittest.TestCase):
     def setUp(self):
         self.udd = Udd()
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+""" Unit tests for the index of virtual packages """
+
+import threading
+import unittest2 as unittest
+from uddcache.udd import Udd
+from uddcache.packages import Package, Release
+from uddcache import provides
+from uddcache.provides import ProvidesIndex, ProvidesRegistry, \
+                               parse_provides
+from uddcache.test.fakes import FakeConnection
+
+
+class ProvidesIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeConnection([
+                {'package': 'exim4-daemon-light',
+                 'provides': 'mail-transport-agent'},
+                {'package': 'postfix',
+                 'provides': 'mail-transport-agent, default-mta'},
+                {'package': 'mawk', 'provides': 'awk'},
+                {'package': 'libfoo1', 'provides': 'libfoo-abi (= 1.0)'},
+            ])
+        self.registry = ProvidesRegistry()
+
+    def testParse(self):
+        """Test splitting the Provides field"""
+        self.assertEqual(parse_provides('awk'), ['awk'])
+        self.assertEqual(parse_provides('a, b (= 1.0),c'), ['a', 'b', 'c'])
+        self.assertEqual(parse_provides(''), [])
+
+    def testProviders(self):
+        """Test looking up the providers of virtual packages"""
+        r = self.registry
+        self.assertEqual(r.providers(self.conn, ('sid',), 'i386',
+                                     'mail-transport-agent'),
+                         ['exim4-daemon-light', 'postfix'])
+        self.assertEqual(r.providers(self.conn, ('sid',), 'i386', 'awk'),
+                         ['mawk'])
+        self.assertEqual(r.providers(self.conn, ('sid',), 'i386',
+                                     'libfoo-abi'), ['libfoo1'])
+        self.assertEqual(r.providers(self.conn, ('sid',), 'i386', 'mawk'),
+                         [])
+        self.assertEqual(len(self.conn.executed), 1)
+        self.assertEqual(r.builds, 1)
+        r.providers(self.conn, ('sid',), 'amd64', 'awk')
+        self.assertEqual(r.builds, 2)
+
+    def testArches(self):
+        """Test building the indexes of several architectures at once"""
+        self.conn.rows[1]['architecture'] = 'amd64'
+        for row in self.conn.rows:
+            row.setdefault('architecture', 'all')
+        r = self.registry
+        r.index(self.conn, ('sid',), 'i386')
+        amd64, i386, armel = r.indexes(self.conn, ('sid',),
+                                       ['amd64', 'i386', 'armel'])
+        self.assertEqual(len(self.conn.executed), 2)
+        self.assertEqual(self.conn.executed[1][1]['arches'],
+                         ['amd64', 'armel'])
+        self.assertEqual(amd64.providers('default-mta'), ['postfix'])
+        self.assertEqual(armel.providers('default-mta'), [])
+        self.assertEqual(armel.providers('awk'), ['mawk'])
+        self.assert_(i386 is r.index(self.conn, ('sid',), 'i386'))
+        r.indexes(self.conn, ('sid',), ['amd64', 'armel'])
+        self.assertEqual(len(self.conn.executed), 2)
+
+    def testStats(self):
+        """Test the stats and the rebuilding of the index"""
+        r = self.registry
+        self.assertEqual(r.stats(), [])
+        r.index(self.conn, ('sid',), 'i386')
+        s = r.stats()[0]
+        self.assertEqual(s['virtuals'], 4)
+        self.assertEqual(s['providers'], 5)
+        self.assert_(s['bytes'] > 0)
+        self.assert_(s['build_ms'] >= 0)
+        r.index(self.conn, ('sid',), 'i386')
+        self.assertEqual(r.builds, 1)
+        r.max_age = -1
+        r.index(self.conn, ('sid',), 'i386')
+        self.assertEqual(r.builds, 2)
+        r.clear()
+        self.assertEqual(r.stats(), [])
+
+    def testConcurrentBuilds(self):
+        """Test that building one index does not hold up the others"""
+        r = self.registry
+        slow = set(['armel'])
+        started = threading.Event()
+        finish = threading.Event()
+
+        class SlowIndex(ProvidesIndex):
+            def build(idx, dbconn):
+                if idx.arch in slow:
+                    started.set()
+                    finish.wait(5)
+                ProvidesIndex.build(idx, dbconn)
+
+        def build(arch):
+            t = threading.Thread(target=r.index,
+                                 args=(self.conn, ('sid',), arch))
+            t.start()
+            self.assert_(started.wait(5))
+            return t
+
+        r._make = SlowIndex
+        t = build('armel')
+        self.assertEqual(r.providers(self.conn, ('sid',), 'i386', 'awk'),
+                         ['mawk'])
+        finish.set()
+        t.join()
+        self.assertEqual(r.builds, 2)
+        # a stale index is used while it is being rebuilt
+        old = r.index(self.conn, ('sid',), 'i386')
+        old.built -= 2 * r.max_age
+        slow.add('i386')
+        started.clear()
+        finish.clear()
+        t = build('i386')
+        self.assert_(r.index(self.conn, ('sid',), 'i386') is old)
+        finish.set()
+        t.join()
+        self.assertEqual(r.builds, 3)
+        self.assertFalse(r.index(self.conn, ('sid',), 'i386') is old)
+
+    def testPackage(self):
+        """Test answering Package.ProvidersList from the index"""
+        p = Package(self.conn, release='sid', arch='i386',
+                    package='mail-transport-agent', fetch=False)
+        p.data = None
+        p.registry = self.registry
+        self.assert_(p.IsVirtualOnly())
+        self.assertEqual(p.ProvidersList(),
+                         ['exim4-daemon-light', 'postfix'])
+        p = Package(self.conn, release='sid', arch='i386',
+                    package='mawk', fetch=False)
+        p.registry = self.registry
+        self.assertFalse(p.IsVirtual())
+        self.assertEqual(self.registry.builds, 1)
+
+    def testRegistries(self):
+        """Test that each database has its own provides indexes"""
+        r = Release(self.conn, release='sid', arch='i386',
+                    provides_registry=self.registry)
+        other = Release(self.conn, release='sid', arch='i386')
+        self.assertEqual(r.Package('mawk').registry, self.registry)
+        self.assertNotEqual(other.provides_registry, self.registry)
+        r.provides_registry.index(self.conn, ('sid',), 'i386')
+        self.assertEqual(other.provides_registry.stats(), [])
+
+
+class ProvidesQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.udd = Udd()
+
+    def tearDown(self):
+        self.udd = None
+
+    def testIndex(self):
+        """Test the index against the packages table"""
+        release = self.udd.BindRelease(arch='i386', release='sid')
+        p = release.Package('mail-transport-agent')
+        self.assert_(p.IsVirtual())
+        self.assert_('postfix' in p.ProvidersList())
+        self.assertEqual(provides.find_providers(self.udd.pool, ('sid',),
+                                    'i386', 'mail-transport-agent'),
+                         p.ProvidersList())
+        self.assertFalse(release.Package('dpkg').IsVirtual())
+        stats = self.udd.provides_stats()
+        self.assert_(stats)
+        self.assert_(stats[0]['virtuals'] > 100)
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
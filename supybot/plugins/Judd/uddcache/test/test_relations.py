@@ -49,6 +49,48 @@ if os.environ.has_key('UDD_SKIP_SLOW_TESTS') and int(os.environ['UDD_SKIP_SLOW_T
     #print "Skipping slow tests in %s" % __file__
     includeSlowTests = 0
 
+class ParseTests(unittest.TestCase):
+    def testParseRelation(self):
+        """Test parsing relationships into shared immutable forms"""
+        p = parse_relation("pkg (>= 1.0) [amd64 i386]")
+        self.assertEqual(p, ("pkg (>= 1.0) [amd64 i386]", "pkg", ">=", "1.0",
+                             ("amd64", "i386")))
+        self.assert_(parse_relation("pkg (>= 1.0) [amd64 i386]") is p)
+        self.assertRaises(AttributeError, setattr, p, 'package', 'other')
+        self.assertRaises(ValueError, parse_relation, "pkg >> 1.0")
+        self.assertRaises(ValueError, parse_relation, "pkg >> 1.0")
+
+    def testParseLists(self):
+        """Test parsing options and lists of relationships once"""
+        o = parse_options("a (>> 1.0 ) | b (= 2.0)")
+        self.assertEqual([r.package for r in o], ["a", "b"])
+        self.assert_(parse_options("a (>> 1.0 ) | b (= 2.0)") is o)
+        l = parse_relationships("c, a (>> 1.0 ) | b (= 2.0)")
+        self.assertEqual([text for text, options in l],
+                         ["c", "a (>> 1.0 ) | b (= 2.0)"])
+        self.assert_(l[1][1] is o)
+        self.assert_(parse_relationships("c, a (>> 1.0 ) | b (= 2.0)") is l)
+
+    def testRecords(self):
+        """Test that each check has its own records of the outcome"""
+        o1 = RelationshipOptions("a | b [amd64]")
+        o2 = RelationshipOptions("a | b [amd64]")
+        o1.satisfiedBy = o1[0]
+        o1[0].virtual = True
+        self.assertEqual(o2.satisfiedBy, None)
+        self.assertFalse(o2[0].virtual)
+        self.assert_(o1[1].arch is o2[1].arch)
+
+    def testSlots(self):
+        """Test that relationships hold no dict of attributes"""
+        o = RelationshipOptions("a | b [amd64]")
+        self.assertFalse(hasattr(o, '__dict__'))
+        self.assertFalse(hasattr(o[0], '__dict__'))
+        self.assertFalse(hasattr(RelationshipOptionsList(), '__dict__'))
+        self.assertRaises(AttributeError, setattr, o[0], 'nosuchattr', 1)
+        self.assert_(o[1].package is intern("b"))
+
+
 class RelationshipTests(unittest.TestCase):
     def testRelationship(self):
         """Test construction/parsing of package relationships"""
@@ -63,18 +105,18 @@ class RelationshipTests(unittest.TestCase):
         r = Relationship(relation="pkg (= 1.2-3release4.1)")
         self.assert_(r.package == "pkg" and r.operator == "=" and r.version == "1.2-3release4.1" and not(r.arch))
         r = Relationship(relation="pkg [amd64]")
-        self.assert_(r.package == "pkg" and not(r.operator) and not(r.version) and r.arch == ["amd64"])
+        self.assert_(r.package == "pkg" and not(r.operator) and not(r.version) and r.arch == ("amd64",))
         r = Relationship(relation="pkg [!amd64]")
-        self.assert_(r.package == "pkg" and not(r.operator) and not(r.version) and r.arch == ["!amd64"])
+        self.assert_(r.package == "pkg" and not(r.operator) and not(r.version) and r.arch == ("!amd64",))
         r = Relationship(relation="pkg (>> 1.0) [amd64]")
-        self.assert_(r.package == "pkg" and r.operator == ">>" and r.version == "1.0" and r.arch == ["amd64"])
+        self.assert_(r.package == "pkg" and r.operator == ">>" and r.version == "1.0" and r.arch == ("amd64",))
 
         r = Relationship(package="pkg", operator=">>", version="1.0", arch="amd64")
-        self.assert_(r.package == "pkg" and r.operator == ">>" and r.version == "1.0" and r.arch == ["amd64"])
+        self.assert_(r.package == "pkg" and r.operator == ">>" and r.version == "1.0" and r.arch == ("amd64",))
         r = Relationship(package="pkg", operator=">>", version="1.0", arch=["amd64", "i386"])
-        self.assert_(r.package == "pkg" and r.operator == ">>" and r.version == "1.0" and r.arch == ["amd64", "i386"])
+        self.assert_(r.package == "pkg" and r.operator == ">>" and r.version == "1.0" and r.arch == ("amd64", "i386"))
         r = Relationship(package="pkg", operator=">>", version="1.0", arch="amd64 i386")
-        self.assert_(r.package == "pkg" and r.operator == ">>" and r.version == "1.0" and r.arch == ["amd64", "i386"])
+        self.assert_(r.package == "pkg" and r.operator == ">>" and r.version == "1.0" and r.arch == ("amd64", "i386"))
 
         # catch over-specification
         self.assertRaises(ValueError, Relationship, relation="pkg", package="pkg")
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+
+
+""" Unit tests for the compact rows of query results """
+
+import sys
+import pickle
+import psycopg2.extras
+import unittest2 as unittest
+from uddcache.udd import Udd
+from uddcache.database import query
+from uddcache.rows import Row, RowCursor, row_class
+
+
+class RowTests(unittest.TestCase):
+    def testRowClass(self):
+        """Test making the classes of rows for the columns of queries"""
+        cls = row_class(['package', 'version'])
+        self.assert_(issubclass(cls, Row))
+        self.assert_(row_class(('package', 'version')) is cls)
+        self.assertFalse(row_class(['package']) is cls)
+        self.assertEqual(cls._fields, ('package', 'version'))
+
+    def testAccess(self):
+        """Test reading rows by position, column name and attribute"""
+        row = row_class(['package', 'version', 'keys'])(('dpkg', '1.16.9',
+                                                           'k'))
+        self.assertEqual(row['package'], 'dpkg')
+        self.assertEqual(row[1], '1.16.9')
+        self.assertEqual(row.version, '1.16.9')
+        self.assertEqual(row[:2], ('dpkg', '1.16.9'))
+        self.assertEqual(row['keys'], 'k')
+        self.assertEqual(row.keys(), ['package', 'version', 'keys'])
+        self.assertEqual(row.items()[0], ('package', 'dpkg'))
+        self.assertEqual(row.copy()['version'], '1.16.9')
+        self.assert_('version' in row)
+        self.assertFalse('dpkg' in row)
+        self.assertRaises(KeyError, lambda: row['nosuchcolumn'])
+        self.assertEqual(row.get('nosuchcolumn', 'x'), 'x')
+        self.assertRaises(AttributeError, setattr, row, 'package', 'apt')
+        self.assertEqual(row, ('dpkg', '1.16.9', 'k'))
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+        self.assert_(type(pickle.loads(pickle.dumps(row))) is type(row))
+
+    def testSize(self):
+        """Test that rows are smaller than the rows of a DictCursor"""
+        columns = ['package', 'version', 'architecture', 'release']
+        values = ('dpkg', '1.16.9', 'amd64', 'sid')
+        row = row_class(columns)(values)
+
+        class Cursor(object):
+            description = columns
+            index = dict([(c, i) for i, c in enumerate(columns)])
+        dictrow = psycopg2.extras.DictRow(Cursor())
+        dictrow[:] = values
+        self.assert_(sys.getsizeof(row) < sys.getsizeof(dictrow))
+        self.assertFalse(hasattr(row, '__dict__'))
+
+
+class RowCursorTests(unittest.TestCase):
+    def setUp(self):
+        self.udd = Udd()
+
+    def tearDown(self):
+        self.udd = None
+
+    def testQuery(self):
+        """Test reading rows with a RowCursor"""
+        sql = "SELECT package, version FROM packages " \
+              "WHERE package=%(package)s AND release='sid'"
+        rows = query(self.udd.pool, sql, {'package': 'dpkg'},
+                     cursor_factory=RowCursor)
+        self.assert_(rows)
+        self.assertEqual(rows[0]['package'], 'dpkg')
+        self.assertEqual(rows[0].version, rows[0][1])
+        self.assert_(type(rows[0]) is type(rows[-1]))
+        row = query(self.udd.pool, sql, {'package': 'nosuchpackage'},
+                    cursor_factory=RowCursor, one=True)
+        self.assertEqual(row, None)
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+""" Unit tests for the releases held in memory """
+
+import threading
+import unittest2 as unittest
+from uddcache.udd import Udd
+from uddcache.packages import Release, PackageNotFoundError
+from uddcache.resolver import Checker
+from uddcache.slices import ReleaseSlice, SliceStore
+from uddcache.test.fakes import FakeConnection
+
+
+def row(package, version, source=None, provides=None, depends=None):
+    values = dict(package=package, version=version, architecture='amd64',
+                  distribution='debian', release='sid', component='main',
+                  source=source or package, provides=provides,
+                  depends=depends)
+    return tuple([values.get(c) for c in ReleaseSlice.columns])
+
+
+class SliceTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeConnection([
+                row('exim4-daemon-light', '4.80-7',
+                    provides='mail-transport-agent'),
+                row('libc6', '2.13-38', source='eglibc'),
+                row('libc6', '2.11.3-4', source='eglibc'),
+                row('mutt', '1.5.21-6', depends='libc6 (>= 2.7), '
+                        'exim4-daemon-light | mail-transport-agent'),
+            ])
+        self.store = SliceStore(self.conn, [(('sid',), 'amd64')])
+        self.store.load()
+
+    def testSlice(self):
+        """Test reading a release into memory"""
+        sl = self.store.get(('sid',), 'amd64')
+        self.assertEqual([r['version'] for r in sl.candidates('libc6')],
+                         ['2.13-38', '2.11.3-4'])
+        self.assertEqual(sl.candidates('nosuchpackage'), [])
+        self.assertEqual(sl.source('libc6'), 'eglibc')
+        self.assertEqual(sl.source('nosuchpackage'), None)
+        self.assertEqual(sl.providers('mail-transport-agent'),
+                         ['exim4-daemon-light'])
+        self.assertEqual(self.store.get(('sid',), 'i386'), None)
+        s = self.store.stats()[0]
+        self.assertEqual((s['packages'], s['rows'], s['virtuals']),
+                         (3, 4, 1))
+        self.assert_(s['bytes'] > 0)
+        self.assert_(sl.data['package'][1] is sl.data['package'][2],
+                     'Strings are interned')
+
+    def testRelease(self):
+        """Test looking up the packages of a release without queries"""
+        r = Release(self.conn, release='sid', arch='amd64',
+                    slices=self.store)
+        self.assertEqual(r.Package('libc6', '2.12', '<<').data['version'],
+                         '2.11.3-4')
+        self.assertFalse(r.Package('nosuchpackage').Found())
+        self.assertEqual(r.bin2src('libc6'), 'eglibc')
+        self.assert_(r.Package('mail-transport-agent').IsVirtualOnly())
+        status = Checker(r).Check('mutt', 'depends')
+        self.assertEqual(len(status.good), 2)
+        self.assertEqual(len(status.bad), 0)
+        self.assertEqual(len(self.conn.executed), 1, 'Only the slice is read')
+
+        # other columns are read from the database
+        self.conn.rows = [{'package': 'libc6', 'maintainer': 'GNU Libc'}]
+        self.assertEqual(r.Package('libc6').data['maintainer'], 'GNU Libc')
+        self.assertEqual(self.conn.executed[-1][1]['version'], '2.13-38')
+
+        # releases with pins aren't held
+        r = Release(self.conn, release='sid', arch='amd64',
+                    pins={'sid': 1}, slices=self.store)
+        r.Package('libc6')
+        self.assertEqual(len(self.conn.executed), 3)
+
+    def testReload(self):
+        """Test reloading the slices in the background"""
+        old = self.store.get(('sid',), 'amd64')
+        self.store.reload()
+        self.store.wait(5)
+        self.assertEqual(self.store.loads, 2)
+        self.assert_(self.store.get(('sid',), 'amd64') is not old)
+        self.conn.error = True
+        self.store.reload()
+        self.store.wait(5)
+        self.assertEqual(self.store.errors, 1)
+        self.assert_(self.store.get(('sid',), 'amd64'),
+                     'The old slices are kept')
+
+    def testImportDuringLoad(self):
+        """Test reloading when an import arrives during a reload"""
+        loading = threading.Event()
+        go = threading.Event()
+
+        class SlowConnection(FakeConnection):
+            def cursor(self, cursor_factory=None):
+                loading.set()
+                go.wait(5)
+                return FakeConnection.cursor(self, cursor_factory)
+
+        store = SliceStore(SlowConnection(self.conn.rows),
+                           [(('sid',), 'amd64')])
+        installed = []
+        store.listeners.append(
+                lambda: installed.append(store.get(('sid',), 'amd64')))
+        store.reload()
+        self.assert_(loading.wait(5))
+        store.reload()
+        go.set()
+        store.wait(5)
+        self.assertEqual(store.loads, 2, 'The import is not dropped')
+        self.assertEqual(len(installed), 2)
+        self.assert_(installed[-1] is store.get(('sid',), 'amd64'),
+                     'The listeners are told once the slices are in use')
+        store.reload()
+        store.wait(5)
+        self.assertEqual(store.loads, 3)
+
+
+class SliceQueryTests(unittest.TestCase):
+    def testUdd(self):
+        """Test holding a release in memory"""
+        udd = Udd()
+        udd.slices.wanted = [(('sid',), 'amd64')]
+        udd.slices.load()
+        r = udd.BindRelease('sid', 'amd64')
+        fresh = Release(udd.psql, release='sid', arch='amd64')
+        self.assertEqual(r.Package('libc6').data['version'],
+                         fresh.Package('libc6').data['version'])
+        self.assertEqual(r.Package('libc6').ProvidersList(),
+                         fresh.Package('libc6').ProvidersList())
+        self.assert_(udd.slice_stats()[0]['packages'] > 1000)
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+
+""" Unit tests for the snapshots of UDD in a local file """
+
+import os
+import shutil
+import tempfile
+import datetime
+import psycopg2.extras
+import unittest2 as unittest
+from uddcache.udd import Udd, AsyncUdd
+from uddcache.package_queries import Commands
+from uddcache.packages import PackageNotFoundError
+from uddcache import snapshot
+from uddcache.snapshot import Snapshot, translate
+from uddcache.test.fakes import FakeConnection
+
+
+TEXT = 25
+INTEGER = 23
+TIMESTAMP = 1114
+
+PACKAGE_COLUMNS = ['package', 'version', 'architecture', 'distribution',
+                   'release', 'component', 'source', 'provides', 'depends',
+                   'pre_depends', 'recommends', 'suggests', 'enhances',
+                   'conflicts', 'breaks', 'replaces', 'section', 'priority',
+                   'size', 'installed_size', 'description', 'homepage']
+
+
+def package(name, version, release, arch='amd64', source=None,
+            depends='', provides=''):
+    row = dict([(c, None) for c in PACKAGE_COLUMNS])
+    row.update(package=name, version=version, architecture=arch,
+               distribution='debian', release=release, component='main',
+               source=source or name, provides=provides, depends=depends,
+               section='admin', priority='optional', size=2048,
+               installed_size=4, description='%s package' % name)
+    return [row[c] for c in PACKAGE_COLUMNS]
+
+
+TABLES = {
+    'packages': (
+        [(c, c.endswith('size') and INTEGER or TEXT)
+            for c in PACKAGE_COLUMNS],
+        [package('libc6', '2.13-38', 'sid', source='eglibc'),
+         package('dpkg', '1.16.9', 'sid', depends='libc6 (>= 2.11)'),
+         package('dpkg', '1.16.10', 'experimental',
+                 depends='libc6 (>= 2.14)'),
+         package('exim4', '4.80-7', 'sid', arch='all',
+                 provides='mail-transport-agent'),
+         package('mutt', '1.5.21-6', 'sid',
+                 depends='libc6 (>= 2.11), default-mta | '
+                         'mail-transport-agent, libnosuch1'),
+         package('zlib1g', '1:1.2.7', 'sid', arch='i386')]),
+    'sources': (
+        [('source', TEXT), ('version', TEXT), ('distribution', TEXT),
+         ('release', TEXT), ('component', TEXT), ('architecture', TEXT),
+         ('build_depends', TEXT), ('build_depends_indep', TEXT),
+         ('build_conflicts', TEXT), ('build_conflicts_indep', TEXT)],
+        [['eglibc', '2.13-38', 'debian', 'sid', 'main', 'any',
+          'gettext', '', '', ''],
+         ['dpkg', '1.16.9', 'debian', 'sid', 'main', 'any',
+          'libbz2-dev', '', '', ''],
+         ['dpkg', '1.16.10', 'debian', 'experimental', 'main', 'any',
+          'libbz2-dev', '', '', '']]),
+    'popcon': (
+        [('package', TEXT), ('insts', INTEGER), ('vote', INTEGER),
+         ('olde', INTEGER), ('recent', INTEGER), ('nofiles', INTEGER)],
+        [['dpkg', 150000, 140000, 5000, 4000, 1000]]),
+    'upload_history': (
+        [('source', TEXT), ('version', TEXT), ('date', TIMESTAMP),
+         ('changed_by', TEXT), ('signed_by', TEXT), ('nmu', TEXT)],
+        [['dpkg', '1.16.9', datetime.datetime(2012, 10, 17, 12, 0),
+          'Guillem', 'Guillem', 'f'],
+         ['dpkg', '1.16.10', datetime.datetime(2013, 3, 28, 8, 30),
+          'Guillem', 'Guillem', 'f']]),
+    'screenshots': (
+        [('package', TEXT), ('screenshot_url', TEXT)],
+        [['dpkg', 'http://screenshots.debian.net/package/dpkg']]),
+}
+
+
+class TablesConnection(FakeConnection):
+    """ Stand-in for a connection to UDD that returns all rows of a table """
+    def answer(self, cursor, sql, params):
+        columns, rows = TABLES[sql.split()[3]]
+        cursor.description = [(c, t, None, None, None, None, None)
+                                for c, t in columns]
+        return rows
+
+
+class TranslateTests(unittest.TestCase):
+    def testTranslate(self):
+        """Test rewriting queries for SQLite"""
+        sql, params, distinct = translate(
+                r"""SELECT DISTINCT ON (source) source, version FROM sources
+                    WHERE source = ANY(%(packages)s) AND release=%(release)s
+                      AND version LIKE '1%%'""",
+                dict(packages=['dpkg', 'eglibc'], release='sid'))
+        self.assertEqual(distinct, 'source')
+        self.assertFalse('DISTINCT' in sql)
+        self.assert_('source IN (:packages__0, :packages__1)' in sql)
+        self.assert_('release=:release' in sql)
+        self.assert_("LIKE '1%'" in sql)
+        self.assertEqual(params['packages__1'], 'eglibc')
+        sql, params, distinct = translate(
+                "CASE WHEN release = %(pinrel0)s THEN %(pin0)s::integer",
+                dict(pinrel0='sid', pin0=500))
+        self.assertEqual(sql, "CASE WHEN release = :pinrel0 THEN :pin0")
+        self.assertEqual(distinct, None)
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'udd.sqlite')
+        self.conn = TablesConnection()
+        self.counts = snapshot.export(self.conn, self.filename,
+                                      ['sid', 'experimental'], ['amd64'])
+        self.udd = Udd(snapshot=self.filename)
+        self.dispatcher = Commands(self.udd)
+
+    def tearDown(self):
+        self.udd = None
+        shutil.rmtree(self.dir)
+
+    def testExport(self):
+        """Test writing a snapshot"""
+        self.assertEqual(self.counts['packages'], 6)
+        self.assertEqual(self.counts['upload_history'], 2)
+        self.assertEqual(len(self.conn.executed), len(snapshot.TABLES))
+        self.assertEqual(self.conn.executed[0][1]['release'],
+                         ['sid', 'experimental'])
+        self.assertEqual(os.listdir(self.dir), ['udd.sqlite'])
+        s = Snapshot(self.filename)
+        self.assertEqual(s.stats()['releases'], ['sid', 'experimental'])
+        self.assertEqual(s.stats()['archs'], ['amd64'])
+        s.close()
+        self.assertRaises(IOError, Snapshot,
+                          os.path.join(self.dir, 'nosuchfile'))
+
+    def testRows(self):
+        """Test reading rows by name and position"""
+        c = self.udd.pool.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        c.execute("SELECT package, size FROM packages "
+                  "WHERE package=%(package)s", dict(package='dpkg'))
+        row = c.fetchone()
+        self.assertEqual(row['package'], 'dpkg')
+        self.assertEqual(row[1], 2048)
+        self.assertEqual(row.keys(), ['package', 'size'])
+        self.assert_(isinstance(row['package'], str))
+        self.assertRaises(KeyError, lambda: row['nosuchcolumn'])
+        self.assertEqual(row.get('nosuchcolumn', 'x'), 'x')
+        c = self.udd.pool.cursor()
+        c.execute("SELECT package FROM packages WHERE package='dpkg'")
+        self.assertEqual(c.fetchall(), [('dpkg',), ('dpkg',)])
+
+    def testVersions(self):
+        """Test finding versions in order of the Debian version"""
+        rows = self.dispatcher.versions('dpkg', None, 'amd64')
+        self.assertEqual([r['version'] for r in rows],
+                         ['1.16.9', '1.16.10'])
+        rows = self.dispatcher.versions('src:dpkg', 'experimental', 'amd64')
+        self.assertEqual([r['version'] for r in rows], ['1.16.10'])
+        self.assertRaises(PackageNotFoundError, self.dispatcher.versions,
+                          'zlib1g', None, 'amd64')
+
+    def testInfo(self):
+        """Test showing the details of a package"""
+        p = self.dispatcher.info('dpkg', 'sid', 'amd64')
+        self.assertEqual(p['version'], '1.16.9')
+        self.assertEqual(p['installed_size'], 4)
+        self.assertEqual(p['screenshot_url'],
+                         'http://screenshots.debian.net/package/dpkg')
+        p = self.dispatcher.info('exim4', 'sid', 'amd64')
+        self.assertEqual(p['screenshot_url'], None)
+        self.assertRaises(PackageNotFoundError, self.dispatcher.info,
+                          'nosuchpackage', 'sid', 'amd64')
+
+    def testNames(self):
+        """Test searching package names, which are case-sensitive"""
+        rows = self.dispatcher.names('*t*', 'sid', 'amd64')
+        self.assertEqual([r['package'] for r in rows], ['mutt'])
+        self.assertEqual(self.dispatcher.names('MUTT', 'sid', 'amd64'), [])
+        rows = self.dispatcher.names('src:?glibc', 'sid', 'amd64')
+        self.assertEqual([r['package'] for r in rows], ['eglibc'])
+
+    def testCheckdepsArches(self):
+        """Test checking relationships in several architectures at once"""
+        queries = self.udd.pool.queries
+        statuses = self.dispatcher.checkdeps_arches('mutt', 'sid',
+                                        ['amd64', 'i386', 'mips'], ['depends'])
+        self.assertEqual(statuses.keys(), ['amd64'])
+        self.assertEqual(len(statuses['amd64']['depends'].bad), 1)
+        self.assertEqual(self.udd.pool.queries - queries, 3,
+                         'One query each for the package, its relations and '
+                         'the provides indexes')
+        statuses = self.dispatcher.checkdeps_arches('exim4', 'sid',
+                                        ['amd64', 'i386', 'mips'], ['depends'])
+        self.assertEqual(sorted(statuses.keys()), ['amd64', 'i386', 'mips'])
+        self.assertRaises(PackageNotFoundError,
+                          self.dispatcher.checkdeps_arches, 'zlib1g', 'sid',
+                          ['amd64'], ['depends'])
+
+    def testSuggestions(self):
+        """Test suggesting the names of packages that were not found"""
+        try:
+            self.dispatcher.info('dpgk', 'sid', 'amd64')
+            self.fail('PackageNotFoundError not raised')
+        except PackageNotFoundError, e:
+            self.assertEqual(e.suggestions, ['dpkg'])
+        queries = self.udd.pool.queries
+        self.assertRaises(PackageNotFoundError, self.dispatcher.archs,
+                          'mutt-ng', 'sid')
+        self.assertRaises(PackageNotFoundError, self.dispatcher.versions,
+                          'src:dpgk', 'sid', 'amd64')
+        self.assertEqual(self.udd.pool.queries, queries,
+                         'Absent names rejected without queries')
+
+    def testIndexesPerUdd(self):
+        """Test that the indexes built by a Udd are not shared with others"""
+        other = Udd(snapshot=self.filename)
+        self.assertRaises(PackageNotFoundError, self.dispatcher.info,
+                          'dpgk', 'sid', 'amd64')
+        self.assert_(self.udd.name_stats())
+        self.assertEqual(other.name_stats(), [])
+        other.flush()
+        self.assert_(self.udd.name_stats())
+
+    def testPsql(self):
+        """Test that the snapshot is the connection held for older code"""
+        self.assert_(self.udd.psql is self.udd.pool)
+        c = self.udd.psql.cursor()
+        c.execute("SELECT count(*) FROM packages")
+        self.assert_(c.fetchone()[0])
+
+    def testAsync(self):
+        """Test that AsyncUdd refuses to query a snapshot"""
+        self.assertRaises(ValueError, AsyncUdd, snapshot=self.filename)
+
+    def testResolveSource(self):
+        """Test finding a source package and its binaries in one query"""
+        r = self.udd.BindRelease('sid', 'amd64')
+        queries = self.udd.pool.queries
+        s = r.ResolveSource('libc6')
+        self.assertEqual(s.package, 'eglibc')
+        self.assertEqual(s.data['version'], '2.13-38')
+        self.assertEqual(s.Binaries(), ['libc6'])
+        self.assertEqual(self.udd.pool.queries - queries, 1)
+        self.assert_(r.ResolveSource('libc6') is s)
+        self.assertEqual(self.udd.pool.queries - queries, 1)
+        s = self.udd.BindSourcePackage('dpkg', ['sid', 'experimental'])
+        self.assertEqual(s.data['version'], '1.16.10')
+        self.assertEqual(s.Binaries(), ['dpkg'])
+        self.assertRaises(PackageNotFoundError, self.udd.BindSourcePackage,
+                          'mutt', 'sid')
+
+    def testArchs(self):
+        """Test finding the architectures of a package"""
+        rows = self.dispatcher.archs('exim4', 'sid')
+        self.assertEqual([r['architecture'] for r in rows], ['all'])
+
+    def testUploads(self):
+        """Test finding the uploads of a package"""
+        rows = self.dispatcher.uploads('dpkg', max=1)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['version'], '1.16.10')
+        self.assertEqual(rows[0]['date'].date(), datetime.date(2013, 3, 28))
+        rows = self.dispatcher.uploads('dpkg', version='1.16.9')
+        self.assertEqual(len(rows), 1)
+
+    def testPopcon(self):
+        """Test reading the popcon data"""
+        self.assertEqual(self.dispatcher.popcon('dpkg')['insts'], 150000)
+        self.assertRaises(PackageNotFoundError, self.dispatcher.popcon,
+                          'nosuchpackage')
+
+    def testCheckdeps(self):
+        """Test checking relationships against the snapshot"""
+        status = self.dispatcher.checkdeps('mutt', 'sid', 'amd64',
+                                           ['depends'])['depends']
+        self.assertEqual(len(status.good), 2)
+        self.assertEqual(len(status.bad), 1)
+        status = self.dispatcher.checkdeps('dpkg', 'experimental', 'amd64',
+                                           ['depends'])['depends']
+        self.assertEqual(len(status.bad), 1, 'libc6 (>= 2.14) not in sid')
+        self.assertEqual(self.udd.BindRelease('sid', 'amd64').
+                                Source('libc6').data['version'], '2.13-38')
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+""" Unit tests for the map of binary to source packages """
+
+import re
+import unittest2 as unittest
+from uddcache.udd import Udd
+from uddcache.packages import Release, PackageNotFoundError
+from uddcache.sourcemap import SourceMapRegistry
+from uddcache.test.fakes import FakeConnection
+
+
+class TablesConnection(FakeConnection):
+    """ Stand-in for a connection to the packages and sources tables """
+    def __init__(self):
+        FakeConnection.__init__(self)
+        self.tables = {
+                'packages': [{'package': 'libc6', 'source': 'eglibc'},
+                             {'package': 'libc-bin', 'source': 'eglibc'},
+                             {'package': 'dpkg', 'source': 'dpkg'},
+                             {'package': 'libdpkg-perl', 'source': 'dpkg'}],
+                'sources': [{'source': 'eglibc', 'version': '2.13-38'},
+                            {'source': 'dpkg', 'version': '1.16.9'}],
+            }
+
+    def answer(self, cursor, sql, params):
+        if 'UNION' in sql:
+            # the names of the packages (see nameindex.py)
+            return [(r['package'], 0) for r in self.tables['packages']] + \
+                   [(r['source'], 1) for r in self.tables['sources']]
+        table = re.search(r"FROM (\w+)", sql).group(1)
+        names = params.get('packages') or [params.get('package')]
+        return [r for r in self.tables[table]
+                    if table == 'packages' and not 'package' in params
+                        or r.get('source', r.get('package')) in names]
+
+
+class SourceMapTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = TablesConnection()
+        self.registry = SourceMapRegistry()
+
+    def testMap(self):
+        """Test mapping binary packages to their sources"""
+        sources = self.registry.index(self.conn, ('sid',))
+        self.assertEqual(sources.source('libc6'), 'eglibc')
+        self.assertEqual(sources.source('dpkg'), 'dpkg')
+        self.assertEqual(sources.source('eglibc'), None)
+        self.assert_(sources.is_source('eglibc'))
+        self.assertFalse(sources.is_source('libc6'))
+        self.assert_(sources is self.registry.index(self.conn, ('sid',)))
+        s = self.registry.stats()[0]
+        self.assertEqual((s['binaries'], s['sources']), (4, 2))
+        self.assert_(s['bytes'] > 0)
+
+    def testRelease(self):
+        """Test looking up source packages by binary package name"""
+        r = Release(self.conn, release='sid', sourcemap_registry=self.registry)
+        self.assertEqual(r.bin2src('libc6'), 'eglibc')
+        self.assertEqual(self.registry.builds, 1)
+        self.assertEqual(len(self.conn.executed), 1)
+        self.assertEqual(r.Source('libc-bin').package, 'eglibc')
+        self.assertEqual(len(self.conn.executed), 2,
+                         'One query for the binary and source names')
+        self.assertEqual(r.Source('libdpkg-perl').package, 'dpkg')
+        self.assertEqual(r.Source('dpkg').package, 'dpkg')
+        self.assertEqual(len(self.conn.executed), 3)
+        self.assertRaises(PackageNotFoundError, r.bin2src, 'nosuchpackage')
+        self.assertEqual(len(self.conn.executed), 4,
+                         'The names are read to suggest near names')
+        self.assertRaises(PackageNotFoundError, r.Source, 'libc6',
+                          autoBin2Src=False)
+        self.assertRaises(PackageNotFoundError, r.Source, 'nosuchpackage')
+
+
+class SourceMapQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.udd = Udd()
+
+    def tearDown(self):
+        self.udd = None
+
+    def testMap(self):
+        """Test the map against the packages table"""
+        release = self.udd.BindRelease(release='sid')
+        self.assertEqual(release.bin2src('libc6'), 'eglibc')
+        self.assertEqual(release.Source('libc6').package, 'eglibc')
+        self.assert_(self.udd.sourcemap_stats()[0]['binaries'] > 1000)
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -83,6 +83,23 @@ class database(unittest.TestCase):
         self.assert_(r.Found())
         self.assert_(r.data['version'])
 
+    def testPool(self):
+        """Test checking connections out of the pool"""
+        with self.udd.connection() as conn:
+            self.assert_(conn)
+            self.assertEqual(self.udd.pool_stats()['in_use'], 1)
+        self.assertEqual(self.udd.pool_stats()['in_use'], 0)
+        self.assert_(self.udd.pool_stats()['checkouts'])
+
+    def testPsql(self):
+        """Test using the connection held for older code"""
+        c = self.udd.psql.cursor()
+        c.execute("SELECT 1")
+        self.assertEqual(c.fetchone()[0], 1)
+        self.udd.psql.commit()
+        self.assert_(self.udd.psql is self.udd.psql)
+        self.assertEqual(self.udd.pool_stats()['in_use'], 1)
+
     def testBts(self):
         """Test binding to a source package and doing a lookup"""
         tracker = self.udd.Bts(False)
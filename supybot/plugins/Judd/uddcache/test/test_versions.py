@@ -0,0 +1,98 @@
+#!/usr/bin/python
+#
+# Ultimate Debian Database query tool
+#
+# Test suite
+#
+###
+#
+# Copyright (c) 2010-2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+###
+
+
+
+""" Unit tests for the sort keys of Debian versions """
+
+import unittest2 as unittest
+from uddcache import versions
+from uddcache.versions import version_key, make_key, compare, satisfies
+try:
+    from debian import debian_support
+except:
+    from debian_bundle import debian_support
+
+
+VERSIONS = ['0', '1', '1.0', '1.0-0', '1.0-1', '1.0-1.1', '1.0-1~bpo60+1',
+            '1.0.0', '1.0~', '1.0~rc1', '1.0~rc1-1', '1.0~~', '1.0a', '1.0+',
+            '1.0+b1', '1.0-0~1', '1.0-0.1', '1:0.1', '2:1.0', '10', '9.99',
+            '2.13-38', '2.11.3-4', '1.2.7.dfsg-13', '0.5a~git20120101-1',
+            '4.80-7', '1.5.21-6+deb7u1', '20120101', '1.0.0-0ubuntu1']
+
+
+class VersionKeyTests(unittest.TestCase):
+    def tearDown(self):
+        versions.max_keys = 50000
+        versions.clear()
+
+    def testOrder(self):
+        """Test ordering versions as debian_support does"""
+        for a in VERSIONS:
+            for b in VERSIONS:
+                expected = debian_support.version_compare(a, b)
+                self.assertEqual(cmp(make_key(a), make_key(b)),
+                                 cmp(expected, 0), "%s vs %s" % (a, b))
+        self.assertEqual(sorted(VERSIONS, key=version_key),
+                         sorted(VERSIONS, cmp=debian_support.version_compare))
+
+    def testMemo(self):
+        """Test keeping the keys of the versions in a bounded memo"""
+        versions.clear()
+        versions.max_keys = 3
+        key = version_key('1.0')
+        self.assert_(version_key('1.0') is key)
+        for v in VERSIONS:
+            version_key(v)
+        self.assert_(len(versions._keys) + len(versions._old_keys) <= 6)
+        self.assertEqual(version_key('1.0'), key)
+
+    def testSatisfies(self):
+        """Test versions against the constraints of relationships"""
+        self.assert_(satisfies('2.13-38', '>=', '2.11'))
+        self.assert_(satisfies('2.13-38', '>>', '2.13'))
+        self.assert_(satisfies('1.0', '=', '1.0-0'))
+        self.assert_(satisfies('1.0~rc1', '<<', '1.0'))
+        self.assert_(satisfies('1:0.1', '>>', '2.0'))
+        self.assertFalse(satisfies('1.0', '<=', '1.0~'))
+        self.assertEqual(compare('1.0', '1.0.0'), -1)
+        self.assertRaises(ValueError, satisfies, '1.0', '>', '1.0')
+
+
+###########################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -36,8 +36,19 @@
 
 
 import re
+import itertools
+import threading
 import psycopg2
+import psycopg2.extensions
 import database
+import engine
+import cache
+import batch
+import provides
+import sourcemap
+import nameindex
+import slices
+import snapshot
 from data import DebianData
 from config import Config
 from packages import *
@@ -47,7 +58,8 @@ class Udd():
     """
     """
 
-    def __init__(self, config=None, distro="debian", logfile=None):
+    def __init__(self, config=None, distro="debian", logfile=None,
+                 snapshot=None):
         """Initialise the connection to the UDD instance
 
             config: config filename or Config instance
@@ -55,11 +67,17 @@ class Udd():
             logfile: filename into which database calls should be logged
                     or False to suppress loading this setting from the
                     config file
+            snapshot: filename of a snapshot of UDD (see snapshot.py) to
+                    be queried instead of the database server; also set
+                    with the 'snapshot' option of the config file
         """
         if type(config) is str or config is None:
-            config = Config(config)
+            config = Config(config,
+                            confdict=snapshot and {'snapshot': snapshot})
         self.config = config
-        self.psql = None
+        self.snapshot = snapshot or config.db_snapshot()
+        self.pool = None
+        self._psql = None
         self._connect(logfile)
         if distro == 'debian':
             self.data = DebianData()
@@ -68,6 +86,13 @@ class Udd():
             # TODO: add this in
         else:
             raise ValueError("Unknown data types requested by 'distro'")
+        # the packages of the busiest releases are held in memory
+        wanted = [(self.data.list_dependent_releases(r) or [r], a)
+                    for r, a in self.config.db_release_slices()]
+        self.slices = slices.SliceStore(self.pool, wanted)
+        self.slices.listeners.append(self._sliced)
+        self.releases.slices = self.slices
+        self.slices.reload()
 
     def __del__(self):
         self._disconnect()
@@ -85,42 +110,352 @@ class Udd():
         for i in c.keys():
             if c[i] != None:
                 args[arg_mapping[i]] = c[i]
+        self._args = args
 
         # look up logfile settings from config file unless instructed not to
         if logfile == None:
             logfile = self.config.db_logging()
 
-        # make the connection, logging to the file if requests
-        self.psql = database.Connect(logfile, **args)
+        querylog = None
+        if logfile:
+            querylog = database.query_log(logfile,
+                                slow_ms=self.config.db_log_slow_ms(),
+                                sample_rate=self.config.db_log_sample_rate())
+
+        prepare = self.config.db_prepared_statements()
+
+        def make_pool(args):
+            # make a pool of connections, logging to the file if requested
+            return database.ConnectionPool(
+                        lambda: database.Connect(querylog, prepare, **args),
+                        size=self.config.db_pool_size(),
+                        timeout=self.config.db_pool_timeout(),
+                        retries=self.config.db_reconnect_attempts(),
+                        backoff=self.config.db_reconnect_backoff())
+
+        self._replicas = not self.snapshot and self._replica_args(args) or []
+        if self.snapshot:
+            # the tables are read from a local file (see snapshot.py)
+            self.pool = snapshot.Snapshot(self.snapshot)
+        elif self._replicas:
+            # route the queries between a pool for each of the replicas
+            self.pool = database.ReplicaRouter(
+                        [(name, make_pool(a)) for name, a in self._replicas],
+                        policy=self.config.db_routing(),
+                        check_interval=self.config.db_health_check_interval(),
+                        retries=self.config.db_reconnect_attempts(),
+                        backoff=self.config.db_reconnect_backoff())
+        else:
+            self.pool = make_pool(args)
+
+        # the runs of UDD's importers are watched so that the data held
+        # from UDD is dropped once it is stale; a snapshot has no record of
+        # the imports into UDD to check
+        self.watcher = None
+        if not self.snapshot:
+            self.watcher = cache.ImportWatcher(self.pool,
+                        interval=self.config.db_cache_check_interval())
+        # results of the queries that ask for it are cached on the pool
+        self.cache = None
+        if self.config.db_cache_size() and not self.snapshot:
+            self.cache = cache.QueryCache(
+                        size=self.config.db_cache_size(),
+                        ttl=self.config.db_cache_ttl(),
+                        table_ttls=self.config.db_cache_table_ttls(),
+                        watcher=self.watcher)
+            self.pool.cache = self.cache
+        if self.watcher is not None:
+            self.watcher.listeners.append(self._imported)
+        # the indexes read from the packages tables belong to this database
+        self.provides_registry = provides.ProvidesRegistry()
+        self.sourcemap_registry = sourcemap.SourceMapRegistry()
+        self.name_registry = nameindex.NameRegistry()
+        # the packages looked up in the Releases are kept between commands
+        self.releases = ReleaseRegistry(self.pool,
+                        cache.ObjectCache(
+                            entries=self.config.db_release_cache_entries(),
+                            size=self.config.db_release_cache_size(),
+                            sizeof=package_size),
+                        provides_registry=self.provides_registry,
+                        sourcemap_registry=self.sourcemap_registry,
+                        name_registry=self.name_registry)
+        # the pool is handed out as the database connection to Release and
+        # Bts objects so that they check out a connection per operation;
+        # if the server restarts, the pool reconnects and those objects (and
+        # their caches) remain usable
+        self._psql_lock = threading.Lock()
+
+    def _replica_args(self, defaults):
+        """Return a list of (name, connection args) for the replicas"""
+        replicas = []
+        for dsn in self.config.db_replicas():
+            args = dict(defaults)
+            for k, v in psycopg2.extensions.parse_dsn(dsn).items():
+                if k == 'dbname':
+                    k = 'database'
+                args[k] = v
+            name = "%s:%s/%s" % (args.get('host', 'localhost'),
+                                 args.get('port', '5432'),
+                                 args.get('database', 'udd'))
+            replicas.append((name, args))
+        return replicas
 
     def _disconnect(self):
-        self.psql.close()
+        if self._psql is not None and self._psql is not self.pool:
+            self.pool.putconn(self._psql)
+        self._psql = None
+        if self.pool:
+            self.pool.closeall()
+
+    @property
+    def psql(self):
+        """
+        A database connection held for the lifetime of this instance
+
+        Kept for code that calls cursor() and commit() on the connection;
+        the connection is checked out of the pool on first use and is not
+        replaced if the server restarts. Pass self.pool to the Release and
+        Bts objects or use connection() instead.
+        """
+        with self._psql_lock:
+            if self._psql is None:
+                if hasattr(self.pool, 'getconn'):
+                    conn = self.pool.getconn()
+                    try:
+                        database.reset_statement_timeout(conn)
+                    except psycopg2.Error:
+                        self.pool.putconn(conn, close=True)
+                        raise
+                    self._psql = conn
+                else:
+                    # a snapshot is its own connection
+                    self._psql = self.pool
+            return self._psql
+
+    def export_snapshot(self, filename, releases, archs=None):
+        """
+        Write the package tables of releases to a snapshot file
+
+        The snapshot can then be queried by Udd(snapshot=filename) without
+        the database server. Returns the number of rows of each table.
+        """
+        return snapshot.export(self.pool, filename, releases, archs)
+
+    def connection(self):
+        """
+        Check out a database connection for the duration of a with block
+        """
+        return database.connection(self.pool)
+
+    def batch(self):
+        """
+        Queue queries to be sent to the database together (see batch.py)
+
+        Each query returns a Future for its result; the queries are sent
+        when the Batch is executed, at the end of a with block or when the
+        first result is asked for.
+        """
+        return batch.Batch(self.pool)
+
+    def deadline(self, budget):
+        """
+        Impose a time budget in seconds on the queries made in a with block
+
+        The budget applies to all queries made by the current thread,
+        including those made through Release, Checker and Bts objects;
+        DeadlineExceededError is raised once it has run out.
+        """
+        return database.deadline(budget)
+
+    def pool_stats(self):
+        """
+        Return the usage counters for the pool of database connections
+
+        When routing between replicas, the counters are summed over the
+        replicas and the state of each replica is given under 'replicas'.
+        """
+        return self.pool.stats()
+
+    def query_stats(self):
+        """
+        Return the query latency statistics by fingerprint, origin and replica
+        """
+        return database.query_stats.dump()
+
+    def cache_stats(self):
+        """
+        Return the hit and miss counters for the cache of query results
+        """
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
+
+    def provides_stats(self):
+        """
+        Return the size and build time of the indexes of virtual packages
+        """
+        return self.provides_registry.stats()
+
+    def slice_stats(self):
+        """
+        Return the size and load time of the releases held in memory
+        """
+        return self.slices.stats()
+
+    def sourcemap_stats(self):
+        """
+        Return the size and build time of the maps of binary to source
+        packages
+        """
+        return self.sourcemap_registry.stats()
+
+    def name_stats(self):
+        """
+        Return the size and build time of the indexes of package names and
+        the number of lookups that they have rejected
+        """
+        return self.name_registry.stats()
+
+    def release_stats(self):
+        """
+        Return the usage counters of the cache of packages of the releases
+        """
+        return self.releases.stats()
+
+    def flush(self):
+        """
+        Drop all the data cached from UDD, e.g. once UDD has been updated
+        """
+        self.releases.flush()
+        self.provides_registry.clear()
+        self.sourcemap_registry.clear()
+        self.name_registry.clear()
+        self.slices.reload()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _imported(self, tables):
+        # called by the ImportWatcher when UDD's importers have run
+        if tables is None or [t for t in tables
+                                if t in ('packages', 'sources')]:
+            self.releases.flush()
+            self.provides_registry.clear()
+            self.sourcemap_registry.clear()
+            self.name_registry.clear()
+            self.slices.reload()
+
+    def _sliced(self):
+        # called by the SliceStore once new slices are in use: the packages
+        # and indexes built from the old slices in the meantime are dropped
+        self.releases.flush()
+        self.provides_registry.clear()
+        self.sourcemap_registry.clear()
+        self.name_registry.clear()
+
+    def check_imports(self):
+        """
+        Drop the data held from UDD if its importers have run since the
+        last check (see cache.ImportWatcher)
+        """
+        if self.watcher is not None:
+            self.watcher.check()
+
+    def check_imports_plan(self):
+        """
+        Plan (see engine.py) that makes the same check as check_imports()
+
+        The plans of the Commands classes bind their releases after this
+        step rather than with BindRelease, so that an AsyncUdd polls UDD
+        with a Query step instead of blocking its event loop.
+        """
+        if self.watcher is not None:
+            yield self.watcher.plan()
 
     def BindRelease(self, release="lenny", arch="i386", **kwargs):
         """
         Select a release from the database
+
+        The Release objects are shared, as are the packages that have
+        been looked up in them.
+        """
+        # flush the packages if UDD has imported new ones
+        self.check_imports()
+        return self.releases.get(release, arch, **kwargs)
+
+    def BindArches(self, release="lenny", arches=None, **kwargs):
+        """
+        Select a release in several architectures, by default all of those
+        for which packages are built
+
+        The packages are looked up in all the architectures at once (see
+        ReleaseArches).
         """
-        r = Release(self.psql, arch=arch, release=release, **kwargs)
-        return r
+        self.check_imports()
+        return self.releases.arches(release,
+                                    arches or self.data.list_arches(),
+                                    **kwargs)
 
     def BindPackage(self, package="", release="lenny", arch="i386"):
         """
         Select a package from the database
         """
-        r = Release(self.psql, arch=arch, release=release)
+        r = self.BindRelease(arch=arch, release=release)
         p = r.Package(package)
         return p
 
     def BindSourcePackage(self, package="", release="lenny"):
         """
         Select a source package from the database
+
+        The package may be named by the name of one of its binary packages;
+        its binary packages are looked up with it (see
+        Release.ResolveSource).
         """
-        r = Release(self.psql, release=release)
-        p = r.Source(package)
+        r = self.BindRelease(release=release)
+        p = r.ResolveSource(package)
         return p
 
     def Bts(self, include_archived=True):
         """
         Create a new bug tracker
         """
-        return bts.Bts(self.psql, include_archived)
+        return bts.Bts(self.pool, include_archived)
+
+
+class AsyncUdd(Udd):
+    """
+    A Udd instance that can also run queries on an event loop
+
+    The synchronous API is unchanged. The engine runs the plans of
+    AsyncCommands objects (see package_queries.py and bug_queries.py) over
+    its own pool of asynchronous connections, returning futures. The engine
+    only talks to the database server, so a snapshot cannot be queried.
+    """
+
+    engine = None
+
+    def _connect(self, logfile):
+        if self.snapshot:
+            raise ValueError("A snapshot of UDD cannot be queried "
+                             "asynchronously; use Udd instead.")
+        Udd._connect(self, logfile)
+        # new connections are opened on each of the replicas in turn
+        targets = itertools.cycle([a for name, a in self._replicas] or
+                                  [self._args])
+        self.engine = engine.AsyncEngine(
+                        lambda: database.ConnectAsync(**targets.next()),
+                        size=self.config.db_pool_size(),
+                        workers=self.config.db_async_workers(),
+                        retries=self.config.db_reconnect_attempts(),
+                        backoff=self.config.db_reconnect_backoff())
+
+    def _disconnect(self):
+        Udd._disconnect(self)
+        if self.engine:
+            self.engine.close()
+
+    def engine_stats(self):
+        """
+        Return the usage counters for the event loop query engine
+        """
+        return self.engine.stats()
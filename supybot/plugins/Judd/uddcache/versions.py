@@ -0,0 +1,153 @@
+###
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011  Stuart Prescott
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES LOSS OF USE, DATA, OR PROFITS OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Sort keys for Debian version strings
+
+Comparing two debian_support.Version objects splits both version strings
+up again each time, and the same versions (those of the packages of a
+release and those in the relationships that name them) are compared over
+and over while checking relationships and sorting lists of packages.
+
+version_key() instead turns each version string once into a tuple that
+Python compares natively in the order given by Debian Policy §5.6.12, and
+keeps the keys of the versions that have been seen in a bounded memo.
+
+Typical usage:
+    versions.sort(key=version_key)
+    if satisfies('2.13-38', '>=', '2.11'):
+        ...
+"""
+
+import re
+
+
+# the order of the characters of the non-digit parts of a version: letters
+# sort before all other characters and '~' before anything, even the end
+# of the part (0)
+def _order(c):
+    if c == '~':
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+_orders = dict([(chr(i), _order(chr(i))) for i in range(256)])
+_parts = re.compile(r"(\D*)(\d*)")
+_end = ((0,), 0)
+
+
+def _part_key(part):
+    """ key for the upstream version or the Debian revision
+
+    Each non-digit part and the number that follows it become a pair; the
+    end of the version is marked by a pair that sorts after any pair
+    starting with '~' and before any other, as the end of a part does.
+    """
+    pairs = _parts.findall(part)
+    if len(pairs) > 1:
+        # the last match is always empty
+        pairs.pop()
+    return tuple([(tuple([_orders.get(c, 256) for c in text]) + (0,),
+                   int(number or 0))
+                  for text, number in pairs]) + (_end,)
+
+
+def make_key(version):
+    """ Return the sort key of a version string without the memo """
+    epoch = 0
+    if ':' in version:
+        epoch, version = version.split(':', 1)
+        epoch = int(epoch)
+    revision = ''
+    if '-' in version:
+        version, revision = version.rsplit('-', 1)
+    return (epoch, _part_key(version), _part_key(revision))
+
+
+# the memo is in two generations: when the newer one is full it becomes
+# the older one, and keys still in use are brought back from it, so that
+# the memo holds at most twice max_keys keys
+max_keys = 50000
+_keys = {}
+_old_keys = {}
+
+
+def version_key(version):
+    """ Return a key that orders a version string as Debian does
+
+    The keys of the same versions are wanted over and over, so they are
+    kept in a memo of the most recently used ones.
+    """
+    global _keys, _old_keys
+    key = _keys.get(version)
+    if key is None:
+        key = _old_keys.get(version)
+        if key is None:
+            key = make_key(version)
+        if len(_keys) >= max_keys:
+            _old_keys = _keys
+            _keys = {}
+        _keys[version] = key
+    return key
+
+
+def compare(a, b):
+    """ Compare two version strings as cmp() does """
+    return cmp(version_key(a), version_key(b))
+
+
+def satisfies(version, operator, target):
+    """ Test a version against a relationship's constraint
+
+        version: the version of the package in the archive
+        operator: one of the relationship operators '>>', '>=', '=',
+                '<=' or '<<'
+        target: the version in the relationship
+    """
+    c = compare(version, target)
+    if operator == '>>':
+        return c > 0
+    if operator == '>=':
+        return c >= 0
+    if operator == '=':
+        return c == 0
+    if operator == '<=':
+        return c <= 0
+    if operator == '<<':
+        return c < 0
+    raise ValueError("Illegal operator in relationship: %s" % operator)
+
+
+def clear():
+    """ Empty the memo of keys """
+    global _keys, _old_keys
+    _keys = {}
+    _old_keys = {}